@@ -1,21 +1,36 @@
 import datetime
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import isoparse
+from itertools import chain, islice
 from sys import stdout
+from threading import local
 
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 from requests.auth import HTTPBasicAuth
+from requests.exceptions import RequestException
 
 from django.conf import settings
+from django.db import transaction
 
 from results.models.athletes import Athlete
-from results.models.athletes import AthleteInformation
+from results.models.athletes import AthleteInformation, LicenceSyncState
 from results.models.organizations import Organization
+from results.utils.response_cache import invalidate_response_cache
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class SuomisportError(Exception):
+    """Suomisport API returned an invalid response."""
+
 
 class Suomisport:
     """
@@ -33,37 +48,111 @@ class Suomisport:
         self.organization_id = settings.SUOMISPORT.get('ORGANIZATION_ID', None)
         self.licence_types = settings.SUOMISPORT.get('LICENCE_TYPES', None)
         self.fetch_size = settings.SUOMISPORT.get('FETCH_SIZE', 1000)
+        self.fetch_workers = settings.SUOMISPORT.get('FETCH_WORKERS', 4)
+        self.fetch_retries = settings.SUOMISPORT.get('FETCH_RETRIES', 3)
+        self.fetch_backoff = settings.SUOMISPORT.get('FETCH_BACKOFF', 1)
+        self.client_id = client_id
+        self.sessions = local()
         auth = HTTPBasicAuth(client_id, client_secret)
         client = BackendApplicationClient(client_id=client_id)
         self.oauth = OAuth2Session(client=client)
         self.token = self.oauth.fetch_token(token_url=self.token_url, auth=auth)
 
+    def _new_session(self):
+        """
+        Create a new API session with the token of the connector's session.
+
+        :return: API session
+        :rtype: OAuth2Session
+        """
+        return OAuth2Session(client=BackendApplicationClient(client_id=self.client_id), token=self.token)
+
+    def _init_worker(self):
+        """
+        Initialize a fetch worker thread with its own API session, as requests sessions are not thread-safe.
+        """
+        self.sessions.session = self._new_session()
+
+    def _get_page(self, url):
+        """
+        Fetch a single page from API. Connection errors and temporary error responses are retried FETCH_RETRIES
+        times, waiting FETCH_BACKOFF seconds before the first retry and doubling the wait for each retry.
+
+        :param url: page url
+        :type url: str
+        :return: response content
+        :rtype: dict
+        :raises RequestException: if the request fails or API returns an error after the retries
+        """
+        attempt = 0
+        while True:
+            try:
+                response = getattr(self.sessions, 'session', self.oauth).get(url)
+            except RequestException as e:
+                if attempt >= self.fetch_retries:
+                    raise
+                logger.warning('Suomisport API request failed, retrying: %s: %s', url, e)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.fetch_retries:
+                    response.raise_for_status()
+                    return response.json()
+                logger.warning('Suomisport API returned %s, retrying: %s', response.status_code, url)
+            time.sleep(self.fetch_backoff * 2 ** attempt)
+            attempt += 1
+
+    def _fetch_pages(self, path, ts=None):
+        """
+        Fetch pages from API. Creates multiple requests if all results do not fit in FETCH_SIZE parameter.
+
+        Page count is read from the first page. Following pages are fetched in a thread pool, FETCH_WORKERS pages
+        ahead of the page being processed, and yielded in order. Each worker thread uses its own API session.
+
+        :param path: path to resource, i.e. 'licence/'
+        :param ts: fetch only results updates since ts
+        :type path: str
+        :type ts: datetime
+        :return: content list for each page
+        :rtype: generator
+        :raises SuomisportError: if a following page has no content
+        """
+        url = self.base_url + path + '?size=' + str(self.fetch_size)
+        if ts:
+            url += '&ts=' + ts.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        result = self._get_page(url + '&page=0')
+        if not result or 'content' not in result:
+            return
+        yield result['content']
+        if 'pageable' not in result or result['pageable']['total'] < result['pageable']['size']:
+            return
+        pages = iter(range(1, math.ceil(result['pageable']['total'] / result['pageable']['size'])))
+        with ThreadPoolExecutor(max_workers=self.fetch_workers, initializer=self._init_worker) as executor:
+            futures = deque(executor.submit(self._get_page, url + '&page=' + str(page))
+                            for page in islice(pages, self.fetch_workers))
+            try:
+                while futures:
+                    result = futures.popleft().result()
+                    if not result or 'content' not in result:
+                        raise SuomisportError('Suomisport API returned a page without content: %s' % path)
+                    page = next(pages, None)
+                    if page is not None:
+                        futures.append(executor.submit(self._get_page, url + '&page=' + str(page)))
+                    yield result['content']
+            finally:
+                for future in futures:
+                    future.cancel()
+
     def _fetch_from_api(self, path, ts=None):
         """
-        Fetch information from API. Creates multiple requests if all results do not fit in FETCH_SIZE parameter.
+        Fetch information from API, page by page.
 
         :param path: path to resource, i.e. 'licence/'
         :param ts: fetch only results updates since ts
         :type path: str
         :type ts: datetime
-        :return: content list
-        :rtype: list
+        :return: content items
+        :rtype: generator
         """
-        content = []
-        page = 0
-        while True:
-            url = self.base_url + path + '?page=' + str(page) + '&size=' + str(self.fetch_size)
-            if ts:
-                url += '&ts=' + ts.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
-            result = self.oauth.get(url).json()
-            if not result or 'content' not in result:
-                break
-            content += result['content']
-            if ('pageable' not in result or result['pageable']['total'] < result['pageable']['size'] or
-                    (page > 0 and result['pageable']['total'] < result['pageable']['size'] * (page + 1))):
-                break
-            page += 1
-        return content
+        return chain.from_iterable(self._fetch_pages(path, ts))
 
     def get_licence_types(self, date=None):
         """
@@ -95,7 +184,7 @@ class Suomisport:
         :param licence_type_id: int
         :param ts: datetime
         :return: licences
-        :rtype: list
+        :rtype: generator
         """
         url = 'user-licence/' + self.organization_id + '/' + str(licence_period_id) + '/' + str(licence_type_id)
         licences = self._fetch_from_api(url, ts)
@@ -120,133 +209,320 @@ class Suomisport:
         else:
             return 'U'
 
+    def _parse_licence(self, licence, only_year=False):
+        """
+        Parse athlete and licence information from Suomisport licence
+
+        :param licence: Suomisport licence
+        :param only_year: set athlete's birth date to YYYY-01-01
+        :type licence: dict
+        :type only_year: bool
+        :return: athlete field values and licence field values
+        :rtype: tuple
+        """
+        user = licence['user']
+        first_name = user['nickname'].capitalize() if 'nickname' in user else None
+        if not first_name:
+            first_name = user['firstName'].split(' ')[0].capitalize()
+        date_of_birth = datetime.datetime.strptime(user['birthDate'], '%Y-%m-%d').date()
+        if only_year:
+            date_of_birth = date_of_birth.replace(month=1, day=1)
+        athlete = {
+            'sport_id': str(user['sportId']),
+            'first_name': first_name,
+            'last_name': user['lastName'].capitalize(),
+            'gender': self._parse_gender(user['gender']),
+            'date_of_birth': date_of_birth,
+        }
+        information = {
+            'type': 'licence',
+            'value': licence['name'],
+            'date_start': datetime.datetime.strptime(licence['usagePeriodStart'], '%Y-%m-%d').date(),
+            'date_end': datetime.datetime.strptime(licence['usagePeriodEnd'], '%Y-%m-%d').date(),
+            'modification_time': isoparse(licence['modificationTime']),
+            'visibility': 'A',
+        }
+        return athlete, information
+
     def _update_athletes(self, licences, print_to_stdout=False, only_year=False):
         """
-        Update athletes and licences based on Suomisport licence list
+        Update athletes and licences based on Suomisport licence list, in batches of FETCH_SIZE licences
 
         :param licences: Suomisport licence list
         :param print_to_stdout: print messages to stdout
+        :param only_year: set athlete's birth date to YYYY-01-01
+        :type licences: iterable
+        :type print_to_stdout: bool
+        :type only_year: bool
+        :return: latest licence modification time or None if there were no licences
+        :rtype: datetime
+        """
+        latest_modification = None
+        licences = iter(licences)
+        while True:
+            batch = list(islice(licences, self.fetch_size))
+            if not batch:
+                break
+            self._update_athlete_batch(batch, print_to_stdout=print_to_stdout, only_year=only_year)
+            latest = max(isoparse(licence['modificationTime']) for licence in batch)
+            if latest_modification is None or latest > latest_modification:
+                latest_modification = latest
+        return latest_modification
+
+    def _update_athlete_batch(self, licences, print_to_stdout=False, only_year=False):
+        """
+        Update athletes and licences for a batch of Suomisport licences
+
+        Organizations, athletes and existing licences are loaded with a single query each. New athletes and
+        licences are added with bulk_create and modified athletes are updated with bulk_update. Athletes with
+        no_auto_update are not modified.
+
+        :param licences: Suomisport licences
+        :param print_to_stdout: print messages to stdout
+        :param only_year: set athlete's birth date to YYYY-01-01
         :type licences: list
         :type print_to_stdout: bool
+        :type only_year: bool
         """
+        organizations = {organization.sport_id: organization for organization in Organization.objects.filter(
+            sport_id__in={str(licence['licenceOrganizationSportId']) for licence in licences})}
+        athletes = {athlete.sport_id: athlete for athlete in Athlete.objects.filter(
+            sport_id__in={str(licence['user']['sportId']) for licence in licences}).select_related('organization')}
+        created = {}
+        modified = {}
+        information = []
         for licence in licences:
-            try:
-                organization = Organization.objects.get(sport_id=str(licence['licenceOrganizationSportId']))
-            except Organization.DoesNotExist:
+            organization = organizations.get(str(licence['licenceOrganizationSportId']), None)
+            if organization is None:
                 logger.warning('Could not find organization with ID: %s', str(licence['licenceOrganizationSportId']))
                 if print_to_stdout:
                     stdout.write(
                         'Could not find organization with ID: %s\n' % str(licence['licenceOrganizationSportId']))
                 continue
-            start = datetime.datetime.strptime(licence['usagePeriodStart'], '%Y-%m-%d').date()
-            end = datetime.datetime.strptime(licence['usagePeriodEnd'], '%Y-%m-%d').date()
-            licence_name = licence['name']
-            modification_time = isoparse(licence['modificationTime'])
-            user = licence['user']
-            sport_id = str(user['sportId'])
-            first_name = user['nickname'].capitalize() if 'nickname' in user else None
-            if not first_name:
-                first_name = user['firstName'].split(' ')[0].capitalize()
-            last_name = user['lastName'].capitalize()
-            gender = self._parse_gender(user['gender'])
-            date_of_birth = datetime.datetime.strptime(user['birthDate'], '%Y-%m-%d').date()
-            if only_year:
-                date_of_birth = date_of_birth.replace(month=1, day=1)
-            try:
-                athlete = Athlete.objects.get(sport_id=sport_id)
-                modified = False
-                if athlete.first_name != first_name:
-                    athlete.first_name = first_name
-                    modified = True
-                if athlete.last_name != last_name:
-                    athlete.last_name = last_name
-                    modified = True
-                if athlete.gender != gender:
-                    athlete.gender = gender
-                    modified = True
-                if athlete.date_of_birth != date_of_birth:
-                    athlete.date_of_birth = date_of_birth
-                    modified = True
-                if not athlete.organization or athlete.organization != organization:
-                    athlete.organization = organization
-                    modified = True
-                if modified:
-                    if not athlete.no_auto_update:
-                        athlete.save()
-                        logger.info('Updated athlete information from Suomisport: %s', sport_id)
-                        if print_to_stdout:
-                            stdout.write('Modified athlete: %s\n' % sport_id)
-                    else:
-                        if print_to_stdout:
-                            stdout.write('Athlete update prevented by no_auto_update: %s\n' % sport_id)
-            except Athlete.DoesNotExist:
-                athlete = Athlete.objects.create(sport_id=sport_id,
-                                                 first_name=first_name,
-                                                 last_name=last_name,
-                                                 date_of_birth=date_of_birth,
-                                                 gender=gender,
-                                                 organization=organization)
-                logger.info('Created new athlete from Suomisport: %s', sport_id)
-                if print_to_stdout:
-                    stdout.write('Created athlete: %s\n' % sport_id)
-            AthleteInformation.objects.get_or_create(athlete=athlete,
-                                                     type='licence',
-                                                     value=licence_name,
-                                                     date_start=start,
-                                                     date_end=end,
-                                                     modification_time=modification_time,
-                                                     visibility='A')
+            values, licence_values = self._parse_licence(licence, only_year=only_year)
+            sport_id = values['sport_id']
+            values['organization'] = organization
+            athlete = athletes.get(sport_id, None)
+            if athlete is None:
+                athlete = Athlete(**values)
+                athletes[sport_id] = created[sport_id] = athlete
+            elif any(getattr(athlete, field) != value for field, value in values.items()):
+                if athlete.no_auto_update:
+                    if print_to_stdout:
+                        stdout.write('Athlete update prevented by no_auto_update: %s\n' % sport_id)
+                else:
+                    for field, value in values.items():
+                        setattr(athlete, field, value)
+                    if sport_id not in created:
+                        modified[sport_id] = athlete
+            information.append((athlete, licence_values))
+        with transaction.atomic():
+            self._create_athletes(list(created.values()), print_to_stdout=print_to_stdout)
+            if modified:
+                Athlete.objects.bulk_update(modified.values(), ['first_name', 'last_name', 'gender', 'date_of_birth',
+                                                                'organization'])
+                Athlete.log_changes(modified.values())
+                for sport_id in modified:
+                    logger.info('Updated athlete information from Suomisport: %s', sport_id)
+                    if print_to_stdout:
+                        stdout.write('Modified athlete: %s\n' % sport_id)
+                invalidate_response_cache(athletes=[athlete.pk for athlete in modified.values()])
+            self._create_licences(information)
+
+    @staticmethod
+    def _create_athletes(athletes, print_to_stdout=False):
+        """
+        Create new athletes with bulk_create
+
+        :param athletes: unsaved athletes
+        :param print_to_stdout: print messages to stdout
+        :type athletes: list
+        :type print_to_stdout: bool
+        """
+        if not athletes:
+            return
+        Athlete.objects.bulk_create(athletes)
+        if any(athlete.pk is None for athlete in athletes):
+            ids = dict(Athlete.objects.filter(sport_id__in=[athlete.sport_id for athlete in athletes]).values_list(
+                'sport_id', 'pk'))
+            for athlete in athletes:
+                athlete.pk = ids[athlete.sport_id]
+        Athlete.log_additions(athletes)
+        for athlete in athletes:
+            logger.info('Created new athlete from Suomisport: %s', athlete.sport_id)
+            if print_to_stdout:
+                stdout.write('Created athlete: %s\n' % athlete.sport_id)
+
+    @staticmethod
+    def _create_licences(information):
+        """
+        Create licences which do not exist yet with bulk_create
+
+        :param information: list of (athlete, licence field values) tuples
+        :type information: list
+        """
+        fields = ['type', 'value', 'date_start', 'date_end', 'modification_time', 'visibility']
+        existing = set(AthleteInformation.objects.filter(
+            athlete__in=[athlete for athlete, values in information], type='licence').values_list(
+            'athlete_id', *fields))
+        licences = []
+        for athlete, values in information:
+            key = (athlete.pk,) + tuple(values[field] for field in fields)
+            if key not in existing:
+                existing.add(key)
+                licences.append(AthleteInformation(athlete=athlete, **values))
+        AthleteInformation.objects.bulk_create(licences)
+        if any(licence.pk is None for licence in licences):
+            ids = {row[1:]: row[0] for row in AthleteInformation.objects.filter(
+                athlete__in=[licence.athlete_id for licence in licences], type='licence').values_list(
+                'pk', 'athlete_id', *fields)}
+            for licence in licences:
+                licence.pk = ids[(licence.athlete_id,) + tuple(getattr(licence, field) for field in fields)]
+        AthleteInformation.log_additions(licences)
 
     def update_licences(self, update_only_latest=True, print_to_stdout=False, only_year=False):
         """
         Fetch licences and update athletes
 
-        :param update_only_latest: update only licences added since last modification time
+        Sync watermark for each licence period and licence type is stored in
+        :class:`results.models.athletes.LicenceSyncState` after all its licences have been fetched and applied. If
+        fetching a page fails, the error is raised and the watermark is not changed.
+
+        :param update_only_latest: update only licences modified since the licence type's sync watermark, or since
+            the last licence modification time if the licence type has no watermark
         :param print_to_stdout: print messages to stdout
         :param only_year: set athlete's birth date to YYYY-01-01
         :type update_only_latest: bool
         :type print_to_stdout: bool
         :type only_year: bool
         """
-        if update_only_latest:
+        licence_types = [licence_type for licence_type in self.get_licence_types(datetime.date.today())
+                         if licence_type['type'] in self.licence_types]
+        states = {(state.licence_period_id, state.licence_type_id): state for state in
+                  LicenceSyncState.objects.filter(licence_type_id__in=[item['id'] for item in licence_types])}
+        missing_watermark = any(
+            not getattr(states.get((item['licencePeriodId'], item['id'])), 'modification_time', None)
+            for item in licence_types)
+        latest_modification = None
+        if update_only_latest and missing_watermark:
             try:
                 latest_modification = AthleteInformation.objects.filter(
                     type='licence', modification_time__isnull=False).latest('modification_time').modification_time
             except AthleteInformation.DoesNotExist:
-                latest_modification = None
-        else:
-            latest_modification = None
-        licence_types = self.get_licence_types(datetime.date.today())
+                pass
         for licence_type in licence_types:
-            if licence_type['type'] in self.licence_types:
-                licences = self.get_licences(
-                    licence_type['licencePeriodId'], licence_type['id'], ts=latest_modification)
-                self._update_athletes(licences=licences, print_to_stdout=print_to_stdout, only_year=only_year)
+            key = (licence_type['licencePeriodId'], licence_type['id'])
+            state = states.get(key, None)
+            if state is None:
+                state = LicenceSyncState(licence_period_id=key[0], licence_type_id=key[1])
+            ts = None
+            if update_only_latest:
+                ts = state.modification_time if state.modification_time else latest_modification
+            licences = self.get_licences(licence_type['licencePeriodId'], licence_type['id'], ts=ts)
+            modification_time = self._update_athletes(licences=licences, print_to_stdout=print_to_stdout,
+                                                      only_year=only_year)
+            if modification_time and (not state.modification_time or modification_time > state.modification_time):
+                state.modification_time = modification_time
+            state.save()
 
-    def get_organizations(self, print_to_stdout=False):
+    @staticmethod
+    def _normalize(value):
         """
-        Fetch licences and update athletes
+        Normalize organization name or abbreviation for matching
+
+        :param value: name or abbreviation
+        :type value: str
+        :return: case folded value with single spaces
+        :rtype: str
+        """
+        return ' '.join(value.split()).casefold() if value else ''
+
+    def match_organizations(self, items):
+        """
+        Match Suomisport organizations to Kiti organizations by abbreviation, or by name if abbreviation does not
+        match a single organization.
+
+        Organizations are loaded once and matched in memory.
+
+        :param items: Suomisport organizations
+        :type items: iterable
+        :return: list of (Suomisport organization, list of matching organizations) tuples
+        :rtype: list
+        """
+        abbreviations = {}
+        names = {}
+        for organization in Organization.objects.all():
+            abbreviations.setdefault(self._normalize(organization.abbreviation), []).append(organization)
+            names.setdefault(self._normalize(organization.name), []).append(organization)
+        matches = []
+        for item in items:
+            organizations = []
+            if item.get('shortName', None):
+                organizations = abbreviations.get(self._normalize(item['shortName']), [])
+            if len(organizations) != 1:
+                organizations = names.get(self._normalize(item['name']), []) or organizations
+            matches.append((item, organizations))
+        return matches
+
+    def get_organizations(self, print_to_stdout=False, update_sport_ids=False):
+        """
+        Fetch organizations and match them to Kiti organizations
 
         :param print_to_stdout: print messages to stdout
+        :param update_sport_ids: set Suomisport IDs to the matched organizations
         :type print_to_stdout: bool
+        :type update_sport_ids: bool
+        :return: matched organizations by Suomisport ID
+        :rtype: dict
         """
         url = 'organization/' + self.organization_id + '/list'
-        organizations = self._fetch_from_api(url)
-        for item in organizations:
-            sport_id = item['sportId']
+        matched = {}
+        for item, organizations in self.match_organizations(self._fetch_from_api(url)):
+            sport_id = str(item['sportId'])
             name = item['name']
-            if 'shortName' in item and item['shortName']:
-                abbreviation = item['shortName']
-            else:
-                abbreviation = None
-            organization = Organization.objects.none()
-            if abbreviation:
-                organization = Organization.objects.filter(abbreviation__iexact=abbreviation)
-            if organization.count() != 1:
-                organization = Organization.objects.filter(name__iexact=name)
-            if print_to_stdout:
-                if organization.count() == 1:
-                    stdout.write("%s;%s;%s;%s\n" % ("FOUND", organization[0].abbreviation, sport_id, name))
-                else:
-                    stdout.write("%s;%s;%s;%s\n" % ("NOT FOUND", sport_id, name, abbreviation))
+            abbreviation = item['shortName'] if item.get('shortName', None) else None
+            if len(organizations) == 1:
+                matched[sport_id] = organizations[0]
+                if print_to_stdout:
+                    stdout.write("%s;%s;%s;%s\n" % ("FOUND", organizations[0].abbreviation, sport_id, name))
+            elif print_to_stdout and organizations:
+                stdout.write("%s;%s;%s;%s;%s\n" % ("AMBIGUOUS", sport_id, name, abbreviation, ",".join(
+                    organization.abbreviation for organization in organizations)))
+            elif print_to_stdout:
+                stdout.write("%s;%s;%s;%s\n" % ("NOT FOUND", sport_id, name, abbreviation))
+        if update_sport_ids:
+            self._update_sport_ids(matched, print_to_stdout=print_to_stdout)
+        return matched
+
+    @staticmethod
+    def _update_sport_ids(matched, print_to_stdout=False):
+        """
+        Set Suomisport IDs to the matched organizations with bulk_update
+
+        Organizations matched by multiple Suomisport organizations and IDs used by other organizations are skipped.
 
+        :param matched: matched organizations by Suomisport ID
+        :param print_to_stdout: print messages to stdout
+        :type matched: dict
+        :type print_to_stdout: bool
+        """
+        counts = {}
+        for organization in matched.values():
+            counts[organization.pk] = counts.get(organization.pk, 0) + 1
+        used = dict(Organization.objects.filter(sport_id__in=matched.keys()).values_list('sport_id', 'pk'))
+        organizations = []
+        for sport_id, organization in matched.items():
+            if organization.sport_id == sport_id:
+                continue
+            if counts[organization.pk] > 1 or used.get(sport_id, organization.pk) != organization.pk:
+                if print_to_stdout:
+                    stdout.write("%s;%s;%s\n" % ("CONFLICT", organization.abbreviation, sport_id))
+                continue
+            organization.sport_id = sport_id
+            organizations.append(organization)
+        with transaction.atomic():
+            Organization.objects.bulk_update(organizations, ['sport_id'])
+            Organization.log_changes(organizations)
+            invalidate_response_cache(organizations=[organization.pk for organization in organizations])
+        if print_to_stdout:
+            stdout.write("Updated Suomisport IDs: %d\n" % len(organizations))
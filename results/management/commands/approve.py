@@ -6,17 +6,23 @@ import logging
 from dateutil.relativedelta import relativedelta
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 
 from results.models.competitions import Competition
 from results.models.events import Event
 from results.models.records import Record
 from results.models.results import Result
+from results.utils.change_log import buffered_change_log
+from results.utils.response_cache import invalidate_response_cache
 
 logger = logging.getLogger(__name__)
 
+APPROVE_CHUNK_SIZE = 1000
+
 
 class Command(BaseCommand):
+    bulk = False
     list_only = False
     verbosity = 0
 
@@ -33,6 +39,8 @@ class Command(BaseCommand):
                             help='Lock past competitions which have not been modified during date limit')
         parser.add_argument('-l', action='store_true', dest='list_only',
                             help='List only, do not approve')
+        parser.add_argument('--bulk', action='store_true', dest='bulk',
+                            help='Approve or lock in chunks with bulk updates instead of saving each object')
 
     def output(self, text):
         if self.list_only:
@@ -42,9 +50,48 @@ class Command(BaseCommand):
                 self.stdout.write(text)
             logger.info(text)
 
+    def bulk_update(self, queryset, field, message, related=()):
+        """
+        Sets field to True for objects in the queryset, in chunks of APPROVE_CHUNK_SIZE.
+
+        Each chunk is updated with a single query and change log entries are written in bulk. Save methods and
+        signals are not called.
+
+        :param queryset: objects to update
+        :param field: field name
+        :param message: output message, formatted with the object
+        :param related: related fields to select for the output
+        :type queryset: QuerySet
+        :type field: str
+        :type message: str
+        :type related: tuple
+        :return: updated objects
+        :rtype: list
+        """
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        updated = []
+        for i in range(0, len(ids), APPROVE_CHUNK_SIZE):
+            chunk = queryset.filter(pk__in=ids[i:i + APPROVE_CHUNK_SIZE])
+            instances = list(chunk.select_related(*related))
+            for instance in instances:
+                setattr(instance, field, True)
+                self.output(message % instance)
+            if not self.list_only:
+                with transaction.atomic():
+                    chunk.update(**{field: True, 'updated_at': timezone.now()})
+                    queryset.model.log_changes(instances)
+            updated += instances
+        return updated
+
     def approve_results(self, date_limit):
         """ Approve results which have not been modified during date limits"""
-        for result in Result.objects.filter(updated_at__lt=date_limit, approved=False):
+        results = Result.objects.filter(updated_at__lt=date_limit, approved=False)
+        if self.bulk:
+            results = self.bulk_update(results, 'approved', "Result approved: %s", related=('competition',))
+            if not self.list_only:
+                invalidate_response_cache(competitions={result.competition_id for result in results})
+            return
+        for result in results:
             result.approved = True
             self.output("Result approved: %s" % result)
             if not self.list_only:
@@ -52,7 +99,17 @@ class Command(BaseCommand):
 
     def approve_records(self, date_limit):
         """ Approve records which have not been modified during date limits"""
-        for record in Record.objects.filter(updated_at__lt=date_limit, approved=False):
+        records = Record.objects.filter(updated_at__lt=date_limit, approved=False)
+        if self.bulk:
+            records = self.bulk_update(records, 'approved', "Record approved: %s",
+                                       related=('level', 'type', 'category', 'result'))
+            if not self.list_only and records:
+                invalidate_response_cache(competitions={record.result.competition_id for record in records},
+                                          types={record.type_id for record in records})
+                ended, deleted = Record.end_superseded([record.pk for record in records])
+                self.output("Lower records ended: %d, deleted: %d" % (ended, deleted))
+            return
+        for record in records:
             record.approved = True
             self.output("Record approved: %s" % record)
             if not self.list_only:
@@ -60,9 +117,13 @@ class Command(BaseCommand):
 
     def lock_competitions(self, date_limit):
         """Lock past competitions which have not been modified during date limit"""
-        for competition in Competition.objects.filter(date_start__lte=date_limit,
-                                                      updated_at__lt=date_limit,
-                                                      locked=False):
+        competitions = Competition.objects.filter(date_start__lte=date_limit, updated_at__lt=date_limit, locked=False)
+        if self.bulk:
+            competitions = self.bulk_update(competitions, 'locked', "Competition locked: %s")
+            if not self.list_only:
+                invalidate_response_cache(competitions=[competition.pk for competition in competitions])
+            return
+        for competition in competitions:
             competition.locked = True
             self.output("Competition locked: %s" % competition)
             if not self.list_only:
@@ -70,9 +131,11 @@ class Command(BaseCommand):
 
     def lock_events(self, date_limit):
         """Lock past events which have not been modified during date limit"""
-        for event in Event.objects.filter(date_start__lte=date_limit,
-                                          updated_at__lt=date_limit,
-                                          locked=False):
+        events = Event.objects.filter(date_start__lte=date_limit, updated_at__lt=date_limit, locked=False)
+        if self.bulk:
+            self.bulk_update(events, 'locked', "Event locked: %s")
+            return
+        for event in events:
             event.locked = True
             self.output("Event locked: %s" % event)
             if not self.list_only:
@@ -86,18 +149,20 @@ class Command(BaseCommand):
         lock_events = options['lock_events']
         self.verbosity = options['verbosity']
         self.list_only = options['list_only']
+        self.bulk = options['bulk']
         # Set date range to one year if not given
         if days is None:
             days = 30
         if days >= 0:
             date_limit = timezone.now() - relativedelta(days=days)
-            if approve_results:
-                self.approve_results(date_limit)
-            if approve_records:
-                self.approve_records(date_limit)
-            if lock_competitions:
-                self.lock_competitions(date_limit)
-            if lock_events:
-                self.lock_events(date_limit)
+            with buffered_change_log():
+                if approve_results:
+                    self.approve_results(date_limit)
+                if approve_records:
+                    self.approve_records(date_limit)
+                if lock_competitions:
+                    self.lock_competitions(date_limit)
+                if lock_events:
+                    self.lock_events(date_limit)
         else:
             self.stderr.write("Error: -d must be positive")
\ No newline at end of file
@@ -7,6 +7,7 @@ import datetime
 
 from django.core.management.base import BaseCommand
 from results.models.records import Record
+from results.utils.change_log import buffered_change_log
 
 
 class Command(BaseCommand):
@@ -38,7 +39,8 @@ class Command(BaseCommand):
         else:
             record_list = Record.objects.filter(
                 date_end=None, partial_result=None, approved=False).order_by('date_start', '-result__result')
-        approve_records(record_list)
+        with buffered_change_log():
+            approve_records(record_list)
         if date:
             record_list = Record.objects.filter(
                 date_end=None, approved=False, date_start__lte=date
@@ -46,4 +48,5 @@ class Command(BaseCommand):
         else:
             record_list = Record.objects.filter(
                 date_end=None, approved=False).order_by('date_start', '-partial_result__value')
-        approve_records(record_list)
+        with buffered_change_log():
+            approve_records(record_list)
@@ -1,10 +1,19 @@
 """
 Changes all birth dates to year only
 usage: ./manage.py athletebirthyearonly
+
+Birth dates are updated in chunks of UPDATE_CHUNK_SIZE athletes, with a single update query for each chunk.
 """
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import TruncYear
+
 from results.models.athletes import Athlete
+from results.utils.change_log import buffered_change_log
+from results.utils.response_cache import invalidate_response_cache
+
+UPDATE_CHUNK_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -13,8 +22,19 @@ class Command(BaseCommand):
     help = 'Approve records'
 
     def handle(self, *args, **options):
-        athletes = Athlete.objects.filter(date_of_birth__isnull=False)
-        for athlete in athletes:
-            date_of_birth = athlete.date_of_birth.replace(month=1, day=1)
-            athlete.date_of_birth = date_of_birth
-            athlete.save()
+        athletes = Athlete.objects.filter(date_of_birth__isnull=False).exclude(date_of_birth__month=1,
+                                                                               date_of_birth__day=1)
+        ids = list(athletes.order_by('pk').values_list('pk', flat=True))
+        updated = 0
+        with buffered_change_log():
+            for i in range(0, len(ids), UPDATE_CHUNK_SIZE):
+                chunk = athletes.filter(pk__in=ids[i:i + UPDATE_CHUNK_SIZE])
+                with transaction.atomic():
+                    changed = list(chunk.select_related('organization'))
+                    for athlete in changed:
+                        athlete.date_of_birth = athlete.date_of_birth.replace(month=1, day=1)
+                    updated += chunk.update(date_of_birth=TruncYear('date_of_birth'))
+                    Athlete.log_changes(changed)
+                    invalidate_response_cache(athletes=[athlete.pk for athlete in changed])
+        if options['verbosity'] > 0:
+            self.stdout.write("Updated birth dates: %d" % updated)
@@ -0,0 +1,47 @@
+"""
+Check records for the results in the record check queue
+
+Used when RECORD_CHECK_MODE is set to queue.
+
+usage: ./manage.py checkrecordqueue [-l <batch size>] [-w <seconds>]
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from results.utils.records import run_record_check_queue
+
+
+class Command(BaseCommand):
+    """Check queued records"""
+    args = 'None'
+    help = 'Check records for the results in the record check queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', type=int, action='store', dest='limit', default=500,
+                            help='Number of results checked in a batch.')
+        parser.add_argument('-w', type=int, action='store', dest='wait',
+                            help='Keep running and check the queue again after number of seconds.')
+
+    def process_queue(self, limit, verbosity):
+        """Check queued results batch by batch until the queue is empty"""
+        total = 0
+        checked = run_record_check_queue(limit=limit)
+        while checked:
+            total += checked
+            checked = run_record_check_queue(limit=limit)
+        if verbosity and total:
+            self.stdout.write("Checked records for %d results" % total)
+        return total
+
+    def handle(self, *args, **options):
+        verbosity = options.get('verbosity')
+        limit = options['limit']
+        wait = options['wait']
+        if limit < 1:
+            self.stderr.write("Error: -l must be positive")
+            return
+        self.process_queue(limit, verbosity)
+        while wait:
+            time.sleep(wait)
+            self.process_queue(limit, verbosity)
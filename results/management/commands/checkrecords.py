@@ -1,13 +1,120 @@
 """
 Check all results for records from oldest to newest
 
-usage: ./manage.py checkrecords
+usage: ./manage.py checkrecords [--bulk] [-p <number of processes>]
 """
+import functools
+import logging
+
+from multiprocessing import get_context
 
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Count
 
+from results.models.records import Record
 from results.models.results import Result, ResultPartial
-from results.utils.records import check_records, check_records_partial
+from results.utils.records import RecordIndex, check_records, check_records_partial
+from results.utils.records import get_record_groups, rebuild_record_group
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 1000
+
+
+def _get_results(competition_type=None):
+    """
+    Returns results in the order they are checked.
+
+    :param competition_type: limit to competition type id
+    :type competition_type: int
+    :rtype: QuerySet
+    """
+    results = Result.objects.filter(organization__external=False).select_related(
+        'athlete', 'competition', 'competition__type', 'organization').order_by('competition__date_start', '-result')
+    if competition_type:
+        results = results.filter(competition__type=competition_type)
+    return results
+
+
+def _get_partials(competition_type=None):
+    """
+    Returns partial results in the order they are checked.
+
+    :param competition_type: limit to competition type id
+    :type competition_type: int
+    :rtype: QuerySet
+    """
+    partials = ResultPartial.objects.filter(result__organization__external=False).select_related(
+        'type', 'result', 'result__athlete', 'result__competition', 'result__competition__type',
+        'result__organization').order_by('result__competition__date_start', '-value')
+    if competition_type:
+        partials = partials.filter(result__competition__type=competition_type)
+    return partials
+
+
+def get_partitions():
+    """
+    Returns competition type ids with results or unapproved records, largest first.
+
+    Record progression for different competition types is independent, so each type can be rebuilt separately.
+
+    :return: competition type ids
+    :rtype: list
+    """
+    partitions = [row['competition__type'] for row in Result.objects.values('competition__type').annotate(
+        count=Count('id')).order_by('-count')]
+    for competition_type in Record.objects.filter(approved=False).values_list('type', flat=True).distinct():
+        if competition_type not in partitions:
+            partitions.append(competition_type)
+    return partitions
+
+
+def check_partition(competition_type, bulk=False):
+    """
+    Checks records for a single competition type.
+
+    Used as a worker function in the parallel rebuild.
+
+    :param competition_type: competition type id
+    :param bulk: use set based rebuild
+    :type competition_type: int
+    :type bulk: bool
+    :return: partition summary
+    :rtype: dict
+    """
+    summary = {'type': competition_type, 'results': 0, 'partials': 0, 'groups': 0, 'created': 0, 'deleted': 0}
+    if bulk:
+        groups = get_record_groups(competition_type=competition_type)
+        for key, candidates in groups.items():
+            created, deleted = rebuild_record_group(key, candidates)
+            summary['groups'] += 1
+            summary['created'] += created
+            summary['deleted'] += deleted
+    else:
+        index = RecordIndex(competition_type=competition_type)
+        for result in _get_results(competition_type).iterator():
+            check_records(result, index=index)
+            summary['results'] += 1
+            if not summary['results'] % PROGRESS_INTERVAL:
+                logger.info('Competition type %s: checked %d results', competition_type, summary['results'])
+        for partial in _get_partials(competition_type).iterator():
+            check_records_partial(partial, index=index)
+            summary['partials'] += 1
+            if not summary['partials'] % PROGRESS_INTERVAL:
+                logger.info('Competition type %s: checked %d partial results', competition_type, summary['partials'])
+    logger.info('Competition type %s: finished', competition_type)
+    return summary
+
+
+def _init_worker():
+    """
+    Closes database connections inherited from the parent process, so each worker opens its own connection.
+
+    Workers are forked, so they inherit the configured Django from the parent process. A spawned worker would have
+    to set up Django before importing this module.
+    """
+    connections.close_all()
 
 
 class Command(BaseCommand):
@@ -15,16 +122,81 @@ class Command(BaseCommand):
     args = 'None'
     help = 'Approve records'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--bulk', action='store_true', dest='bulk',
+                            help='Rebuild unapproved records group by group with set based queries.')
+        parser.add_argument('-p', type=int, action='store', dest='processes',
+                            help='Rebuild each competition type separately, using number of worker processes.')
+
+    def bulk_rebuild(self, verbosity):
+        """Rebuild records for each record group"""
+        created = 0
+        deleted = 0
+        groups = get_record_groups()
+        for key, candidates in groups.items():
+            group_created, group_deleted = rebuild_record_group(key, candidates)
+            if verbosity > 1:
+                self.stdout.write("Record group %s: created %d, deleted %d" % (key, group_created, group_deleted))
+            created += group_created
+            deleted += group_deleted
+        if verbosity:
+            self.stdout.write("Created %d and deleted %d records in %d groups" % (created, deleted, len(groups)))
+
+    def output_summary(self, summary, bulk):
+        """Write partition or total summary"""
+        if bulk:
+            self.stdout.write("%s: created %d and deleted %d records in %d groups" % (
+                summary['type'], summary['created'], summary['deleted'], summary['groups']))
+        else:
+            self.stdout.write("%s: checked %d results and %d partial results" % (
+                summary['type'], summary['results'], summary['partials']))
+
+    def parallel_rebuild(self, processes, bulk, verbosity):
+        """Rebuild records for each competition type in worker processes and merge the summaries"""
+        partitions = get_partitions()
+        worker = functools.partial(check_partition, bulk=bulk)
+        total = {'type': 'Total', 'results': 0, 'partials': 0, 'groups': 0, 'created': 0, 'deleted': 0}
+        pool = None
+        if processes > 1:
+            connections.close_all()
+            pool = get_context('fork').Pool(processes, initializer=_init_worker)
+            summaries = pool.imap_unordered(worker, partitions)
+        else:
+            summaries = map(worker, partitions)
+        try:
+            for number, summary in enumerate(summaries, start=1):
+                for key in total:
+                    if key != 'type':
+                        total[key] += summary[key]
+                if verbosity:
+                    self.stdout.write("(%d/%d) Competition type " % (number, len(partitions)), ending='')
+                    self.output_summary(summary, bulk)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if verbosity:
+            self.output_summary(total, bulk)
+        return total
+
     def handle(self, *args, **options):
         verbosity = options.get('verbosity')
-        results = Result.objects.filter(organization__external=False).order_by('competition__date_start', '-result')
-        for result in results:
+        processes = options['processes']
+        if processes is not None:
+            if processes < 1:
+                self.stderr.write("Error: -p must be positive")
+                return
+            self.parallel_rebuild(processes, options['bulk'], verbosity)
+            return
+        if options['bulk']:
+            self.bulk_rebuild(verbosity)
+            return
+        index = RecordIndex()
+        for result in _get_results().iterator():
             if verbosity:
                 print(result)
-            check_records(result)
-        partials = ResultPartial.objects.filter(result__organization__external=False).order_by(
-            'result__competition__date_start', '-value')
-        for partial in partials:
+            check_records(result, index=index)
+        for partial in _get_partials().iterator():
             if verbosity:
                 print(partial)
-            check_records_partial(partial)
+            check_records_partial(partial, index=index)
@@ -1,21 +1,31 @@
 """
 Import athletes from CSV
 
-usage: ./manage.py importathletes -i <file>
+usage: ./manage.py importathletes -i <file> [--dry-run]
 
 <file> is a CSV file with following format:
 sport_id,first_name,last_name,date_of_birth[YYYY-MM-DD],gender[M/W/O/U],organization_id
 
-File may contain athlete multiple times, in different organizations
+File may contain athlete multiple times, in different organizations. First organization is set as athlete's
+organization and others are added to additional organizations.
+
+File is imported in chunks of IMPORT_CHUNK_SIZE rows. Athletes and organizations are loaded once for each chunk and
+changes are saved with bulk_create and bulk_update.
 """
 import csv
 
 from datetime import datetime
+from itertools import islice
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from results.models.athletes import Athlete
 from results.models.organizations import Organization
+from results.utils.change_log import buffered_change_log
+from results.utils.response_cache import invalidate_response_cache
+
+IMPORT_CHUNK_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -23,83 +33,175 @@ class Command(BaseCommand):
     args = 'None'
     help = 'Approve records'
 
+    dry_run = False
+    verbosity = 0
+
     def add_arguments(self, parser):
         parser.add_argument('-i', type=str, action='store',
                             dest='input', help='Import file')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='List changes, do not save')
+
+    def _output(self, text):
+        self.stdout.write(("(Dry run) " if self.dry_run else "") + text)
+
+    def _get_organization(self, organization_id):
+        """
+        Returns organization from the organizations loaded for the import, or None if organization is not found.
+        """
+        try:
+            return self.organizations.get(int(organization_id), None)
+        except ValueError:
+            return None
+
+    def _load_organizations(self, rows):
+        """
+        Loads organizations for the rows with a single query, skipping already loaded organizations.
+        """
+        organization_ids = set()
+        for row in rows:
+            try:
+                organization_ids.add(int(row[5]))
+            except ValueError:
+                pass
+        organization_ids -= set(self.organizations)
+        if organization_ids:
+            self.organizations.update(Organization.objects.in_bulk(organization_ids))
+
+    def _load_athletes(self, rows):
+        """
+        Loads athletes and their additional organizations for the rows.
 
-    def _create_athlete(self, row, date_of_birth, organization):
-        athlete = Athlete.objects.create(sport_id=row[0],
-                                         first_name=row[2],
-                                         last_name=row[1],
-                                         date_of_birth=date_of_birth,
-                                         gender=row[4],
-                                         organization=organization)
-        if self.verbosity > 0:
-            print("Created athlete: %s, %s %s" % (athlete.sport_id, athlete.first_name, athlete.last_name))
-        self.athletes.add(row[0])
-
-    def _update_athlete(self, row, athlete, date_of_birth, organization):
-        if athlete.first_name != row[2]:
+        In dry run, athletes created or changed in previous chunks are used instead of the database values.
+
+        :return: athletes by sport_id and set of (sport_id, organization id) tuples for additional organizations
+        :rtype: tuple
+        """
+        sport_ids = {row[0] for row in rows}
+        athletes = {athlete.sport_id: athlete for athlete in Athlete.objects.filter(
+            sport_id__in=sport_ids).select_related('organization')}
+        additional = set(Athlete.additional_organizations.through.objects.filter(
+            athlete__sport_id__in=sport_ids).values_list('athlete__sport_id', 'organization_id'))
+        if self.dry_run:
+            athletes.update({sport_id: self.dry_run_athletes[sport_id] for sport_id in sport_ids if
+                             sport_id in self.dry_run_athletes})
+            additional |= self.dry_run_additional
+        return athletes, additional
+
+    def _report_changes(self, athlete):
+        """
+        Outputs changed fields for the athlete.
+        """
+        for field, (initial, value) in athlete.diff.items():
+            self._output("Update %s for athlete: %s, %s %s (%s -> %s)" % (
+                field, athlete.sport_id, athlete.first_name, athlete.last_name, initial, value))
+
+    def _import_chunk(self, rows):
+        """
+        Imports a chunk of rows.
+
+        :param rows: CSV rows
+        :type rows: list
+        """
+        self._load_organizations(rows)
+        athletes, additional = self._load_athletes(rows)
+        created = {}
+        modified = {}
+        additions = []
+        for row in rows:
+            organization = self._get_organization(row[5])
+            date_of_birth = datetime.strptime(row[3], '%Y-%m-%d').date()
+            if not organization:
+                if self.verbosity > 0:
+                    self._output("Could not parse organization %s" % row[5])
+                continue
+            sport_id = row[0]
+            athlete = athletes.get(sport_id, None)
+            if athlete is None:
+                athlete = Athlete(sport_id=sport_id, first_name=row[2], last_name=row[1], date_of_birth=date_of_birth,
+                                  gender=row[4], organization=organization)
+                athletes[sport_id] = created[sport_id] = athlete
+                self.imported.add(sport_id)
+                continue
             athlete.first_name = row[2]
-            if self.verbosity > 1:
-                print("Update first name for athlete: %s, %s %s" % (
-                    athlete.sport_id, athlete.first_name, athlete.last_name))
-        if athlete.last_name != row[1]:
             athlete.last_name = row[1]
-            if self.verbosity > 1:
-                print("Update last name for athlete: %s, %s %s" % (
-                    athlete.sport_id, athlete.first_name, athlete.last_name))
-        if athlete.date_of_birth != date_of_birth:
             athlete.date_of_birth = date_of_birth
-            if self.verbosity > 1:
-                print("Update date of birth for athlete: %s, %s %s" % (
-                    athlete.sport_id, athlete.first_name, athlete.last_name))
-        if athlete.gender != row[4]:
             athlete.gender = row[4]
-            if self.verbosity > 1:
-                print("Update gender for athlete: %s, %s %s" % (
-                    athlete.sport_id, athlete.first_name, athlete.last_name))
-        athlete.date_of_birth = date_of_birth
-        athlete.gender = row[4]
-        if row[0] not in self.athletes:
-            self.athletes.add(row[0])
-            if athlete.organization != organization:
+            if sport_id not in self.imported:
+                self.imported.add(sport_id)
                 athlete.organization = organization
-                if self.verbosity > 1:
-                    print("Update organization for athlete: %s, %s %s" % (
-                        athlete.sport_id, athlete.first_name, athlete.last_name))
-        else:
-            if (organization != athlete.organization and
-                    organization not in athlete.additional_organizations.all()):
-                athlete.additional_organizations.add(organization)
-                if self.verbosity > 1:
-                    print("Added additional organization for athlete: %s, %s %s" % (
-                        athlete.sport_id, athlete.first_name, athlete.last_name))
-        athlete.save()
-
-    def _parse_row(self, row):
-        try:
-            athlete = Athlete.objects.get(sport_id=row[0])
-        except Athlete.DoesNotExist:
-            athlete = None
-        try:
-            organization = Organization.objects.get(id=row[5])
-        except (Organization.DoesNotExist, ValueError):
-            organization = None
-        date_of_birth = datetime.strptime(row[3], '%Y-%m-%d').date()
-        if not athlete and organization:
-            self._create_athlete(row, date_of_birth, organization)
-        elif organization:
-            self._update_athlete(row, athlete, date_of_birth, organization)
-        else:
-            if self.verbosity > 0:
-                print("Could not parse organization %s" % row[5])
+            elif organization != athlete.organization and (sport_id, organization.pk) not in additional:
+                additional.add((sport_id, organization.pk))
+                additions.append((athlete, organization))
+            if sport_id not in created and athlete.changed_fields:
+                modified[sport_id] = athlete
+        self.created += len(created)
+        self.modified.update(modified)
+        self.additional += len(additions)
+        if self.verbosity > 0 or self.dry_run:
+            for athlete in created.values():
+                self._output("Created athlete: %s, %s %s" % (athlete.sport_id, athlete.first_name,
+                                                              athlete.last_name))
+        if self.verbosity > 1 or self.dry_run:
+            for athlete in modified.values():
+                self._report_changes(athlete)
+            for athlete, organization in additions:
+                self._output("Added additional organization for athlete: %s, %s %s (%s)" % (
+                    athlete.sport_id, athlete.first_name, athlete.last_name, organization))
+        if self.dry_run:
+            self.dry_run_athletes.update(created)
+            self.dry_run_athletes.update(modified)
+            self.dry_run_additional |= additional
+            return
+        with transaction.atomic():
+            self._save_chunk(list(created.values()), list(modified.values()), additions)
+
+    @staticmethod
+    def _save_chunk(created, modified, additions):
+        """
+        Saves created and modified athletes and additional organizations for a chunk.
+
+        :param created: new athletes
+        :param modified: changed athletes
+        :param additions: list of (athlete, organization) tuples
+        :type created: list
+        :type modified: list
+        :type additions: list
+        """
+        if created:
+            Athlete.objects.bulk_create(created)
+            if any(athlete.pk is None for athlete in created):
+                ids = dict(Athlete.objects.filter(sport_id__in=[athlete.sport_id for athlete in created]).values_list(
+                    'sport_id', 'pk'))
+                for athlete in created:
+                    athlete.pk = ids[athlete.sport_id]
+            Athlete.log_additions(created)
+        if modified:
+            Athlete.objects.bulk_update(modified, ['first_name', 'last_name', 'date_of_birth', 'gender',
+                                                   'organization'])
+            Athlete.log_changes(modified)
+            invalidate_response_cache(athletes=[athlete.pk for athlete in modified])
+        Athlete.additional_organizations.through.objects.bulk_create([
+            Athlete.additional_organizations.through(athlete_id=athlete.pk, organization_id=organization.pk)
+            for athlete, organization in additions])
 
     def handle(self, *args, **options):
         input_file = options['input']
         self.verbosity = options['verbosity']
-        self.athletes = set()
-        with open(input_file) as csv_file:
+        self.dry_run = options['dry_run']
+        self.imported = set()
+        self.organizations = {}
+        self.dry_run_athletes = {}
+        self.dry_run_additional = set()
+        self.created = self.additional = 0
+        self.modified = set()
+        with open(input_file) as csv_file, buffered_change_log():
             csv_reader = csv.reader(filter(lambda row: row[0] != '#', csv_file))
-            for row in csv_reader:
-                self._parse_row(row)
+            while True:
+                rows = list(islice(csv_reader, IMPORT_CHUNK_SIZE))
+                if not rows:
+                    break
+                self._import_chunk(rows)
+        if self.verbosity > 0 or self.dry_run:
+            self._output("Athletes created: %d, updated: %d, additional organizations: %d" % (
+                self.created, len(self.modified), self.additional))
@@ -0,0 +1,27 @@
+"""
+Rebuild season result ranks used in grouped result lists
+
+Ranks are updated when results are changed, if SEASON_RESULT_RANKS is set. Rebuild is needed when the setting is
+enabled or organizations are changed to external.
+
+usage: ./manage.py rebuildseasonranks [-s <season>]
+"""
+from django.core.management.base import BaseCommand
+
+from results.utils.season_ranks import rebuild_season_ranks
+
+
+class Command(BaseCommand):
+    """Rebuild season result ranks"""
+    args = 'None'
+    help = 'Rebuild season result ranks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', type=int, action='store', dest='season',
+                            help='Rebuild only the season.')
+
+    def handle(self, *args, **options):
+        verbosity = options.get('verbosity')
+        count = rebuild_season_ranks(season=options['season'])
+        if verbosity:
+            self.stdout.write("Ranked %d results" % count)
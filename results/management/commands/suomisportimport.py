@@ -6,6 +6,7 @@ usage: ./manage.py suomisportimport
 
 from django.core.management.base import BaseCommand
 from results.connectors.suomisport import Suomisport
+from results.utils.change_log import buffered_change_log
 
 from sys import stderr
 
@@ -32,7 +33,9 @@ class Command(BaseCommand):
         only_year = options['only_year']
         try:
             suomisport = Suomisport()
-            suomisport.update_licences(update_only_latest=update_only_latest, print_to_stdout=True, only_year=only_year)
+            with buffered_change_log():
+                suomisport.update_licences(update_only_latest=update_only_latest, print_to_stdout=True,
+                                           only_year=only_year)
         except Exception as e:
             stderr.write('Cloud not update licences. Most likely API credentials are incorrect.\n')
             stderr.write('Error: %s\n' % e)
@@ -1,7 +1,7 @@
 """
 Get organizations from Suomisport
 
-usage: ./manage.py suomisportorganizations
+usage: ./manage.py suomisportorganizations [--update]
 """
 
 from django.core.management.base import BaseCommand
@@ -15,10 +15,17 @@ class Command(BaseCommand):
     args = 'None'
     help = 'Get organizations from Suomisport'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--update',
+                            action='store_true',
+                            default=False,
+                            dest='update_sport_ids',
+                            help='Set Suomisport IDs to the matched organizations.')
+
     def handle(self, *args, **options):
         try:
             suomisport = Suomisport()
-            suomisport.get_organizations(print_to_stdout=True)
+            suomisport.get_organizations(print_to_stdout=True, update_sport_ids=options['update_sport_ids'])
         except Exception as e:
             stderr.write('Cloud not get organizations. Most likely API credentials are incorrect.\n')
             stderr.write('Error: %s\n' % e)
@@ -0,0 +1,14 @@
+from results.utils.change_log import buffered_change_log
+
+
+class ChangeLogBufferMiddleware(object):
+    """ Middleware for buffering change log entries.
+
+    Log entries are written in bulk at the end of the request, if CHANGE_LOG_MODE is not immediate.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with buffered_change_log():
+            return self.get_response(request)
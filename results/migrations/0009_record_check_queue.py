@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0008_add_timestamps'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordCheckQueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queued_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Queued at')),
+                ('result', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='record_check_queue', to='results.Result')),
+            ],
+            options={
+                'verbose_name': 'Record check queue',
+                'verbose_name_plural': 'Record check queue',
+                'ordering': ['queued_at'],
+            },
+        ),
+    ]
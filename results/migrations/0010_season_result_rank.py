@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0009_record_check_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeasonResultRank',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('season', models.SmallIntegerField(verbose_name='Season')),
+                ('value', models.DecimalField(decimal_places=2, max_digits=11, verbose_name='Result')),
+                ('rank', models.SmallIntegerField(verbose_name='Rank')),
+                ('athlete', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='results.Athlete')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='results.Category')),
+                ('result', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='season_rank', to='results.Result')),
+                ('type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='results.CompetitionType')),
+            ],
+            options={
+                'verbose_name': 'Season result rank',
+                'verbose_name_plural': 'Season result ranks',
+                'ordering': ['season', 'type', 'category', 'athlete', 'rank'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='seasonresultrank',
+            index=models.Index(fields=['season', 'type', 'category', 'rank'], name='results_sea_season_c6b54d_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0010_season_result_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LicenceSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('licence_period_id', models.IntegerField(verbose_name='Licence period ID')),
+                ('licence_type_id', models.IntegerField(verbose_name='Licence type ID')),
+                ('modification_time', models.DateTimeField(blank=True, null=True, verbose_name='Suomisport update timestamp')),
+                ('synced_at', models.DateTimeField(auto_now=True, verbose_name='Synced at')),
+            ],
+            options={
+                'verbose_name': 'Licence sync state',
+                'verbose_name_plural': 'Licence sync states',
+                'ordering': ['licence_period_id', 'licence_type_id'],
+                'unique_together': {('licence_period_id', 'licence_type_id')},
+            },
+        ),
+    ]
@@ -1,9 +1,22 @@
+import json
+
 from django.conf import settings
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE, DELETION
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import DEFERRED
 from django.forms.models import model_to_dict
 
 from results.middleware.current_user import get_current_user
+from results.utils.change_log import add_log_entries
+
+
+def _get_log_user_id():
+    """
+    :return: current user's id, or DEFAULT_LOG_USER_ID if there is no current user or user is anonymous
+    :rtype: int
+    """
+    user = get_current_user()
+    return user.id if user and user.id else settings.DEFAULT_LOG_USER_ID
 
 
 class LogChangesMixing(object):
@@ -11,10 +24,19 @@ class LogChangesMixing(object):
 
     Logs add, delete and modified fields for all models using a mixin
     and values for the fields defined in the LOG_VALUE_FIELDS setting.
+
+    Log entries are written with :func:`results.utils.change_log.add_log_entries`, buffered and written in bulk if
+    CHANGE_LOG_MODE is not immediate.
+
+    Initial values are stored as a tuple of raw field values. Instances loaded from the database are initialized
+    with the field values as positional arguments, which are used as is, so loading instances has no extra cost.
     """
     def __init__(self, *args, **kwargs):
         super(LogChangesMixing, self).__init__(*args, **kwargs)
-        self.__initial = self._dict
+        if args and not kwargs and len(args) == len(self._meta.concrete_fields):
+            self.__initial = args
+        else:
+            self.__initial = tuple(self.__dict__.get(field.attname, DEFERRED) for field in self._meta.concrete_fields)
 
     @property
     def changed_fields(self):
@@ -33,10 +55,14 @@ class LogChangesMixing(object):
         :return: changed data
         :rtype: dict
         """
-        d1 = self.__initial
-        d2 = self._dict
-        diffs = [(k, (v, d2[k])) for k, v in d1.items() if v != d2[k]]
-        return dict(diffs)
+        diffs = {}
+        for field, initial in zip(self._meta.concrete_fields, self.__initial):
+            if initial is DEFERRED or not field.editable:
+                continue
+            value = getattr(self, field.attname)
+            if initial != value:
+                diffs[field.name] = (initial, value)
+        return diffs
 
     @property
     def _dict(self):
@@ -46,21 +72,28 @@ class LogChangesMixing(object):
         """
         return model_to_dict(self, fields=[field.name for field in self._meta.fields])
 
+    def _get_log_entry(self, user_id, action_flag, change_message, object_id=None):
+        """
+        :return: unsaved log entry for the instance
+        :rtype: LogEntry
+        """
+        return LogEntry(
+            user_id=user_id,
+            content_type_id=ContentType.objects.get_for_model(self).pk,
+            object_id=str(self.pk if object_id is None else object_id),
+            object_repr=str(self)[:200],
+            action_flag=action_flag,
+            change_message=json.dumps(change_message) if isinstance(change_message, list) else change_message
+        )
+
     def delete(self, *args, **kwargs):
         """
         Save log entry for data deletion
         """
         object_id = self.pk
-        user_id = get_current_user().id if get_current_user() else settings.DEFAULT_LOG_USER_ID
+        user_id = _get_log_user_id()
         super(LogChangesMixing, self).delete(*args, **kwargs)
-        LogEntry.objects.log_action(
-            user_id=user_id,
-            content_type_id=ContentType.objects.get_for_model(self).pk,
-            object_id=object_id,
-            object_repr=str(self),
-            action_flag=DELETION,
-            change_message="Deleted"
-        )
+        add_log_entries([self._get_log_entry(user_id, DELETION, "Deleted", object_id=object_id)])
 
     def _add_message(self):
         """
@@ -71,9 +104,10 @@ class LogChangesMixing(object):
         """
         add_message = []
         if type(self).__name__ in settings.LOG_VALUE_FIELDS:
+            data = self._dict
             for field in settings.LOG_VALUE_FIELDS[type(self).__name__]:
-                if field in self._dict:
-                    add_message.append(field + ": " + str(self._dict[field]))
+                if field in data:
+                    add_message.append(field + ": " + str(data[field]))
         return add_message
 
     def _change_message(self):
@@ -84,10 +118,11 @@ class LogChangesMixing(object):
         :rtype: list
         """
         change_message = []
-        for field in self.changed_fields:
+        diff = self.diff
+        for field in diff:
             if (type(self).__name__ in settings.LOG_VALUE_FIELDS and
                     field in settings.LOG_VALUE_FIELDS[type(self).__name__]):
-                change_message.append(field + ": " + str(self.diff[field][1]))
+                change_message.append(field + ": " + str(diff[field][1]))
             else:
                 change_message.append(field)
         return change_message
@@ -98,21 +133,69 @@ class LogChangesMixing(object):
         """
 
         action_flag = CHANGE if self.pk else ADDITION
-        user_id = get_current_user().id if get_current_user() else settings.DEFAULT_LOG_USER_ID
+        user_id = _get_log_user_id()
         super(LogChangesMixing, self).save(*args, **kwargs)
         change_message = []
         if action_flag == ADDITION:
             change_message.append({'added': {}})
             change_message.append({'changed': {'fields': self._add_message()}})
         else:
-            if self.changed_fields:
-                change_message.append({'changed': {'fields': self._change_message()}})
+            changed = self._change_message()
+            if changed:
+                change_message.append({'changed': {'fields': changed}})
         if change_message:
-            LogEntry.objects.log_action(
-                user_id=user_id,
-                content_type_id=ContentType.objects.get_for_model(self).pk,
-                object_id=self.pk,
-                object_repr=str(self),
-                action_flag=action_flag,
-                change_message=change_message
-            )
+            add_log_entries([self._get_log_entry(user_id, action_flag, change_message)])
+
+    @classmethod
+    def _bulk_log_action(cls, entries, action_flag):
+        """
+        Create log entries in a single query
+
+        :param entries: list of (object, change message) tuples
+        :param action_flag: ADDITION, CHANGE or DELETION
+        :type entries: list
+        :type action_flag: int
+        """
+        user_id = _get_log_user_id()
+        add_log_entries([instance._get_log_entry(user_id, action_flag, change_message)
+                         for instance, change_message in entries])
+
+    @classmethod
+    def log_additions(cls, instances):
+        """
+        Create log entries for objects added without save, i.e. with bulk_create
+
+        :param instances: added objects
+        :type instances: list
+        """
+        cls._bulk_log_action([(instance, [{'added': {}}, {'changed': {'fields': instance._add_message()}}])
+                              for instance in instances], ADDITION)
+
+    @classmethod
+    def log_changes(cls, instances):
+        """
+        Create log entries for objects changed without save, i.e. with bulk_update
+
+        Changes are compared to the values at initialization, so instances must not be reloaded before logging.
+
+        :param instances: changed objects
+        :type instances: list
+        """
+        entries = []
+        for instance in instances:
+            change_message = instance._change_message()
+            if change_message:
+                entries.append((instance, [{'changed': {'fields': change_message}}]))
+        cls._bulk_log_action(entries, CHANGE)
+
+    @classmethod
+    def log_deletions(cls, instances):
+        """
+        Create log entries for objects deleted without delete, i.e. with a queryset delete
+
+        Instances must be loaded before the deletion, so they still have their primary keys.
+
+        :param instances: deleted objects
+        :type instances: list
+        """
+        cls._bulk_log_action([(instance, "Deleted") for instance in instances], DELETION)
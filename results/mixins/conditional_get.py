@@ -0,0 +1,68 @@
+from hashlib import md5
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+from django.utils.translation import get_language
+
+from results.utils.response_cache import get_request_scopes, get_response_versions
+
+
+class ConditionalGetMixin:
+    """
+    Mixin to support conditional requests in list and retrieve.
+
+    ETag is calculated from the response cache versions, which are renewed when results, partial results, records,
+    competitions, athletes or organizations are changed, so changes to the nested data change the ETag too. Query
+    parameters in _RESPONSE_CACHE_SCOPES limit the versions to the requested competitions, competition types and
+    sports. A not modified response is returned without database queries.
+
+    Versions are kept only if the response cache is enabled, so conditional requests are not supported if
+    RESPONSE_CACHE_TIMEOUT is 0.
+
+    Response content depends on the user, so the user is included in the ETag and the response varies by
+    Authorization and Cookie headers.
+    """
+    _RESPONSE_CACHE_SCOPES = {}
+
+    def get_etag(self, request):
+        """
+        Returns ETag for the request.
+
+        :param request: request
+        :type request: Request
+        :return: ETag or None if conditional requests are not supported
+        :rtype: str
+        """
+        if not settings.RESPONSE_CACHE_TIMEOUT:
+            return None
+        try:
+            scopes = get_request_scopes(request, self._RESPONSE_CACHE_SCOPES)
+        except ValueError:
+            return None
+        params = sorted((key, value) for key in request.query_params for value in request.query_params.getlist(key))
+        key = '%s|%s|%s|%s|%s|%s' % (request.path, params, get_language(), request.accepted_renderer.format,
+                                     request.user.pk, get_response_versions(scopes))
+        return quote_etag(md5(key.encode('utf-8')).hexdigest())
+
+    def get_conditional_response(self, request, get_response, *args, **kwargs):
+        """
+        Returns not modified response if request's conditions match, otherwise response from get_response. Adds
+        ETag and Vary headers to the response.
+        """
+        etag = self.get_etag(request)
+        if etag is None:
+            return get_response(request, *args, **kwargs)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = get_response(request, *args, **kwargs)
+        if response.status_code in [200, 304]:
+            response['ETag'] = etag
+            patch_vary_headers(response, ['Authorization', 'Cookie'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_conditional_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_conditional_response(request, super().retrieve, *args, **kwargs)
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from rest_framework.response import Response
+
+from results.utils.response_cache import get_request_scopes, get_response_cache_key
+
+
+class ResponseCacheMixin:
+    """
+    Mixin to cache list responses for anonymous users.
+
+    Cached responses are invalidated when results, partial results, records, competitions, athletes or
+    organizations are changed. Query parameters in _RESPONSE_CACHE_SCOPES limit the invalidation to the changed
+    competitions, competition types and sports.
+    """
+    _RESPONSE_CACHE_SCOPES = {}
+    _RESPONSE_CACHE_HEADERS = ['ETag', 'Vary']
+
+    def get_response_cache_key(self, request):
+        """
+        Returns cache key for the response, or None if the response is not cached.
+
+        :param request: request
+        :type request: Request
+        :rtype: str
+        """
+        if not settings.RESPONSE_CACHE_TIMEOUT or request.user.is_authenticated:
+            return None
+        try:
+            scopes = get_request_scopes(request, self._RESPONSE_CACHE_SCOPES)
+        except ValueError:
+            return None
+        return get_response_cache_key(type(self).__name__, request, scopes)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Returns cached list response if available. Conditional requests are answered with the cached ETag.
+        """
+        key = self.get_response_cache_key(request)
+        if key:
+            cached = cache.get(key)
+            if cached is not None:
+                data, headers = cached
+                response = get_conditional_response(request, etag=headers.get('ETag')) or Response(data)
+                for header, value in headers.items():
+                    response[header] = value
+                return response
+        response = super().list(request, *args, **kwargs)
+        if key and response.status_code == 200:
+            headers = {header: response[header] for header in self._RESPONSE_CACHE_HEADERS if header in response}
+            cache.set(key, (response.data, headers), settings.RESPONSE_CACHE_TIMEOUT)
+        return response
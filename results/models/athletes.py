@@ -111,3 +111,24 @@ class AthleteInformation(LogChangesMixing, models.Model):
     @allow_staff_or_superuser
     def has_create_permission(request):
         return False
+
+
+class LicenceSyncState(models.Model):
+    """Stores the Suomisport licence sync watermark for a licence period and licence type.
+
+    Watermark is the latest licence modification time applied from the licence type. It is advanced only after all
+    licences fetched for the type have been applied, so an interrupted sync is resumed from the last completed type.
+    """
+    licence_period_id = models.IntegerField(verbose_name=_('Licence period ID'))
+    licence_type_id = models.IntegerField(verbose_name=_('Licence type ID'))
+    modification_time = models.DateTimeField(null=True, blank=True, verbose_name=_('Suomisport update timestamp'))
+    synced_at = models.DateTimeField(auto_now=True, verbose_name=_('Synced at'))
+
+    def __str__(self):
+        return '%s/%s: %s' % (self.licence_period_id, self.licence_type_id, self.modification_time)
+
+    class Meta:
+        ordering = ['licence_period_id', 'licence_type_id']
+        verbose_name = _('Licence sync state')
+        verbose_name_plural = _('Licence sync states')
+        unique_together = ('licence_period_id', 'licence_type_id')
@@ -276,3 +276,15 @@ class Competition(LogChangesMixing, models.Model):
                     not self.locked and not self.event.locked)):
             return True
         return False
+
+    @staticmethod
+    @authenticated_users
+    def has_results_bulk_permission(request):
+        return True
+
+    @authenticated_users
+    def has_object_results_bulk_permission(self, request):
+        if ((request.user.is_staff or request.user.is_superuser) or
+                (self.organization.group in request.user.groups.all() and not self.locked)):
+            return True
+        return False
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from dry_rest_permissions.generics import allow_staff_or_superuser
 
@@ -7,6 +8,7 @@ from results.models.categories import Category
 from results.models.competitions import CompetitionLevel, CompetitionType
 from results.models.organizations import Area
 from results.models.results import Result, ResultPartial
+from results.utils.response_cache import invalidate_response_cache
 
 
 class RecordLevel(LogChangesMixing, models.Model):
@@ -91,23 +93,74 @@ class Record(LogChangesMixing, models.Model):
 
     def save(self, *args, **kwargs):
         """
-        When saved, end approved and delete unapproved lower records.
+        When approved, end approved and delete unapproved lower records.
         """
         super().save(*args, **kwargs)
         if self.approved and "approved" in self.changed_fields:
-            if self.partial_result:
-                records = Record.objects.filter(level=self.level, type=self.type, date_end=None, category=self.category,
-                                                partial_result__type=self.partial_result.type,
-                                                partial_result__value__lt=self.partial_result.value)
+            Record.end_superseded([self.pk])
+
+    @classmethod
+    def end_superseded(cls, record_ids):
+        """
+        Ends approved and deletes unapproved standing records with a lower value than the approved records.
+
+        Called when a record is approved and used for the bulk approval. Lower records are loaded with a single query
+        for each record group. Approved lower records are ended at the start date of the first approved record
+        beating them, with a single update for each end date, and unapproved lower records are deleted with a single
+        query. Change log entries are written in bulk.
+
+        :param record_ids: approved record ids
+        :type record_ids: iterable
+        :return: number of ended and deleted records
+        :rtype: tuple
+        """
+        groups = {}
+        for row in cls.objects.filter(pk__in=record_ids, approved=True).values(
+                'level_id', 'type_id', 'category_id', 'partial_result_id', 'partial_result__type_id',
+                'partial_result__value', 'result__result', 'date_start'):
+            value = row['partial_result__value'] if row['partial_result_id'] else row['result__result']
+            if value is not None:
+                key = (row['level_id'], row['type_id'], row['category_id'], row['partial_result__type_id'])
+                groups.setdefault(key, []).append((value, row['date_start']))
+        date_ends = {}
+        deleted = set()
+        for (level_id, type_id, category_id, partial_type_id), approved in groups.items():
+            records = cls.objects.filter(level_id=level_id, type_id=type_id, category_id=category_id, date_end=None)
+            if partial_type_id:
+                records = records.filter(partial_result__type_id=partial_type_id)
+                field = 'partial_result__value'
             else:
-                records = Record.objects.filter(level=self.level, type=self.type, date_end=None, category=self.category,
-                                                partial_result=None, result__result__lt=self.result.result)
-            for record in records:
-                if record.approved:
-                    record.date_end = self.date_start
-                    record.save()
+                records = records.filter(partial_result=None)
+                field = 'result__result'
+            max_value = max(value for value, date_start in approved)
+            for record_id, record_approved, value in records.filter(**{field + '__lt': max_value}).values_list(
+                    'id', 'approved', field):
+                if record_approved:
+                    date_ends[record_id] = min(date_start for approved_value, date_start in approved
+                                               if approved_value > value)
                 else:
-                    record.delete()
+                    deleted.add(record_id)
+        if not date_ends and not deleted:
+            return 0, 0
+        with transaction.atomic():
+            ended = list(cls.objects.filter(pk__in=date_ends).select_related('level', 'type', 'category'))
+            by_date = {}
+            for record in ended:
+                record.date_end = date_ends[record.pk]
+                by_date.setdefault(record.date_end, []).append(record.pk)
+            updated_at = timezone.now()
+            for date_end, ids in by_date.items():
+                cls.objects.filter(pk__in=ids).update(date_end=date_end, updated_at=updated_at)
+            cls.log_changes(ended)
+            removed = list(cls.objects.filter(pk__in=deleted).select_related('level', 'type', 'category'))
+            cls.objects.filter(pk__in=deleted).delete()
+            cls.log_deletions(removed)
+        if ended:
+            invalidate_response_cache(
+                competitions=Result.objects.filter(pk__in={record.result_id for record in ended}).values_list(
+                    'competition', flat=True),
+                types={record.type_id for record in ended})
+        return len(ended), len(removed)
 
     class Meta:
         ordering = ['type', 'result']
@@ -138,3 +191,23 @@ class Record(LogChangesMixing, models.Model):
     @allow_staff_or_superuser
     def has_create_permission(request):
         return False
+
+
+class RecordCheckQueue(models.Model):
+    """Stores a result waiting for the deferred record check.
+
+    Related to
+     - :class:`.results.Result`
+
+    Used when RECORD_CHECK_MODE is set to queue.
+    """
+    result = models.OneToOneField(Result, related_name='record_check_queue', on_delete=models.CASCADE)
+    queued_at = models.DateTimeField(default=timezone.now, verbose_name=_('Queued at'))
+
+    def __str__(self):
+        return '%s' % self.result
+
+    class Meta:
+        ordering = ['queued_at']
+        verbose_name = _('Record check queue')
+        verbose_name_plural = _('Record check queue')
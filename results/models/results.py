@@ -5,7 +5,7 @@ from dry_rest_permissions.generics import authenticated_users
 from results.mixins.change_log import LogChangesMixing
 from results.models.athletes import Athlete
 from results.models.categories import Category
-from results.models.competitions import Competition, CompetitionResultType
+from results.models.competitions import Competition, CompetitionResultType, CompetitionType
 from results.models.organizations import Organization
 
 
@@ -44,9 +44,18 @@ class Result(LogChangesMixing, models.Model):
         return '%s %s %s' % (self.competition, self.last_name, self.first_name)
 
     def save(self, *args, **kwargs):
+        """
+        Set default values before saving.
+        """
+        self.set_defaults()
+        super().save(*args, **kwargs)
+
+    def set_defaults(self):
         """
         Add result names from the athlete if not included.
         Set position_pre as position if not included and vice versa.
+
+        Called in save and before bulk creating results.
         """
         if self.athlete:
             if not self.first_name:
@@ -57,7 +66,6 @@ class Result(LogChangesMixing, models.Model):
             self.position_pre = self.position
         elif not self.position and self.position_pre:
             self.position = self.position_pre
-        super().save(*args, **kwargs)
 
     class Meta:
         ordering = ['competition', 'category', 'position', '-result']
@@ -149,3 +157,34 @@ class ResultPartial(LogChangesMixing, models.Model):
                  not (self.result.competition.locked or self.result.approved))):
             return True
         return False
+
+
+class SeasonResultRank(models.Model):
+    """Stores athlete's result rank in a season, competition type and category.
+
+    Summary table for the best results by athlete, used in grouped result lists if SEASON_RESULT_RANKS is set.
+
+    Related to
+     - :class:`.athletes.Athlete`
+     - :class:`.categories.Category`
+     - :class:`.competitions.CompetitionType`
+     - :class:`.results.Result`
+    """
+    season = models.SmallIntegerField(verbose_name=_('Season'))
+    type = models.ForeignKey(CompetitionType, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    athlete = models.ForeignKey(Athlete, on_delete=models.CASCADE)
+    result = models.OneToOneField(Result, related_name='season_rank', on_delete=models.CASCADE)
+    value = models.DecimalField(verbose_name=_('Result'), max_digits=11, decimal_places=2)
+    rank = models.SmallIntegerField(verbose_name=_('Rank'))
+
+    def __str__(self):
+        return '%s %s %s: %s' % (self.season, self.category, self.athlete, self.rank)
+
+    class Meta:
+        ordering = ['season', 'type', 'category', 'athlete', 'rank']
+        verbose_name = _('Season result rank')
+        verbose_name_plural = _('Season result ranks')
+        indexes = [
+            models.Index(fields=['season', 'type', 'category', 'rank']),
+        ]
@@ -1,14 +1,42 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from drf_queryfields import QueryFieldsMixin
 from dry_rest_permissions.generics import DRYPermissionsField
 from rest_framework import serializers
 
-from results.models.categories import CategoryForCompetitionType
+from results.models.athletes import Athlete
+from results.models.records import Record
 from results.models.results import Result, ResultPartial
 from results.serializers.athletes import AthleteLimitedSerializer, AthleteNameSerializer
 from results.serializers.competitions import CompetitionLimitedSerializer, CompetitionResultTypeLimitedSerializer
 from results.serializers.records import RecordLimitedSerializer
 from results.mixins.eager_loading import EagerLoadingMixin
+from results.utils.records import check_records_for_results, check_records_partial, defer_record_check
+from results.utils.records import defer_record_checks
+from results.utils.response_cache import invalidate_response_cache
+from results.utils.season_ranks import get_season_rank_keys, update_season_ranks
+from results.utils.statistics import invalidate_statistics_cache
+from results.utils.validation import ResultValidationContext, preload_related_objects
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key related field using objects preloaded to the result validation context, if available.
+    """
+    def to_internal_value(self, data):
+        validation = ResultValidationContext.get(self.context) if 'request' in self.context else None
+        if validation:
+            field_name = self.parent.field_name if isinstance(self.parent, serializers.ManyRelatedField) else \
+                self.field_name
+            instance = validation.get_object(field_name, self.get_queryset().model, data)
+            if instance is not None:
+                return instance
+        return super().to_internal_value(data)
 
 
 class ResultPartialSerializer(serializers.ModelSerializer):
@@ -52,6 +80,8 @@ class ResultPartialNestedSerializer(ResultPartialSerializer):
     """
     Serializer for nested partial result updates where validation is done in results serializer
     """
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
+
     class Meta:
         model = ResultPartial
         fields = ('id', 'type', 'order', 'value', 'decimals', 'code', 'time', 'permissions')
@@ -61,12 +91,124 @@ class ResultPartialNestedSerializer(ResultPartialSerializer):
         return data
 
 
+class ResultListSerializer(serializers.ListSerializer):
+    """
+    Serializer for creating multiple results at once, i.e. a competition's result sheet.
+
+    Results, partial results and team members are inserted with bulk_create in a single transaction. Save and
+    signals are not called for bulk created objects, so change log entries, record checks, season result ranks and
+    response cache invalidation are done once after the insert.
+
+    Related objects are preloaded for all results before validation, see
+    :class:`results.utils.validation.ResultValidationContext`.
+    """
+    def to_internal_value(self, data):
+        """
+        Preloads related objects before validating the results.
+        """
+        if isinstance(data, list) and 'request' in self.context:
+            preload_related_objects(self.child, data, ResultValidationContext.get(self.context))
+        return super().to_internal_value(data)
+
+    @staticmethod
+    def _get_entry_key(data):
+        """
+        Returns key identifying the result entry in a competition, same as used in the existence check.
+        """
+        if data['category'].team:
+            return data['competition'].pk, data['category'].pk, None, data.get('last_name')
+        return data['competition'].pk, data['category'].pk, data['athlete'].pk, None
+
+    def validate(self, attrs):
+        """
+        Validates that the same entry is not included multiple times.
+        """
+        keys = set()
+        for data in attrs:
+            key = self._get_entry_key(data)
+            if key in keys:
+                raise serializers.ValidationError(_('Entry already exists.'))
+            keys.add(key)
+        return attrs
+
+    _INSERT_MATCH_FIELDS = ['competition_id', 'category_id', 'athlete_id', 'organization_id', 'first_name',
+                            'last_name', 'position', 'team']
+
+    @classmethod
+    def _insert_results(cls, results):
+        """
+        Bulk creates results and sets their primary keys.
+
+        If the database backend does not return primary keys from bulk inserts, new rows are fetched by the primary
+        key being higher than the maximum before the insert. Rows are matched to the results in insert order, skipping
+        rows inserted by concurrent requests. Save and signals are bypassed, as logging, record checks and season
+        ranks are handled for the whole list in create.
+
+        Must be called inside a transaction.
+        """
+        max_pk = None
+        if not connection.features.can_return_ids_from_bulk_insert:
+            max_pk = Result.objects.aggregate(max_pk=Max('pk'))['max_pk'] or 0
+        Result.objects.bulk_create(results)
+        if max_pk is None:
+            return
+        rows = Result.objects.filter(pk__gt=max_pk, competition__in={result.competition_id for result in results}
+                                     ).order_by('pk').values_list('pk', *cls._INSERT_MATCH_FIELDS).iterator()
+        for result in results:
+            values = tuple(getattr(result, field) for field in cls._INSERT_MATCH_FIELDS)
+            for row in rows:
+                if row[1:] == values:
+                    result.pk = row[0]
+                    break
+            else:
+                raise DatabaseError('Could not find the primary key for the created result.')
+
+    @transaction.atomic
+    def create(self, validated_data):
+        """
+        Bulk creates results with partial results and team members.
+        """
+        results = []
+        partial_data = []
+        team_members = []
+        for data in validated_data:
+            data = dict(data)
+            partial_data.append(data.pop('partial', None) or [])
+            team_members.append(data.pop('team_members', None) or [])
+            result = Result(**data)
+            result.set_defaults()
+            results.append(result)
+        self._insert_results(results)
+        result_ids = [result.pk for result in results]
+        ResultPartial.objects.bulk_create([ResultPartial(result=result, **partial) for result, partials in
+                                           zip(results, partial_data) for partial in partials])
+        Result.team_members.through.objects.bulk_create([
+            Result.team_members.through(result_id=result.pk, athlete_id=athlete.pk) for result, athletes in
+            zip(results, team_members) for athlete in athletes])
+        Result.log_additions(results)
+        ResultPartial.log_additions(ResultPartial.objects.filter(result__in=result_ids).select_related(
+            'result__competition', 'type'))
+        if settings.RECORD_CHECK_MODE == 'immediate':
+            check_records_for_results(result_ids)
+        else:
+            defer_record_checks(result_ids)
+        if settings.SEASON_RESULT_RANKS:
+            for key in {key for result in results for key in get_season_rank_keys(result)}:
+                update_season_ranks(key)
+        invalidate_response_cache(competitions={result.competition_id for result in results})
+        transaction.on_commit(invalidate_statistics_cache)
+        created = Result.objects.select_related('competition__organization').prefetch_related(
+            'partial', 'team_members').in_bulk(result_ids)
+        return [created[pk] for pk in result_ids]
+
+
 class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for results
     """
     partial = ResultPartialNestedSerializer(many=True, required=False)
     permissions = DRYPermissionsField()
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
 
     class Meta:
         model = Result
@@ -74,7 +216,16 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
             'id', 'competition', 'athlete', 'team_members', 'first_name', 'last_name', 'organization', 'category',
             'elimination_category', 'result', 'decimals', 'result_code', 'position', 'position_pre',
             'approved', 'info', 'team', 'partial', 'permissions')
+        list_serializer_class = ResultListSerializer
 
+    @property
+    def _validation(self):
+        """
+        Validation context shared by the results validated in the request.
+        """
+        return ResultValidationContext.get(self.context)
+
+    @transaction.atomic
     def create(self, validated_data):
         """
         Nested partial results support in create
@@ -89,6 +240,7 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
             result.team_members.set(team_members)
         return result
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         """
         Nested partial results support in update
@@ -100,24 +252,61 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
             team_members = validated_data.pop('team_members')
             instance.team_members.set(team_members)
         instance.save()
-        partial_existing = list(ResultPartial.objects.filter(result=instance).values_list('id', flat=True))
         if 'partial' in validated_data:
-            partial_data = validated_data.pop('partial')
-            for partial in partial_data:
-                try:
-                    partial_instance = ResultPartial.objects.get(result=instance,
-                                                                 type=partial['type'],
-                                                                 order=partial['order'])
-                    for data in partial:
-                        if data not in ['result', 'type', 'order']:
-                            setattr(partial_instance, data, partial[data])
-                    partial_instance.save()
-                    partial_existing.remove(partial_instance.pk)
-                except ResultPartial.DoesNotExist:
-                    ResultPartial.objects.create(result=instance, **partial)
-            ResultPartial.objects.filter(pk__in=partial_existing).delete()
+            self._update_partials(instance, validated_data.pop('partial'))
         return instance
 
+    @staticmethod
+    def _update_partials(instance, partial_data):
+        """
+        Updates nested partial results.
+
+        Existing partial results are matched by type and order. Unchanged partial results are skipped, changed ones
+        are updated and new ones created in bulk, and partial results missing from the data are deleted. Change log
+        entries and record checks are done only for the changed and created partial results.
+        """
+        existing = {(partial.type_id, partial.order): partial for partial in
+                    ResultPartial.objects.filter(result=instance)}
+        changed = {}
+        created = {}
+        for partial in partial_data:
+            key = (partial['type'].pk, partial['order'])
+            if key not in existing:
+                created[key] = ResultPartial(result=instance, **partial)
+                continue
+            partial_instance = existing[key]
+            for data in partial:
+                if data not in ['result', 'type', 'order']:
+                    setattr(partial_instance, data, partial[data])
+            if partial_instance.changed_fields:
+                changed[key] = partial_instance
+        removed = [existing[key].pk for key in set(existing) - {(partial['type'].pk, partial['order'])
+                                                                for partial in partial_data}]
+        if removed:
+            ResultPartial.objects.filter(pk__in=removed).delete()
+        if changed:
+            updated_at = timezone.now()
+            fields = {'updated_at'}
+            for partial_instance in changed.values():
+                partial_instance.updated_at = updated_at
+                fields.update(partial_instance.changed_fields)
+            ResultPartial.objects.bulk_update(changed.values(), fields)
+            ResultPartial.log_changes(changed.values())
+        if created:
+            ResultPartial.objects.bulk_create(created.values())
+        if changed or created:
+            partials = [partial for partial in ResultPartial.objects.filter(result=instance).select_related('type')
+                        if (partial.type_id, partial.order) in set(changed) | set(created)]
+            for partial in partials:
+                partial.result = instance
+            ResultPartial.log_additions([partial for partial in partials if (partial.type_id, partial.order) in
+                                         created])
+            if settings.RECORD_CHECK_MODE == 'immediate':
+                for partial in sorted(partials, key=lambda partial: partial.value or 0, reverse=True):
+                    check_records_partial(partial)
+            else:
+                defer_record_check(instance.pk)
+
     @staticmethod
     def _age_difference(competition, athlete, exact):
         """
@@ -178,20 +367,19 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         if category.team and category.team_size and len(athletes) != category.team_size:
             raise serializers.ValidationError(_("Incorrect number of team members for this category."))
 
-    @staticmethod
-    def _check_requirements(competition, athletes):
+    def _check_requirements(self, competition, athletes):
         """
         Validates competition level and type requirements for the athletes.
         i.e. licence.
         """
-        for requirement in competition.type.requirements.split(',') + competition.level.requirements.split(','):
-            if requirement.strip():
+        requirements = self._validation.get_requirements(competition)
+        if requirements:
+            athletes = [athlete for athlete in athletes if not athlete.organization.external]
+            information = self._validation.get_athlete_information(competition, athletes)
+            for requirement in requirements:
                 for athlete in athletes:
-                    if not athlete.organization.external and not athlete.info.filter(
-                            type=requirement.strip(),
-                            date_start__lte=competition.date_start,
-                            date_end__gte=competition.date_start).count():
-                        raise serializers.ValidationError(_("Missing requirement: %s." % requirement.strip()))
+                    if requirement not in information[athlete.pk]:
+                        raise serializers.ValidationError(_("Missing requirement: %s." % requirement))
 
     def _check_value_limits(self, result, category, competition_type):
         """
@@ -276,15 +464,14 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
             result = None
         return result
 
-    @staticmethod
-    def _get_result_limits(category, competition_type):
+    def _get_result_limits(self, category, competition_type):
         """
         Returns result limits for the competition type and category.
 
         Raises ValidationError if category is not allowed for the competition
         type.
         """
-        check = CategoryForCompetitionType.objects.filter(category=category, type=competition_type).first()
+        check = self._validation.get_category_check(category, competition_type)
         if check and check.disallow:
             raise serializers.ValidationError(_("Category is not allowed for this competition type."))
         max_result = check.max_result if check and check.max_result else competition_type.max_result
@@ -295,13 +482,9 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         """
         Raises ValidationError if trying to create new result and it already exists.
         """
-        if self.instance is None and (
-                (not category.team and Result.objects.filter(competition=data['competition'],
-                                                             athlete=data['athlete'],
-                                                             category=data['category'])) or
-                (category.team and Result.objects.filter(competition=data['competition'],
-                                                         last_name=data['last_name'],
-                                                         category=data['category']))):
+        if self.instance is None and self._validation.entry_exists(
+                data['competition'], data['category'], athlete=data.get('athlete'),
+                last_name=data.get('last_name') if category.team else None):
             raise serializers.ValidationError(_('Entry already exists.'))
 
     def _check_team_status(self, data):
@@ -350,7 +533,7 @@ class ResultSerializer(QueryFieldsMixin, serializers.ModelSerializer):
                 (data['competition'].locked or
                  (data['competition'].level.require_approval and not data['competition'].approved) or
                  ('approved' in data and data['approved']) or
-                 data['competition'].organization.group not in self.context['request'].user.groups.all()))):
+                 data['competition'].organization.group_id not in self._validation.group_ids))):
             raise serializers.ValidationError(_('No permission to alter or create a record.'), 403)
         self._check_team_status(data)
         athletes, team = self._get_athletes(data)
@@ -436,16 +619,103 @@ class ResultLimitedSerializer(QueryFieldsMixin, serializers.ModelSerializer, Eag
             'approved', 'team', 'record')
 
 
-class ResultLimitedAggregateSerializer(ResultLimitedSerializer):
+class ResultLimitedAggregateSerializer(QueryFieldsMixin, serializers.Serializer):
     """
-    Serializer for limited aggregate result information
+    Serializer for limited aggregate result information, from grouped result rows
     """
-    _PREFETCH_RELATED_FIELDS = ['athlete',
-                                'athlete__organization',
-                                'athlete__organization__areas',
-                                'athlete__additional_organizations',
+    id = serializers.IntegerField(source='group_id', read_only=True)
+    athlete = AthleteLimitedSerializer(read_only=True)
+    result = serializers.DecimalField(source='group_result', max_digits=11, decimal_places=2, read_only=True)
+
+    _PREFETCH_RELATED_FIELDS = ['organization',
+                                'organization__areas',
+                                'additional_organizations',
                                 ]
 
-    class Meta:
-        model = Result
-        fields = ('id', 'athlete', 'result')
+    @classmethod
+    def setup_athletes(cls, rows):
+        """
+        Replaces athlete ids with athletes in the grouped result rows.
+
+        :param rows: grouped result rows
+        :type rows: list
+        :return: grouped result rows
+        :rtype: list
+        """
+        athletes = Athlete.objects.prefetch_related(*cls._PREFETCH_RELATED_FIELDS).in_bulk(
+            [row['athlete'] for row in rows])
+        for row in rows:
+            row['athlete'] = athletes.get(row['athlete'])
+        return rows
+
+
+class ResultLimitedFlatSerializer:
+    """
+    Read only serializer for flat limited result information
+
+    Builds rows from a values() queryset and id keyed lookups for partial results, records and team members,
+    without serializer fields for each instance. Related objects are included as ids or abbreviations.
+    """
+    FIELDS = ['id', 'athlete', 'first_name', 'last_name', 'competition', 'organization__abbreviation',
+              'category__abbreviation', 'elimination_category__abbreviation', 'result', 'result_code', 'decimals',
+              'position', 'position_pre', 'approved', 'team']
+    PARTIAL_FIELDS = ['id', 'result', 'type', 'order', 'value', 'decimals', 'code', 'time']
+    RECORD_FIELDS = ['id', 'result', 'level__abbreviation', 'approved', 'partial_result', 'category__abbreviation',
+                     'date_end', 'historical']
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @classmethod
+    def setup_queryset(cls, queryset):
+        """
+        Returns values queryset for the result rows.
+
+        :param queryset: results
+        :type queryset: QuerySet
+        :rtype: QuerySet
+        """
+        return queryset.prefetch_related(None).values(*cls.FIELDS)
+
+    @staticmethod
+    def _rename(row):
+        """
+        Returns row with related abbreviations named by the relation.
+        """
+        return {key.split('__')[0]: str(value) if isinstance(value, Decimal) else value for key, value in row.items()}
+
+    @staticmethod
+    def _group_by_result(rows):
+        """
+        Returns rows in lists keyed by result id.
+        """
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row.pop('result'), []).append(row)
+        return grouped
+
+    @property
+    def data(self):
+        """
+        :return: flat result rows
+        :rtype: list
+        """
+        ids = [row['id'] for row in self.rows]
+        partials = self._group_by_result(
+            self._rename(row) for row in ResultPartial.objects.filter(result__in=ids).order_by(
+                'type', 'order').values(*self.PARTIAL_FIELDS))
+        records = self._group_by_result(
+            self._rename(row) for row in Record.objects.filter(result__in=ids).order_by('id').values(
+                *self.RECORD_FIELDS))
+        team_members = {}
+        for result_id, athlete_id in Result.team_members.through.objects.filter(result__in=ids).values_list(
+                'result_id', 'athlete_id'):
+            team_members.setdefault(result_id, []).append(athlete_id)
+        data = []
+        for row in self.rows:
+            row = self._rename(row)
+            row['team_members'] = team_members.get(row['id'], [])
+            row['partial'] = partials.get(row['id'], [])
+            row['record'] = records.get(row['id'], [])
+            data.append(row)
+        return data
@@ -1,12 +1,21 @@
 from django.conf import settings
 from django.contrib.auth.models import Group
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
+from results.models.athletes import Athlete
+from results.models.categories import Category, CategoryForCompetitionType
+from results.models.competitions import Competition, CompetitionLevel, CompetitionType
 from results.models.organizations import Organization
+from results.models.records import Record
 from results.models.results import Result, ResultPartial
-from results.utils.records import check_records, check_records_partial
+from results.utils.records import check_records, check_records_partial, defer_record_check
+from results.utils.records import invalidate_category_cache
+from results.utils.response_cache import invalidate_response_cache
+from results.utils.season_ranks import get_season_rank_keys, update_season_ranks
+from results.utils.statistics import invalidate_statistics_cache
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -20,14 +29,123 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
 def check_result_records(sender, instance=None, created=False, **kwargs):
     """ Check for records after result has been saved."""
     if instance:
-        check_records(instance)
+        if settings.RECORD_CHECK_MODE == 'immediate':
+            check_records(instance)
+        else:
+            defer_record_check(instance.pk)
 
 
 @receiver(post_save, sender=ResultPartial)
 def check_result_records_partial(sender, instance=None, created=False, **kwargs):
     """ Check for records after partial result has been saved."""
     if instance:
-        check_records_partial(instance)
+        if settings.RECORD_CHECK_MODE == 'immediate':
+            check_records_partial(instance)
+        else:
+            defer_record_check(instance.result_id)
+
+
+@receiver(post_save, sender=Result)
+def update_result_season_ranks(sender, instance=None, created=False, **kwargs):
+    """ Update season result ranks after result has been saved."""
+    if instance and settings.SEASON_RESULT_RANKS:
+        for key in get_season_rank_keys(instance):
+            update_season_ranks(key)
+
+
+@receiver(pre_delete, sender=Result)
+def get_deleted_result_season_ranks(sender, instance=None, **kwargs):
+    """ Store season result ranks affected by the result deletion."""
+    if instance and settings.SEASON_RESULT_RANKS:
+        instance._season_rank_keys = get_season_rank_keys(instance)
+
+
+@receiver(post_delete, sender=Result)
+def update_deleted_result_season_ranks(sender, instance=None, **kwargs):
+    """ Update season result ranks after result has been deleted."""
+    for key in getattr(instance, '_season_rank_keys', []):
+        update_season_ranks(key)
+
+
+@receiver(post_save, sender=Competition)
+def update_competition_season_ranks(sender, instance=None, created=False, **kwargs):
+    """ Update season result ranks if competition's date or type has been changed."""
+    if instance and not created and settings.SEASON_RESULT_RANKS and {'date_start', 'type'} & set(
+            instance.changed_fields):
+        for result in instance.results_competition.select_related('competition', 'organization'):
+            for key in get_season_rank_keys(result):
+                update_season_ranks(key)
+
+
+def _get_changed_values(instance, field):
+    """ Returns current and initial value of the field."""
+    values = {getattr(instance, field + '_id')}
+    if field in instance.changed_fields:
+        values.add(instance.diff[field][0])
+    return values
+
+
+@receiver([post_save, post_delete], sender=Competition)
+def invalidate_competition_responses(sender, instance=None, **kwargs):
+    """ Invalidate cached responses after competition has been changed."""
+    if instance:
+        invalidate_response_cache(competitions=[instance.pk], types=_get_changed_values(instance, 'type'))
+
+
+@receiver([post_save, post_delete], sender=Result)
+def invalidate_result_responses(sender, instance=None, **kwargs):
+    """ Invalidate cached responses after result has been changed."""
+    if instance:
+        invalidate_response_cache(competitions=_get_changed_values(instance, 'competition'))
+
+
+@receiver([post_save, post_delete], sender=ResultPartial)
+def invalidate_result_partial_responses(sender, instance=None, **kwargs):
+    """ Invalidate cached responses after partial result has been changed."""
+    if instance:
+        invalidate_response_cache(
+            competitions=Result.objects.filter(pk=instance.result_id).values_list('competition', flat=True))
+
+
+@receiver([post_save, post_delete], sender=Record)
+def invalidate_record_responses(sender, instance=None, **kwargs):
+    """ Invalidate cached responses after record has been changed."""
+    if instance:
+        invalidate_response_cache(
+            competitions=Result.objects.filter(pk=instance.result_id).values_list('competition', flat=True),
+            types=_get_changed_values(instance, 'type'))
+
+
+@receiver([post_save, pre_delete], sender=Athlete)
+def invalidate_athlete_responses(sender, instance=None, **kwargs):
+    """ Invalidate cached responses after athlete has been changed."""
+    if instance:
+        invalidate_response_cache(athletes=[instance.pk])
+
+
+@receiver([post_save, pre_delete], sender=Organization)
+def invalidate_organization_responses(sender, instance=None, **kwargs):
+    """ Invalidate cached responses after organization has been changed."""
+    if instance:
+        invalidate_response_cache(organizations=[instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=CategoryForCompetitionType)
+@receiver([post_save, post_delete], sender=CompetitionType)
+@receiver(m2m_changed, sender=CategoryForCompetitionType.limit_partial.through)
+def invalidate_record_categories(sender, **kwargs):
+    """ Invalidate cached record categories after categories have been changed."""
+    invalidate_category_cache()
+
+
+@receiver([post_save, post_delete], sender=Result)
+@receiver([post_save, post_delete], sender=Competition)
+@receiver([post_save, post_delete], sender=CompetitionLevel)
+@receiver([post_save, post_delete], sender=Organization)
+def invalidate_statistics(sender, **kwargs):
+    """ Invalidate cached statistics after the transaction has been committed."""
+    transaction.on_commit(invalidate_statistics_cache)
 
 
 @receiver(post_save, sender=Organization)
@@ -1,18 +1,30 @@
 import datetime
+from threading import get_ident, local
 from unittest.mock import patch
 
+from django.contrib.admin.models import ADDITION, CHANGE, LogEntry
 from django.contrib.auth.models import User
 from django.test import TestCase
+from requests.exceptions import HTTPError
 
-from results.connectors.suomisport import Suomisport
-from results.models.athletes import Athlete
+from results.connectors.suomisport import Suomisport, SuomisportError
+from results.models.athletes import Athlete, AthleteInformation, LicenceSyncState
+from results.models.organizations import Organization
 from results.tests.factories.athletes import AthleteFactory
 from results.tests.factories.organizations import OrganizationFactory
 
 
 class OAuth(object):
+    status_code = 200
+    urls = []
+
     def __init__(self, url):
         self.url = url
+        OAuth.urls.append(url)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError('%s Error' % self.status_code)
 
     def json(self):
         today = datetime.date.today().isoformat()
@@ -85,9 +97,79 @@ class OAuth(object):
                         "total": 2
                     }
                 }
+        if self.url.startswith('organization'):
+            return {
+                "content": [
+                    {"sportId": 11, "name": "Seura 1", "shortName": "S1"},
+                    {"sportId": 12, "name": "seura  2", "shortName": None},
+                    {"sportId": 13, "name": "Seura 3", "shortName": "S3"},
+                    {"sportId": 14, "name": "Seura 4", "shortName": "SA"},
+                ]
+            }
         return {}
 
 
+class PagedOAuth(OAuth):
+    failures = 0
+    empty_page = None
+    unauthorized = False
+
+    def __init__(self, url):
+        super().__init__(url)
+        if PagedOAuth.failures:
+            PagedOAuth.failures -= 1
+            self.status_code = 503
+        elif PagedOAuth.unauthorized:
+            self.status_code = 401
+
+    def json(self):
+        page = int(self.url.split('page=')[1])
+        if page == PagedOAuth.empty_page:
+            return {}
+        return {
+            "content": [{"id": page}],
+            "pageable": {
+                "page": page,
+                "size": 1,
+                "total": 10
+            }
+        }
+
+
+class LicencePagedOAuth(OAuth):
+    failed_page = 2
+
+    def json(self):
+        if self.url.startswith('licence'):
+            return super().json()
+        page = int(self.url.split('page=')[1])
+        if page == LicencePagedOAuth.failed_page:
+            return {}
+        return {
+            "content": [
+                {
+                    "licenceOrganizationSportId": 1,
+                    "usagePeriodEnd": "2021-12-31",
+                    "usagePeriodStart": "2021-01-01",
+                    "name": "Competition licence",
+                    "modificationTime": "2021-01-0%dT12:00:00.000Z" % (page + 1),
+                    "user": {
+                        "birthDate": "1990-03-01",
+                        "firstName": "Matti",
+                        "gender": "Male",
+                        "lastName": "Meikäläinen",
+                        "sportId": 100 + page
+                    }
+                }
+            ],
+            "pageable": {
+                "page": page,
+                "size": 1,
+                "total": 4
+            }
+        }
+
+
 class TestSuomiSport(Suomisport):
 
     def __init__(self):
@@ -95,9 +177,16 @@ class TestSuomiSport(Suomisport):
         self.organization_id = '1'
         self.licence_types = ['Competition']
         self.fetch_size = 1
+        self.fetch_workers = 2
+        self.fetch_retries = 3
+        self.fetch_backoff = 0
+        self.sessions = local()
         self.oauth = OAuth
         self.oauth.get = OAuth
 
+    def _new_session(self):
+        return self.oauth
+
 
 class SuomisportCase(TestCase):
     def test_get_licence_types(self):
@@ -108,7 +197,68 @@ class SuomisportCase(TestCase):
     def test_get_licences(self):
         obj = TestSuomiSport()
         result = obj.get_licences(1, 1)
-        self.assertEqual(len(result), 2)
+        self.assertEqual(len(list(result)), 2)
+
+    def test_fetch_pages_in_order(self):
+        obj = TestSuomiSport()
+        obj.oauth = PagedOAuth
+        obj.oauth.get = PagedOAuth
+        self.assertEqual([licence['id'] for licence in obj.get_licences(1, 1)], list(range(10)))
+
+    def test_fetch_pages_session_per_worker(self):
+        sessions = []
+
+        class Session:
+            def __init__(self):
+                self.threads = set()
+                sessions.append(self)
+
+            def get(self, url):
+                self.threads.add(get_ident())
+                return PagedOAuth(url)
+
+        obj = TestSuomiSport()
+        obj.oauth = Session()
+        obj._new_session = Session
+        self.assertEqual([licence['id'] for licence in obj.get_licences(1, 1)], list(range(10)))
+        self.assertEqual(obj.oauth.threads, {get_ident()})
+        self.assertGreater(len(sessions), 1)
+        self.assertLessEqual(len(sessions), 1 + obj.fetch_workers)
+        self.assertTrue(all(len(session.threads) <= 1 for session in sessions))
+        self.assertEqual(len(set().union(*(session.threads for session in sessions))),
+                         sum(len(session.threads) for session in sessions))
+
+    @patch('results.connectors.suomisport.logger')
+    def test_fetch_retry(self, mock_logger):
+        obj = TestSuomiSport()
+        obj.oauth = PagedOAuth
+        obj.oauth.get = PagedOAuth
+        PagedOAuth.failures = 2
+        self.assertEqual(obj._get_page('page=0'), PagedOAuth('page=0').json())
+        self.assertEqual(mock_logger.warning.call_count, 2)
+
+    @patch('results.connectors.suomisport.logger')
+    def test_fetch_retry_failed(self, mock_logger):
+        obj = TestSuomiSport()
+        obj.oauth = PagedOAuth
+        obj.oauth.get = PagedOAuth
+        PagedOAuth.failures = 4
+        with self.assertRaises(HTTPError):
+            obj._get_page('page=0')
+        PagedOAuth.unauthorized = True
+        self.addCleanup(setattr, PagedOAuth, 'unauthorized', False)
+        with self.assertRaises(HTTPError):
+            obj._get_page('page=0')
+        self.assertEqual(mock_logger.warning.call_count, 3)
+
+    def test_fetch_page_without_content(self):
+        obj = TestSuomiSport()
+        obj.oauth = PagedOAuth
+        obj.oauth.get = PagedOAuth
+        PagedOAuth.empty_page = 5
+        self.addCleanup(setattr, PagedOAuth, 'empty_page', None)
+        with self.assertRaises(SuomisportError):
+            list(obj.get_licences(1, 1))
 
     @patch('results.connectors.suomisport.logger')
     def test_update_licences(self, mock_logger):
@@ -123,6 +273,97 @@ class SuomisportCase(TestCase):
         self.assertEqual(Athlete.objects.get(id=2).gender, 'W')
         self.assertEqual(Athlete.objects.get(id=2).first_name, 'Maju')
 
+    @staticmethod
+    def _licence(sport_id, organization_sport_id=1, name='Competition licence'):
+        return {
+            "licenceOrganizationSportId": organization_sport_id,
+            "usagePeriodEnd": "2020-12-31",
+            "usagePeriodStart": "2020-01-01",
+            "name": name,
+            "modificationTime": "2020-01-01T12:00:01.123Z",
+            "user": {
+                "birthDate": "1990-03-01",
+                "firstName": "Matti",
+                "gender": "Male",
+                "lastName": "Meikäläinen",
+                "sportId": sport_id
+            }
+        }
+
+    def test_update_athletes_in_batch(self):
+        User.objects.create_user('log')
+        organization = OrganizationFactory.create(sport_id=1)
+        AthleteFactory.create(sport_id='1', first_name='Matti', last_name='Meikäläinen', gender='M',
+                              date_of_birth=datetime.date(1990, 3, 1), organization=organization)
+        AthleteFactory.create(sport_id='2', first_name='Maija')
+        AthleteFactory.create(sport_id='3', first_name='Maija', no_auto_update=True)
+        licences = [self._licence(sport_id) for sport_id in range(1, 11)]
+        licences += [self._licence(11, organization_sport_id=2), self._licence(4, name='Training licence')]
+        obj = TestSuomiSport()
+        obj.fetch_size = 100
+        with self.assertNumQueries(13):
+            obj._update_athletes(licences)
+        self.assertEqual(Athlete.objects.count(), 10)
+        self.assertEqual(Athlete.objects.filter(first_name='Matti').count(), 9)
+        self.assertEqual(Athlete.objects.get(sport_id='3').first_name, 'Maija')
+        self.assertEqual(AthleteInformation.objects.filter(type='licence').count(), 11)
+        self.assertEqual(LogEntry.objects.filter(action_flag=ADDITION, content_type__model='athlete').count(), 10)
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE, content_type__model='athlete').count(), 1)
+        with self.assertNumQueries(5):
+            obj._update_athletes(licences)
+        self.assertEqual(AthleteInformation.objects.filter(type='licence').count(), 11)
+
+    def test_update_licences_watermark(self):
+        User.objects.create_user('log')
+        OrganizationFactory.create(sport_id=1)
+        obj = TestSuomiSport()
+        obj.update_licences()
+        state = LicenceSyncState.objects.get()
+        self.assertEqual((state.licence_period_id, state.licence_type_id), (2, 5))
+        self.assertEqual(state.modification_time.isoformat(), '2020-01-01T12:00:01.123000+00:00')
+        OAuth.urls = []
+        obj.update_licences()
+        self.assertIn('ts=2020-01-01T12:00:01.123Z', [url for url in OAuth.urls if url.startswith('user-lic')][0])
+        self.assertEqual(LicenceSyncState.objects.count(), 1)
+
+    def test_update_licences_uses_licence_type_watermark(self):
+        User.objects.create_user('log')
+        OrganizationFactory.create(sport_id=1)
+        AthleteInformation.objects.create(athlete=AthleteFactory.create(), type='licence', value='Licence',
+                                          modification_time=datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc))
+        LicenceSyncState.objects.create(licence_period_id=2, licence_type_id=5, modification_time=datetime.datetime(
+            2020, 1, 1, tzinfo=datetime.timezone.utc))
+        OAuth.urls = []
+        TestSuomiSport().update_licences()
+        self.assertIn('ts=2020-01-01T00:00:00.000Z', [url for url in OAuth.urls if url.startswith('user-lic')][0])
+
+    def test_get_organizations(self):
+        User.objects.create_user('log')
+        organization = OrganizationFactory.create(name='Seura 1', abbreviation='s1')
+        organization_2 = OrganizationFactory.create(name='Seura 2', abbreviation='S2')
+        OrganizationFactory.create(name='Seura A', abbreviation='SA')
+        OrganizationFactory.create(name='Seura B', abbreviation='SA')
+        obj = TestSuomiSport()
+        with self.assertNumQueries(1):
+            matched = obj.get_organizations()
+        self.assertEqual(matched, {'11': organization, '12': organization_2})
+        obj.get_organizations(update_sport_ids=True)
+        self.assertEqual(sorted(Organization.objects.exclude(sport_id=None).values_list('sport_id', flat=True)),
+                         ['11', '12'])
+
+    def test_update_licences_failed_page_keeps_watermark(self):
+        User.objects.create_user('log')
+        OrganizationFactory.create(sport_id=1)
+        modification_time = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        LicenceSyncState.objects.create(licence_period_id=2, licence_type_id=5, modification_time=modification_time)
+        obj = TestSuomiSport()
+        obj.oauth = LicencePagedOAuth
+        obj.oauth.get = LicencePagedOAuth
+        with self.assertRaises(SuomisportError):
+            obj.update_licences()
+        self.assertEqual(LicenceSyncState.objects.get().modification_time, modification_time)
+        self.assertEqual(Athlete.objects.count(), 2)
+
     def test_ignore_athlete_updates(self):
         User.objects.create_user('log')
         OrganizationFactory.create(sport_id=1)
@@ -1,11 +1,30 @@
+from datetime import date, timedelta
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest.mock import patch
+
+from django.contrib.admin.models import CHANGE, LogEntry
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
+from results.models.athletes import Athlete
+from results.models.categories import Category, CategoryForCompetitionType
 from results.models.competitions import Competition
 from results.models.events import Event
-from results.models.results import Result
-from results.tests.factories.results import ResultFactory
+from results.models.records import Record, RecordCheckQueue, RecordLevel
+from results.models.results import Result, ResultPartial
+from results.tests.factories.athletes import AthleteFactory
+from results.tests.factories.competitions import CompetitionFactory, CompetitionResultTypeFactory
+from results.tests.factories.organizations import OrganizationFactory
+from results.tests.factories.results import ResultFactory, ResultPartialFactory
+from results.utils.change_log import buffered_change_log, wait_for_log_writer, write_log_entries
+from results.utils.records import defer_record_check, defer_record_checks, get_record_groups
+from results.utils.records import run_pending_record_checks
 
 
 class CreateEvent(TestCase):
@@ -32,3 +51,368 @@ class Approve(TestCase):
         self.assertEqual(Result.objects.filter(approved=False).count(), 0)
         self.assertEqual(Event.objects.filter(locked=False).count(), 0)
         self.assertEqual(Competition.objects.filter(locked=False).count(), 0)
+
+    def test_approve_objects_in_bulk(self):
+        self.user = User.objects.create(username='logger')
+        ResultFactory.create(approved=False, competition__locked=False, competition__event__locked=False)
+        log_entries = LogEntry.objects.filter(action_flag=CHANGE).count()
+        call_command('approve', days=0, result=True, record=True, event=True, competition=True, bulk=True,
+                     verbosity=0)
+        self.assertEqual(Result.objects.filter(approved=False).count(), 0)
+        self.assertEqual(Event.objects.filter(locked=False).count(), 0)
+        self.assertEqual(Competition.objects.filter(locked=False).count(), 0)
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), log_entries + 3)
+
+
+@override_settings(CHANGE_LOG_MODE='buffered')
+class ApproveBufferedChangeLog(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='logger')
+        log_user = override_settings(DEFAULT_LOG_USER_ID=self.user.pk)
+        log_user.enable()
+        self.addCleanup(log_user.disable)
+        for position in range(1, 4):
+            ResultFactory.create(approved=False, position=position, competition__locked=False,
+                                 competition__event__locked=False)
+
+    def test_approve_change_log_written_in_bulk(self):
+        with CaptureQueriesContext(connection) as context:
+            call_command('approve', days=0, result=True, verbosity=0)
+        inserts = [query for query in context.captured_queries if
+                   query['sql'].startswith('INSERT INTO "django_admin_log"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE, content_type__model='result').count(),
+                         Result.objects.count())
+
+    def test_rolled_back_changes_not_logged(self):
+        result = Result.objects.first()
+        log_entries = LogEntry.objects.count()
+        with buffered_change_log():
+            try:
+                with transaction.atomic():
+                    result.approved = True
+                    result.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            result = Result.objects.get(pk=result.pk)
+            result.info = 'Changed'
+            result.save()
+            self.assertEqual(LogEntry.objects.count(), log_entries)
+        self.assertEqual(LogEntry.objects.count(), log_entries + 1)
+        self.assertIn('info', LogEntry.objects.latest('pk').change_message)
+
+
+@override_settings(CHANGE_LOG_MODE='thread')
+class ThreadChangeLog(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='logger')
+        self.content_type = ContentType.objects.get_for_model(User)
+
+    def _entries(self, change_message):
+        return [LogEntry(user=self.user, content_type=self.content_type, object_id=str(self.user.pk),
+                         object_repr=str(self.user), action_flag=CHANGE, change_message=change_message)]
+
+    @patch('results.utils.change_log.logger')
+    def test_writer_continues_after_failed_write(self, mock_logger):
+        bulk_create = LogEntry.objects.bulk_create
+        calls = []
+
+        def fail_once(entries):
+            calls.append(entries)
+            if len(calls) == 1:
+                raise DatabaseError('Lock wait timeout')
+            return bulk_create(entries)
+
+        with patch.object(LogEntry.objects, 'bulk_create', side_effect=fail_once):
+            write_log_entries(self._entries('first'))
+            write_log_entries(self._entries('second'))
+            wait_for_log_writer()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(mock_logger.exception.call_count, 1)
+        self.assertEqual(list(LogEntry.objects.values_list('change_message', flat=True)), ['second'])
+
+
+@override_settings(RECORD_CHECK_MODE='commit')
+class DeferredRecordChecks(TransactionTestCase):
+    @patch('results.utils.records.check_records_for_results')
+    def test_rolled_back_results_not_checked(self, mock_check):
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                defer_record_check(1)
+                raise DatabaseError('Rollback')
+        with transaction.atomic():
+            defer_record_check(2)
+            defer_record_checks({3, 4})
+        mock_check.assert_called_once_with({2, 3, 4})
+
+    @patch('results.utils.records.check_records_for_results')
+    def test_check_registered_once_per_transaction(self, mock_check):
+        with transaction.atomic(), patch('results.utils.records.transaction.on_commit',
+                                         wraps=transaction.on_commit) as mock_on_commit:
+            for result_id in range(1, 4):
+                defer_record_check(result_id)
+            self.assertEqual(mock_on_commit.call_count, 1)
+        mock_check.assert_called_once_with({1, 2, 3})
+        defer_record_check(4)
+        mock_check.assert_called_with({4})
+
+
+class ImportAthletes(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='logger')
+        self.organization = OrganizationFactory.create()
+        self.organization_2 = OrganizationFactory.create()
+        AthleteFactory.create(sport_id='100', first_name='Matti', organization=self.organization_2)
+        rows = ['100,Meikäläinen,Matti,1990-01-01,M,%s' % self.organization.pk,
+                '200,Virtanen,Maija,1991-02-03,W,%s' % self.organization.pk,
+                '100,Meikäläinen,Matti,1990-01-01,M,%s' % self.organization_2.pk,
+                '200,Virtanen,Maija,1991-02-03,W,%s' % self.organization_2.pk,
+                '300,Virtanen,Mikko,1991-02-03,M,0']
+        self.input_file = NamedTemporaryFile(mode='w', suffix='.csv')
+        self.input_file.write('\n'.join(rows) + '\n')
+        self.input_file.flush()
+        self.addCleanup(self.input_file.close)
+
+    def test_import_athletes(self):
+        with CaptureQueriesContext(connection) as context:
+            call_command('importathletes', input=self.input_file.name, verbosity=0)
+        self.assertLess(len(context.captured_queries), 15)
+        self.assertEqual(Athlete.objects.count(), 2)
+        athlete = Athlete.objects.get(sport_id='100')
+        self.assertEqual((athlete.last_name, athlete.organization), ('Meikäläinen', self.organization))
+        self.assertEqual(list(athlete.additional_organizations.all()), [self.organization_2])
+        athlete = Athlete.objects.get(sport_id='200')
+        self.assertEqual((athlete.first_name, athlete.organization), ('Maija', self.organization))
+        self.assertEqual(list(athlete.additional_organizations.all()), [self.organization_2])
+        call_command('importathletes', input=self.input_file.name, verbosity=0)
+        self.assertEqual(Athlete.additional_organizations.through.objects.count(), 2)
+
+    def test_import_athletes_dry_run(self):
+        out = StringIO()
+        call_command('importathletes', input=self.input_file.name, dry_run=True, stdout=out)
+        self.assertEqual(Athlete.objects.count(), 1)
+        self.assertEqual(Athlete.objects.get(sport_id='100').organization, self.organization_2)
+        self.assertIn('Created athlete: 200', out.getvalue())
+        self.assertIn('Update organization for athlete: 100', out.getvalue())
+        self.assertIn('Athletes created: 1, updated: 1, additional organizations: 2', out.getvalue())
+
+
+class AthleteBirthYearOnly(TestCase):
+    def test_birth_dates_to_year_only(self):
+        self.user = User.objects.create(username='logger')
+        AthleteFactory.create(date_of_birth=date(1990, 3, 1))
+        AthleteFactory.create(date_of_birth=date(1991, 1, 1))
+        AthleteFactory.create(date_of_birth=None)
+        out = StringIO()
+        with self.assertNumQueries(6):
+            call_command('athletebirthyearonly', stdout=out)
+        self.assertEqual(sorted(Athlete.objects.exclude(date_of_birth=None).values_list('date_of_birth', flat=True)),
+                         [date(1990, 1, 1), date(1991, 1, 1)])
+        self.assertIn('Updated birth dates: 1', out.getvalue())
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE, content_type__model='athlete').count(), 1)
+
+
+class CheckRecords(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='logger')
+        self.competition = CompetitionFactory.create()
+        self.competition_later = CompetitionFactory.create(
+            date_start=self.competition.date_start + timedelta(days=2),
+            date_end=self.competition.date_end + timedelta(days=2),
+            type=self.competition.type, level=self.competition.level)
+        sport = self.competition.type.sport
+        self.category_W = Category.objects.create(name="W", abbreviation="W", gender="W", sport=sport)
+        self.category_W20 = Category.objects.create(name="W20", abbreviation="W20", max_age=20, gender="W",
+                                                    sport=sport)
+        CategoryForCompetitionType.objects.create(type=self.competition.type, category=self.category_W,
+                                                  record_group=1)
+        CategoryForCompetitionType.objects.create(type=self.competition.type, category=self.category_W20,
+                                                  record_group=1)
+        record_level = RecordLevel.objects.create(name="SE", abbreviation="SE", decimals=True, partial=True)
+        record_level.types.add(self.competition.type)
+        record_level.levels.add(self.competition.level)
+        self.result_type = CompetitionResultTypeFactory.create(competition_type=self.competition.type)
+
+    def _create_results(self):
+        values = [(self.competition, 200, 50), (self.competition, 250, 40), (self.competition_later, 220, 60),
+                  (self.competition_later, 300, 55)]
+        for competition, value, partial_value in values:
+            athlete = AthleteFactory.create(gender="W", date_of_birth=competition.date_start - timedelta(days=18*365))
+            result = ResultFactory.create(competition=competition, athlete=athlete, category=self.category_W20,
+                                          result=value)
+            ResultPartialFactory.create(result=result, type=self.result_type, value=partial_value)
+
+    @staticmethod
+    def _records():
+        return set(Record.objects.values_list('result', 'partial_result', 'level', 'category', 'date_start'))
+
+    def test_checkrecords_rebuild(self):
+        self._create_results()
+        records = self._records()
+        Record.objects.all().delete()
+        call_command('checkrecords', verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    def test_checkrecords_keeps_approved_records(self):
+        self._create_results()
+        Record.objects.all().update(approved=True)
+        records = self._records()
+        call_command('checkrecords', verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    def test_checkrecords_bulk_rebuild(self):
+        self._create_results()
+        Record.objects.all().delete()
+        call_command('checkrecords', verbosity=0)
+        records = self._records()
+        self.assertEqual(sorted(Record.objects.exclude(partial_result=None).values_list(
+            'partial_result__value', flat=True)), [40, 40, 50, 50, 55, 55, 60, 60])
+        Record.objects.all().delete()
+        call_command('checkrecords', bulk=True, verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    def test_checkrecords_bulk_rebuild_same_partial_value(self):
+        self._create_results()
+        result = Result.objects.get(result=250)
+        ResultPartial.objects.filter(result=result).update(value=50)
+        values = ('partial_result__value', 'category', 'date_start')
+        Record.objects.all().delete()
+        call_command('checkrecords', verbosity=0)
+        records = sorted(Record.objects.exclude(partial_result=None).values_list(*values))
+        self.assertEqual(len(records), 6)
+        Record.objects.all().delete()
+        call_command('checkrecords', bulk=True, verbosity=0)
+        self.assertEqual(sorted(Record.objects.exclude(partial_result=None).values_list(*values)), records)
+
+    def test_checkrecords_bulk_rebuild_category_limits(self):
+        self._create_results()
+        check = CategoryForCompetitionType.objects.get(category=self.category_W20)
+        check.limit_partial.add(self.result_type)
+        CategoryForCompetitionType.objects.filter(category=self.category_W).update(check_record=False)
+        Record.objects.all().delete()
+        call_command('checkrecords', verbosity=0)
+        records = self._records()
+        Record.objects.all().delete()
+        call_command('checkrecords', bulk=True, verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    def test_record_groups_queries(self):
+        self._create_results()
+        with CaptureQueriesContext(connection) as context:
+            groups = get_record_groups()
+        for result in Result.objects.all():
+            athlete = AthleteFactory.create(gender="W", date_of_birth=result.athlete.date_of_birth)
+            ResultFactory.create(competition=result.competition, athlete=athlete, category=self.category_W20,
+                                 organization=result.organization, result=result.result - 10)
+        with self.assertNumQueries(len(context)):
+            self.assertEqual(get_record_groups().keys(), groups.keys())
+
+    def test_checkrecords_bulk_keeps_approved_records(self):
+        self._create_results()
+        Record.objects.filter(result__result=250, partial_result=None).update(approved=True)
+        call_command('checkrecords', bulk=True, verbosity=0)
+        self.assertEqual(Record.objects.filter(approved=True).count(), 2)
+        self.assertEqual(Record.objects.filter(partial_result=None).count(), 4)
+
+    def test_checkrecords_bulk_removes_stale_records(self):
+        self._create_results()
+        check = CategoryForCompetitionType.objects.get(category=self.category_W)
+        check.record_group = 2
+        check.save()
+        call_command('checkrecords', bulk=True, verbosity=0)
+        self.assertEqual(Record.objects.filter(category=self.category_W).count(), 0)
+        self.assertEqual(Record.objects.filter(category=self.category_W20).count(), 6)
+
+    def test_approve_bulk_ends_lower_records(self):
+        self._create_results()
+        call_command('approve', days=0, record=True, bulk=True, verbosity=0)
+        self.assertEqual(Record.objects.filter(approved=False).count(), 0)
+        self.assertEqual(Record.objects.exclude(date_end=None).count(), 8)
+        self.assertEqual(set(Record.objects.exclude(date_end=None).values_list(
+            'result__result', 'partial_result__value', 'date_end')),
+            {(250, None, self.competition_later.date_start), (200, 50, self.competition_later.date_start),
+             (250, 40, self.competition.date_start), (300, 55, self.competition_later.date_start)})
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE, content_type__model='record').count(), 20)
+
+    def test_approve_bulk_deletes_lower_unapproved_records(self):
+        self._create_results()
+        Record.objects.filter(result__competition=self.competition_later).update(
+            updated_at=timezone.now() - timedelta(days=2))
+        call_command('approve', days=1, record=True, bulk=True, verbosity=0)
+        self.assertEqual(Record.objects.filter(result__competition=self.competition).count(), 0)
+        self.assertEqual(Record.objects.filter(approved=True, date_end=None).count(), 4)
+
+    def test_approverecords_ends_lower_records(self):
+        self._create_results()
+        with CaptureQueriesContext(connection) as context:
+            call_command('approverecords', str(self.competition_later.date_start), stdout=StringIO())
+        self.assertEqual(len([query for query in context.captured_queries if
+                              query['sql'].startswith('UPDATE "results_record" SET "date_end"')]), 4)
+        self.assertEqual(set(Record.objects.filter(date_end=None).values_list(
+            'result__result', 'partial_result__value')), {(300, None), (220, 60)})
+        self.assertEqual(set(Record.objects.exclude(date_end=None).values_list('result__result', 'date_end')),
+                         {(250, self.competition_later.date_start), (200, self.competition_later.date_start)})
+        self.assertEqual(Record.objects.filter(approved=False).count(), 0)
+
+    def test_checkrecords_partitioned_rebuild(self):
+        self._create_results()
+        records = self._records()
+        Record.objects.all().delete()
+        call_command('checkrecords', processes=1, verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    def test_checkrecords_partitioned_bulk_rebuild(self):
+        self._create_results()
+        call_command('checkrecords', bulk=True, verbosity=0)
+        records = self._records()
+        Record.objects.all().delete()
+        call_command('checkrecords', processes=1, bulk=True, verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    @patch('results.management.commands.checkrecords.get_context')
+    def test_checkrecords_parallel_rebuild(self, mock_context):
+        """Worker processes cannot see the test database, so the forked pool is replaced with a serial pool."""
+        class SerialPool:
+            def __init__(self, processes, initializer):
+                self.processes = processes
+
+            def imap_unordered(self, func, iterable):
+                return map(func, iterable)
+
+            def close(self):
+                pass
+
+            def join(self):
+                pass
+
+        mock_context.return_value.Pool = SerialPool
+        self._create_results()
+        records = self._records()
+        Record.objects.all().delete()
+        call_command('checkrecords', processes=2, verbosity=0)
+        mock_context.assert_called_once_with('fork')
+        self.assertEqual(self._records(), records)
+
+    def test_deferred_record_check_on_commit(self):
+        with override_settings(RECORD_CHECK_MODE='commit'):
+            self._create_results()
+            self.assertEqual(Record.objects.count(), 0)
+            run_pending_record_checks()
+        records = self._records()
+        self.assertNotEqual(records, set())
+        Record.objects.all().delete()
+        call_command('checkrecords', verbosity=0)
+        self.assertEqual(self._records(), records)
+
+    def test_checkrecordqueue(self):
+        with override_settings(RECORD_CHECK_MODE='queue'):
+            self._create_results()
+            self.assertEqual(Record.objects.count(), 0)
+            self.assertEqual(RecordCheckQueue.objects.count(), 4)
+            call_command('checkrecordqueue', limit=3, verbosity=0)
+        self.assertEqual(RecordCheckQueue.objects.count(), 0)
+        records = self._records()
+        Record.objects.all().delete()
+        call_command('checkrecords', verbosity=0)
+        self.assertEqual(self._records(), records)
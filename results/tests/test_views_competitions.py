@@ -1,3 +1,6 @@
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlparse
+
 from django.contrib.auth.models import Group, User
 from django.test import TestCase, override_settings
 from rest_framework import status
@@ -420,6 +423,21 @@ class CompetitionTestCase(ResultsTestCase):
         self.viewset = CompetitionViewSet
         self.model = Competition
 
+    def test_competition_list_cursor(self):
+        for days in [0, 0, 1]:
+            CompetitionFactory.create(date_start=self.object.date_start - timedelta(days=days),
+                                      date_end=self.object.date_end, name=self.object.name)
+        view = self.viewset.as_view(actions={'get': 'list'})
+        expected = [competition['id'] for competition in view(self.factory.get(self.url)).data['results']]
+        ids = []
+        params = {'limit': 3, 'cursor': ''}
+        while params is not None:
+            response = view(self.factory.get(self.url, params))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [competition['id'] for competition in response.data['results']]
+            params = dict(parse_qsl(urlparse(response.data['next']).query)) if response.data['next'] else None
+        self.assertEqual(ids, expected)
+
     def _test_access(self, user):
         request = self.factory.get(self.url + '1/')
         force_authenticate(request, user=user)
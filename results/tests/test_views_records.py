@@ -1,6 +1,8 @@
 from datetime import date, timedelta
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
@@ -11,6 +13,7 @@ from results.models.records import Record, RecordLevel
 from results.tests.factories.athletes import AthleteFactory
 from results.tests.factories.competitions import CompetitionFactory, CompetitionResultTypeFactory
 from results.tests.factories.results import ResultFactory, ResultPartialFactory
+from results.utils.records import get_categories
 from results.views.records import RecordViewSet
 
 
@@ -247,6 +250,26 @@ class RecordsTestCase(TestCase):
         self.assertEqual(Record.objects.all().count(), 3)
         self.assertEqual(Record.objects.filter(date_end=None).count(), 3)
 
+    @override_settings(CATEGORY_CACHE_TIMEOUT=60*60)
+    def test_record_categories_cached(self):
+        categories = get_categories(self.result)
+        self.assertEqual(set(categories), {self.category_W, self.category_W20})
+        with self.assertNumQueries(0):
+            self.assertEqual(get_categories(self.result), categories)
+
+    def test_record_categories_cache_disabled(self):
+        categories = get_categories(self.result)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(get_categories(self.result), categories)
+        self.assertGreater(len(context), 0)
+
+    @override_settings(CATEGORY_CACHE_TIMEOUT=60*60)
+    def test_record_categories_cache_invalidation(self):
+        get_categories(self.result)
+        self.category_check.record_group = 2
+        self.category_check.save()
+        self.assertEqual(get_categories(self.result), [self.category_W20])
+
     def test_record_access_list(self):
         request = self.factory.get(self.url)
         view = self.viewset.as_view(actions={'get': 'list'})
@@ -1,19 +1,31 @@
+import csv
+import json
+
 from decimal import Decimal
+from unittest.mock import patch
+from urllib.parse import parse_qsl, urlparse
 from datetime import date
 
 from dateutil.relativedelta import relativedelta
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth.models import Group, User
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
 
 from results.models.athletes import AthleteInformation
 from results.models.categories import CategoryForCompetitionType
-from results.models.results import Result, ResultPartial
+from results.models.results import Result, ResultPartial, SeasonResultRank
+from results.serializers.results import ResultSerializer
 from results.tests.factories.athletes import AthleteFactory
-from results.tests.factories.competitions import CompetitionResultTypeFactory
+from results.tests.factories.competitions import CompetitionFactory, CompetitionResultTypeFactory
 from results.tests.factories.results import ResultFactory, ResultPartialFactory
+from results.views.competitions import CompetitionViewSet
 from results.views.results import ResultViewSet, ResultPartialViewSet, ResultList
 
 
@@ -405,6 +417,23 @@ class ResultTestCase(TestCase):
         self.assertEqual(len(response.data['partial']), 1)
         self.assertEqual(response.data['partial'][0]['value'], '15.0')
 
+    def test_result_update_with_partial_change_one_result(self):
+        self.newdata['partial'] = [{"order": order, "type": self.competition_result_type.pk, "value": 10,
+                                    "decimals": 0} for order in range(1, 4)]
+        self._test_update(user=self.superuser, data=self.newdata, locked=True)
+        partials = {partial.order: partial for partial in ResultPartial.objects.filter(result=self.object)}
+        log_entries = LogEntry.objects.filter(content_type__model='resultpartial').count()
+        self.newdata['partial'][1]['value'] = 15
+        response = self._test_update(user=self.superuser, data=self.newdata, locked=True)
+        self.assertEqual([partial['value'] for partial in response.data['partial']], ['10.0', '15.0', '10.0'])
+        for partial in ResultPartial.objects.filter(result=self.object):
+            self.assertEqual(partial.pk, partials[partial.order].pk)
+            if partial.order == 2:
+                self.assertGreater(partial.updated_at, partials[partial.order].updated_at)
+            else:
+                self.assertEqual(partial.updated_at, partials[partial.order].updated_at)
+        self.assertEqual(LogEntry.objects.filter(content_type__model='resultpartial').count(), log_entries + 1)
+
     def test_result_update_with_partial_change_result_too_high(self):
         self.test_result_update_with_partial_result()
         self.newdata['partial'] = [{"order": 1, "type": self.competition_result_type.pk, "value": 550, "decimals": 0}]
@@ -428,6 +457,152 @@ class ResultTestCase(TestCase):
         response = self._test_create(user=self.superuser, data=self.newdata, locked=False)
         self.assertEqual(len(response.data['team_members']), 3)
 
+    def test_result_changed_fields(self):
+        result = Result.objects.get(pk=self.object.pk)
+        self.assertEqual(result.changed_fields, [])
+        first_name = result.first_name
+        result.first_name = 'Changed'
+        result.athlete = self.athlete
+        self.assertEqual(result.diff, {'first_name': (first_name, 'Changed'),
+                                       'athlete': (self.object.athlete.pk, self.athlete.pk)})
+        with self.assertNumQueries(1):
+            result = Result.objects.only('id', 'result').get(pk=self.object.pk)
+            result.result = result.result + 1
+            self.assertEqual(result.changed_fields, ['result'])
+
+    def _test_bulk_create(self, user, data, locked=True):
+        if not locked:
+            self.object.competition.locked = False
+            self.object.competition.save()
+        request = self.factory.post('/api/competitions/%s/results/bulk/' % self.object.competition.pk, data,
+                                    format='json')
+        if user:
+            force_authenticate(request, user=user)
+        view = CompetitionViewSet.as_view(actions={'post': 'results_bulk'})
+        return view(request, pk=self.object.competition.pk)
+
+    def _get_bulk_data(self):
+        athlete = AthleteFactory.create(gender="M", date_of_birth=date.today() - relativedelta(years=19))
+        data = [dict(self.newdata, result=10, result_code='', position=1), dict(
+            self.newdata, athlete=athlete.pk, first_name='', last_name='', result=5, result_code='', position=2)]
+        for item in data:
+            del item['competition']
+            item['partial'] = [{"order": 1, "type": self.competition_result_type.pk, "value": item['result'],
+                                "decimals": 0}]
+        return data, athlete
+
+    def test_result_bulk_create_with_superuser(self):
+        data, athlete = self._get_bulk_data()
+        log_entries = LogEntry.objects.count()
+        response = self._test_bulk_create(user=self.superuser, data=data, locked=True)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.model.objects.filter(competition=self.object.competition).count(), 3)
+        self.assertEqual([result['position'] for result in response.data], [1, 2])
+        self.assertEqual(response.data[1]['last_name'], athlete.last_name)
+        self.assertEqual(response.data[1]['position_pre'], 2)
+        self.assertEqual(response.data[1]['partial'][0]['value'], '5.0')
+        self.assertEqual(ResultPartial.objects.filter(result__in=[result['id'] for result in response.data]).count(),
+                         2)
+        self.assertEqual(LogEntry.objects.count(), log_entries + 4)
+
+    def test_result_bulk_create_without_athletes(self):
+        self.object.category.team = True
+        self.object.category.team_size = 3
+        self.object.category.save()
+        data = []
+        for name, value in [('Team A', 10), ('Team B', 5)]:
+            team_members = [AthleteFactory.create(gender="M", date_of_birth=date.today() - relativedelta(
+                years=19)).pk for i in range(3)]
+            data.append(dict(self.newdata, athlete=None, first_name='', last_name=name, result=value,
+                             result_code='', team=True, team_members=team_members, partial=[
+                                 {"order": 1, "type": self.competition_result_type.pk, "value": value,
+                                  "decimals": 0}]))
+            del data[-1]['competition']
+        response = self._test_bulk_create(user=self.superuser, data=data, locked=True)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        for item in response.data:
+            result = self.model.objects.get(pk=item['id'])
+            self.assertIsNone(result.athlete)
+            self.assertEqual(item['last_name'], result.last_name)
+            self.assertEqual([partial.value for partial in result.partial.all()], [result.result])
+            self.assertEqual(sorted(result.team_members.values_list('pk', flat=True)), sorted(item['team_members']))
+
+    def test_result_bulk_create_single_insert(self):
+        data, athlete = self._get_bulk_data()
+        with CaptureQueriesContext(connection) as context:
+            response = self._test_bulk_create(user=self.superuser, data=data, locked=True)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len([query for query in context.captured_queries if
+                              query['sql'].startswith('INSERT INTO "results_result"')]), 1)
+        for item in response.data:
+            self.assertEqual(self.model.objects.get(pk=item['id']).result, Decimal(item['result']))
+
+    def test_result_bulk_create_concurrent_insert(self):
+        data, athlete = self._get_bulk_data()
+        bulk_create = Result.objects.bulk_create
+        concurrent = []
+
+        def insert_concurrent(results):
+            concurrent.append(ResultFactory.create(competition=self.object.competition, category=self.object.category,
+                                                   athlete=athlete))
+            return bulk_create(results)
+
+        with patch.object(Result.objects, 'bulk_create', side_effect=insert_concurrent):
+            response = self._test_bulk_create(user=self.superuser, data=data, locked=True)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn(concurrent[0].pk, [item['id'] for item in response.data])
+        self.assertEqual([item['position'] for item in response.data], [1, 2])
+        self.assertEqual([item['partial'][0]['value'] for item in response.data], ['10.0', '5.0'])
+
+    def test_result_bulk_validate_queries(self):
+        self.object.competition.level.requirements = 'licence'
+        self.object.competition.level.save()
+        self.object.competition.locked = False
+        self.object.competition.save()
+        queries = []
+        for count in [2, 6]:
+            data = []
+            for i in range(count):
+                athlete = AthleteFactory.create(gender="M", date_of_birth=date.today() - relativedelta(years=19))
+                AthleteInformation.objects.create(athlete=athlete, type='licence', value='1',
+                                                  date_start=self.object.competition.date_start,
+                                                  date_end=self.object.competition.date_end)
+                data.append(dict(self.newdata, athlete=athlete.pk, result=10, result_code='', partial=[
+                    {"order": 1, "type": self.competition_result_type.pk, "value": 10, "decimals": 0}]))
+            request = self.factory.post('/api/competitions/%s/results/bulk/' % self.object.competition.pk)
+            request.user = self.organization_user
+            serializer = ResultSerializer(data=data, many=True, context={'request': request})
+            with CaptureQueriesContext(connection) as context:
+                self.assertTrue(serializer.is_valid(), serializer.errors)
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_result_bulk_create_with_organization_user(self):
+        data, athlete = self._get_bulk_data()
+        response = self._test_bulk_create(user=self.organization_user, data=data, locked=True)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self._test_bulk_create(user=self.organization_user, data=data, locked=False)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_result_bulk_create_with_normal_user(self):
+        data, athlete = self._get_bulk_data()
+        response = self._test_bulk_create(user=self.user, data=data, locked=False)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_result_bulk_create_duplicate(self):
+        data, athlete = self._get_bulk_data()
+        response = self._test_bulk_create(user=self.superuser, data=data + data[:1], locked=True)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.model.objects.all().count(), 1)
+
+    def test_result_bulk_create_invalid_result(self):
+        data, athlete = self._get_bulk_data()
+        data[1]['partial'][0]['value'] = 550
+        response = self._test_bulk_create(user=self.superuser, data=data, locked=True)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[1]['non_field_errors'][0], "A result is too high.")
+        self.assertEqual(self.model.objects.all().count(), 1)
+
 
 class PartialResultTestCase(TestCase):
     def setUp(self):
@@ -687,13 +862,241 @@ class ResultListTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['results']), 2)
 
+    def _get_list(self, params):
+        request = self.factory.get(self.url, params)
+        view = self.viewset.as_view(actions={'get': 'list'})
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
     def test_result_list_search(self):
-        import os
-        if 'TRAVIS' not in os.environ:
-            params = {'sport': 1, 'group_results': 2}
+        response = self._get_list({'sport': 1, 'group_results': 2})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['result'], str(self.result.result + self.result2.result))
+
+    def _get_cursor_pages(self, params):
+        pages = []
+        while params is not None:
+            response = self._get_list(params)
+            pages.append(response.data['results'])
+            params = dict(parse_qsl(urlparse(response.data['next']).query)) if response.data['next'] else None
+        return pages
+
+    def test_result_list_cursor(self):
+        for result in [self.result.result, self.result.result, None]:
+            ResultFactory.create(result=result, category=self.result.category)
+        expected = [result['id'] for result in self._get_list({'limit': 10}).data['results']]
+        response = self._get_list({'limit': 2, 'cursor': '', 'count': 'true'})
+        self.assertEqual(response.data['count'], 5)
+        pages = self._get_cursor_pages({'limit': 2, 'cursor': ''})
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([result['id'] for page in pages for result in page], expected)
+
+    def test_result_list_cursor_group_results(self):
+        ResultFactory.create(result=self.result.result, competition=self.result.competition,
+                             category=self.result.category)
+        params = {'type': self.result.competition.type.pk, 'group_results': 2}
+        expected = self._get_list(params).data['results']
+        pages = self._get_cursor_pages(dict(params, limit=1, cursor=''))
+        self.assertEqual([result for page in pages for result in page], expected)
+
+    def test_result_list_invalid_cursor(self):
+        request = self.factory.get(self.url, {'cursor': 'invalid'})
+        view = self.viewset.as_view(actions={'get': 'list'})
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=60)
+    def test_result_list_cache_disabled_for_authenticated_user(self):
+        cache.clear()
+        params = {'competition': self.result.competition.pk}
+        view = self.viewset.as_view(actions={'get': 'list'})
+        for value in ['1.00', '2.00']:
+            Result.objects.filter(pk=self.result.pk).update(result=value)
             request = self.factory.get(self.url, params)
-            view = self.viewset.as_view(actions={'get': 'list'})
-            response = view(request)
-            self.assertEqual(response.status_code, status.HTTP_200_OK)
-            self.assertEqual(len(response.data['results']), 1)
-            self.assertEqual(response.data['results'][0]['result'], str(self.result.result + self.result2.result))
+            force_authenticate(request, user=self.user)
+            self.assertEqual(view(request).data[0]['result'], value)
+
+    def test_result_list_conditional_get_disabled(self):
+        response = self._get_list({})
+        self.assertNotIn('ETag', response)
+
+    def test_result_list_export_csv(self):
+        response = self._get_list({'format': 'csv', 'limit': 1})
+        rows = list(csv.DictReader(line.decode('utf-8') for line in response.streaming_content))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['last_name'], self.result.athlete.last_name)
+        self.assertEqual({row['result'] for row in rows}, {str(self.result.result), str(self.result2.result)})
+
+    def test_result_list_export_ndjson_group_results(self):
+        response = self._get_list({'format': 'ndjson', 'sport': 1, 'group_results': 2})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['first_name'], self.result.athlete.first_name)
+        self.assertEqual(Decimal(rows[0]['result']), self.result.result + self.result2.result)
+
+    def test_result_list_flat(self):
+        ResultPartialFactory.create(result=self.result)
+        params = {'competition': self.result.competition.pk}
+        expected = self._get_list(params).data[0]
+        with self.assertNumQueries(4):
+            response = self._get_list(dict(params, shape='flat'))
+        result = response.data[0]
+        for key in ['id', 'first_name', 'last_name', 'organization', 'category', 'result', 'position', 'approved']:
+            self.assertEqual(result[key], expected[key])
+        self.assertEqual(result['athlete'], expected['athlete']['id'])
+        self.assertEqual(result['competition'], expected['competition']['id'])
+        self.assertEqual(result['partial'][0]['value'], expected['partial'][0]['value'])
+        self.assertEqual(result['partial'][0]['type'], expected['partial'][0]['type']['id'])
+        self.assertEqual(len(result['record']), len(expected['record']))
+
+    def test_result_list_flat_cursor(self):
+        expected = [result['id'] for result in self._get_list({}).data['results']]
+        pages = self._get_cursor_pages({'shape': 'flat', 'limit': 1, 'cursor': ''})
+        self.assertEqual([result['id'] for page in pages for result in page], expected)
+
+    def test_result_list_group_best_results(self):
+        ResultFactory.create(athlete=self.result.athlete, competition=CompetitionFactory.create(
+            type=self.result.competition.type), category=self.result.category, result=self.result.result + 1)
+        params = {'type': self.result.competition.type.pk, 'category': self.result.category.pk, 'group_results': 2}
+        response = self._get_list(params)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['athlete']['id'], self.result.athlete.pk)
+        best = sorted(Result.objects.filter(
+            category=self.result.category, competition__type=self.result.competition.type).exclude(
+            organization__external=True).values_list('result', flat=True))[-2:]
+        self.assertEqual(response.data['results'][0]['result'], str(sum(best)))
+
+    def test_result_list_group_season_ranks(self):
+        ResultFactory.create(athlete=self.result.athlete, competition=CompetitionFactory.create(
+            type=self.result.competition.type), category=self.result.category, result=self.result.result + 1)
+        params = {'season': self.result.competition.date_start.year, 'type': self.result.competition.type.pk,
+                  'category': self.result.category.pk, 'group_results': 2}
+        expected = self._get_list(params).data
+        with override_settings(SEASON_RESULT_RANKS=True):
+            call_command('rebuildseasonranks', verbosity=0)
+            self.assertEqual(SeasonResultRank.objects.count(), 3)
+            self.assertEqual(self._get_list(params).data, expected)
+            self.result.result = 0
+            self.result.save()
+            self.assertEqual(SeasonResultRank.objects.get(result=self.result).rank, 1)
+            self.assertNotEqual(self._get_list(params).data, expected)
+            self.result.delete()
+            self.assertEqual(SeasonResultRank.objects.count(), 2)
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=60)
+class ResultListCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='tester')
+        log_user = override_settings(DEFAULT_LOG_USER_ID=self.user.pk)
+        log_user.enable()
+        self.addCleanup(log_user.disable)
+        self.factory = APIRequestFactory()
+        self.result = ResultFactory.create(athlete=AthleteFactory.create(
+            gender="M", date_of_birth=date.today() - relativedelta(years=18)))
+        self.url = '/api/resultlist/'
+        self.viewset = ResultList
+        cache.clear()
+
+    def _get_list(self, params):
+        request = self.factory.get(self.url, params)
+        view = self.viewset.as_view(actions={'get': 'list'})
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_result_list_cache(self):
+        other = ResultFactory.create()
+        params = {'competition': self.result.competition.pk}
+        other_params = {'competition': other.competition.pk}
+        self._get_list(params)
+        self._get_list(other_params)
+        with self.assertNumQueries(0):
+            response = self._get_list(params)
+        self.assertEqual(response.data[0]['result'], str(self.result.result))
+        view = self.viewset.as_view(actions={'get': 'list'})
+        with self.assertNumQueries(0):
+            self.assertEqual(view(self.factory.get(self.url, params, HTTP_IF_NONE_MATCH=response['ETag'])).status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+        Result.objects.filter(pk=self.result.pk).update(result=1)
+        self.assertEqual(self._get_list(params).data[0]['result'], str(self.result.result))
+        self.result.refresh_from_db()
+        self.result.save()
+        self.assertEqual(self._get_list(params).data[0]['result'], '1.00')
+        with self.assertNumQueries(0):
+            self._get_list(other_params)
+
+    def test_result_list_cache_invalidated_after_commit(self):
+        params = {'competition': self.result.competition.pk}
+        self._get_list(params)
+        with transaction.atomic():
+            self.result.result = 1
+            self.result.save()
+            with self.assertNumQueries(0):
+                self._get_list(params)
+        self.assertEqual(self._get_list(params).data[0]['result'], '1.00')
+
+    def test_result_list_cache_athlete_change(self):
+        params = {'competition': self.result.competition.pk}
+        self._get_list(params)
+        self.result.athlete.first_name = 'Changed'
+        self.result.athlete.save()
+        with CaptureQueriesContext(connection) as context:
+            self._get_list(params)
+        self.assertGreater(len(context), 0)
+
+    def test_result_list_cache_organization_change(self):
+        params = {'competition': self.result.competition.pk}
+        self._get_list(params)
+        self.result.competition.organization.name = 'Changed'
+        self.result.competition.organization.save()
+        with CaptureQueriesContext(connection) as context:
+            self._get_list(params)
+        self.assertGreater(len(context), 0)
+
+    def test_result_conditional_get(self):
+        view = ResultViewSet.as_view(actions={'get': 'retrieve'})
+        url = '/api/results/%d/' % self.result.pk
+        response = view(self.factory.get(url), pk=self.result.pk)
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('Authorization', response['Vary'])
+        with self.assertNumQueries(0):
+            response = view(self.factory.get(url, HTTP_IF_NONE_MATCH=etag), pk=self.result.pk)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        ResultPartialFactory.create(result=self.result)
+        response = view(self.factory.get(url, HTTP_IF_NONE_MATCH=etag), pk=self.result.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def _get_conditional_list(self, params, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        request = self.factory.get(self.url, params, **headers)
+        force_authenticate(request, user=self.user)
+        return self.viewset.as_view(actions={'get': 'list'})(request)
+
+    def test_result_list_conditional_get_athlete_change(self):
+        params = {'competition': self.result.competition.pk}
+        etag = self._get_conditional_list(params)['ETag']
+        self.assertEqual(self._get_conditional_list(params, etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.result.athlete.first_name = 'Changed'
+        self.result.athlete.save()
+        response = self._get_conditional_list(params, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['athlete']['first_name'], 'Changed')
+
+    def test_result_list_conditional_get_deleted(self):
+        other = ResultFactory.create(competition=self.result.competition)
+        params = {'competition': self.result.competition.pk}
+        etag = self._get_conditional_list(params)['ETag']
+        other.delete()
+        response = self._get_conditional_list(params, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_result_list_conditional_get_user(self):
+        etag = self._get_list({})['ETag']
+        response = self._get_conditional_list({}, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
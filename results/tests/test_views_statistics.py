@@ -4,14 +4,16 @@ import logging
 from datetime import date
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.urls import reverse
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 from rest_framework import status
 
 from results.models.competitions import CompetitionLevel
 from results.tests.factories.competitions import CompetitionFactory
 from results.tests.factories.organizations import OrganizationFactory
 from results.tests.factories.results import ResultFactory
+from results.views.statistics import statistics_pohjolan_malja
 
 
 class StatisticsPohjolanMaljaTestCase(TestCase):
@@ -24,6 +26,7 @@ class StatisticsPohjolanMaljaTestCase(TestCase):
 
     def tearDown(self):
         self.logger.setLevel(self.previous_level)
+        cache.clear()
 
     def test_pohjolanmalja_access_object_without_user(self):
         response = self.client.get(self.url, follow=True)
@@ -68,3 +71,40 @@ class StatisticsPohjolanMaljaTestCase(TestCase):
             }
         ]
         self.assertEqual(response.content.decode(), json.dumps({"results": data}))
+
+
+@override_settings(STATISTICS_CACHE_TIMEOUT=60*60*24)
+class StatisticsCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="superuser", is_staff=True)
+        log_user = override_settings(DEFAULT_LOG_USER_ID=self.user.pk)
+        log_user.enable()
+        self.addCleanup(log_user.disable)
+        level = CompetitionLevel.objects.create(name='SM', abbreviation='SM')
+        self.organization = OrganizationFactory.create(abbreviation="A", name="AN")
+        self.competition = CompetitionFactory.create(level=level, date_start=date(2019, 6, 1),
+                                                     date_end=date(2019, 6, 1), locked=True)
+        ResultFactory.create(organization=self.organization, competition=self.competition, position=2)
+
+    def tearDown(self):
+        cache.clear()
+
+    def _get_points(self):
+        request = RequestFactory().get(reverse('sal-pohjolan-malja', kwargs={'year': 2019}))
+        request.user = self.user
+        return json.loads(statistics_pohjolan_malja(request, year=2019).content.decode())['results']
+
+    def test_pohjolanmalja_closed_year_cached(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(self._get_points()[0]['value'], 7)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get_points()[0]['value'], 7)
+
+    def test_pohjolanmalja_closed_year_cache_invalidation(self):
+        self._get_points()
+        ResultFactory.create(organization=self.organization, competition=self.competition, position=1)
+        with self.assertNumQueries(2):
+            self.assertEqual(self._get_points()[0]['value'], 15)
+        self.organization.name = 'AN2'
+        self.organization.save()
+        self.assertEqual(self._get_points()[0]['organization']['name'], 'AN2')
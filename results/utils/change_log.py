@@ -0,0 +1,152 @@
+import atexit
+import logging
+from contextlib import contextmanager
+from functools import partial
+from queue import Queue
+from threading import Lock, Thread, local
+
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+CHANGE_LOG_BUFFER_SIZE = 1000
+
+_local = local()
+_queue = None
+_queue_lock = Lock()
+
+
+class LogEntryBuffer:
+    """
+    Buffer for change log entries, written when the buffer is full or closed.
+
+    Entries added after the buffer is closed, i.e. from a transaction committed after the buffered block, are
+    written immediately.
+    """
+    def __init__(self):
+        self.entries = []
+        self.closed = False
+
+    def extend(self, entries):
+        """
+        Adds entries to the buffer.
+
+        :param entries: log entries
+        :type entries: list
+        """
+        if self.closed:
+            write_log_entries(entries)
+            return
+        self.entries += entries
+        if len(self.entries) >= CHANGE_LOG_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes buffered entries.
+        """
+        entries, self.entries = self.entries, []
+        if entries:
+            write_log_entries(entries)
+
+    def close(self):
+        """
+        Writes buffered entries and closes the buffer.
+        """
+        self.closed = True
+        self.flush()
+
+
+def _process_log_queue():
+    """
+    Writes log entries from the queue in a background thread. Failed writes are logged, so the thread keeps
+    processing the following entries.
+    """
+    while True:
+        entries = _queue.get()
+        try:
+            close_old_connections()
+            LogEntry.objects.bulk_create(entries)
+        except Exception:
+            logger.exception('Could not write %d change log entries', len(entries))
+        finally:
+            _queue.task_done()
+
+
+def _get_log_queue():
+    """
+    Returns queue for the background writer, starting the writer thread if needed.
+
+    :rtype: Queue
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = Queue()
+            Thread(target=_process_log_queue, name='change-log-writer', daemon=True).start()
+            atexit.register(wait_for_log_writer)
+    return _queue
+
+
+def wait_for_log_writer():
+    """
+    Waits until the background writer has written all queued entries.
+    """
+    if _queue is not None:
+        _queue.join()
+
+
+def write_log_entries(entries):
+    """
+    Writes log entries with a single bulk_create, in a background thread if CHANGE_LOG_MODE is thread.
+
+    :param entries: log entries
+    :type entries: list
+    """
+    if settings.CHANGE_LOG_MODE == 'thread':
+        _get_log_queue().put(entries)
+    else:
+        LogEntry.objects.bulk_create(entries)
+
+
+def add_log_entries(entries):
+    """
+    Adds change log entries.
+
+    Inside :func:`buffered_change_log`, entries are added to the buffer when the current transaction is committed, so
+    entries for rolled back changes are not written. Without a buffer, entries are written in the current transaction,
+    or handed to the background writer when the transaction is committed if CHANGE_LOG_MODE is thread.
+
+    :param entries: log entries
+    :type entries: list
+    """
+    if not entries:
+        return
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is not None:
+        transaction.on_commit(partial(buffer.extend, entries))
+    elif settings.CHANGE_LOG_MODE == 'thread':
+        transaction.on_commit(partial(write_log_entries, entries))
+    else:
+        LogEntry.objects.bulk_create(entries)
+
+
+@contextmanager
+def buffered_change_log():
+    """
+    Collects change log entries written inside the block and writes them with bulk_create at the end of the block,
+    or when CHANGE_LOG_BUFFER_SIZE entries have been collected.
+
+    Nested blocks share the outermost buffer. Entries are written immediately if CHANGE_LOG_MODE is immediate.
+    """
+    if settings.CHANGE_LOG_MODE == 'immediate' or getattr(_local, 'buffer', None) is not None:
+        yield
+        return
+    buffer = _local.buffer = LogEntryBuffer()
+    try:
+        yield
+    finally:
+        _local.buffer = None
+        buffer.close()
@@ -0,0 +1,89 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from rest_framework import renderers
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class _Echo:
+    """
+    Pseudo buffer for the csv writer, returning the written row.
+    """
+    def write(self, value):
+        return value
+
+
+class CSVRenderer(renderers.BaseRenderer):
+    """
+    Renderer for the CSV export format. Lists are streamed with :func:`stream_export`, this is used for other
+    responses, i.e. errors.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, dict):
+            data = {'detail': data}
+        writer = csv.writer(_Echo())
+        return ''.join(writer.writerow([key, value]) for key, value in data.items())
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    """
+    Renderer for the newline delimited JSON export format. Lists are streamed with :func:`stream_export`, this is
+    used for other responses, i.e. errors.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, cls=DjangoJSONEncoder) + '\n'
+
+
+EXPORT_RENDERERS = [CSVRenderer, NDJSONRenderer]
+
+
+def _csv_lines(fields, rows):
+    """
+    Yields CSV lines, starting with a header.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def _ndjson_lines(fields, rows):
+    """
+    Yields JSON objects, one in each line.
+    """
+    for row in rows:
+        yield json.dumps({field: row[field] for field in fields}, cls=DjangoJSONEncoder) + '\n'
+
+
+def stream_export(export_format, fields, rows, filename):
+    """
+    Returns streaming response for the export rows.
+
+    :param export_format: csv or ndjson
+    :param fields: field names, in the column order
+    :param rows: iterable of dicts
+    :param filename: file name without the extension
+    :type export_format: str
+    :type fields: list
+    :type rows: iterable
+    :type filename: str
+    :rtype: StreamingHttpResponse
+    """
+    if export_format == CSVRenderer.format:
+        response = StreamingHttpResponse(_csv_lines(fields, rows), content_type='text/csv; charset=utf-8')
+    else:
+        response = StreamingHttpResponse(_ndjson_lines(fields, rows),
+                                         content_type='application/x-ndjson; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, export_format)
+    return response
@@ -1,15 +1,181 @@
+import json
+
+from base64 import b64decode, b64encode
 from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
 from rest_framework import pagination
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPagePagination(pagination.PageNumberPagination):
     """
     Custom pagination class to use with Vue Bootstrap pagination.
+
+    Cursor pagination is used if the cursor query parameter is given, empty for the first page. Cursor contains
+    the last row's values for the ordering fields, so the next page is filtered by them instead of an offset.
+    Cursor pagination only has next links and result count is only included if requested with the count query
+    parameter.
     """
     page_size_query_param = "limit"
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    invalid_cursor_message = 'Invalid cursor'
+
+    cursor = None
+    next_cursor = None
+    count = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+        return self.paginate_queryset_by_cursor(queryset, request)
+
+    @staticmethod
+    def _get_ordering(queryset):
+        """
+        Returns queryset ordering for the cursor. Relations of model instances are ordered by the key and primary
+        key is added to make the ordering unique, unless queryset returns grouped values.
+
+        :param queryset: queryset
+        :type queryset: QuerySet
+        :return: ordering field names, prefixed with - for descending order
+        :rtype: list
+        """
+        ordering = list(queryset.query.order_by or (queryset.model._meta.ordering if queryset.ordered else []))
+        cursor_ordering = []
+        for field in ordering:
+            name = field.lstrip('-')
+            if not queryset.query.values_select:
+                try:
+                    model_field = queryset.model._meta.get_field(name)
+                    if model_field.many_to_one or model_field.one_to_one:
+                        name = model_field.attname
+                except FieldDoesNotExist:
+                    pass
+            cursor_ordering.append(('-' if field.startswith('-') else '') + name)
+        if queryset.query.group_by is None and not {'pk', 'id', '-pk', '-id'} & set(cursor_ordering):
+            cursor_ordering.append('id' if queryset.query.values_select else 'pk')
+        return cursor_ordering
+
+    @staticmethod
+    def _get_value(row, name):
+        """
+        Returns ordering field value from a model instance or a values row.
+        """
+        if isinstance(row, dict):
+            return row[name]
+        for attribute in name.split('__'):
+            row = getattr(row, attribute)
+            if row is None:
+                break
+        return row
+
+    @staticmethod
+    def _get_cursor_filter(ordering, values):
+        """
+        Returns filter for rows after the cursor values. Null values are ordered as the smallest values.
+
+        :param ordering: ordering field names
+        :param values: cursor values
+        :type ordering: list
+        :type values: list
+        :rtype: Q
+        """
+        cursor_filter = Q(pk__in=[])
+        equal = Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            if field.startswith('-'):
+                after = Q(pk__in=[]) if value is None else Q(**{name + '__lt': value}) | Q(**{name + '__isnull': True})
+            else:
+                after = Q(**{name + '__isnull': False}) if value is None else Q(**{name + '__gt': value})
+            cursor_filter |= equal & after
+            equal &= Q(**{name + '__isnull': True}) if value is None else Q(**{name: value})
+        return cursor_filter
+
+    @staticmethod
+    def _encode_cursor(values):
+        """
+        Encodes cursor values to a cursor string.
+        """
+        values = [str(value) if isinstance(value, (Decimal, date)) else value for value in values]
+        return b64encode(json.dumps(values).encode('ascii')).decode('ascii')
+
+    def _decode_cursor(self, cursor, ordering):
+        """
+        Decodes cursor values from a cursor string.
+        """
+        try:
+            values = json.loads(b64decode(cursor.encode('ascii')).decode('ascii'))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def paginate_queryset_by_cursor(self, queryset, request):
+        """
+        Paginate a queryset by the cursor.
+
+        :param queryset: queryset
+        :param request: request
+        :type queryset: QuerySet
+        :type request: Request
+        :return: rows in the page
+        :rtype: list
+        """
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        self.request = request
+        self.display_page_controls = False
+        self.page = None
+        ordering = self._get_ordering(queryset)
+        queryset = queryset.order_by(*ordering)
+        if request.query_params.get(self.count_query_param, '').lower() in ['1', 'true']:
+            self.count = queryset.count()
+        self.cursor = request.query_params.get(self.cursor_query_param)
+        if self.cursor:
+            try:
+                queryset = queryset.filter(self._get_cursor_filter(ordering, self._decode_cursor(self.cursor,
+                                                                                                  ordering)))
+            except (TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        rows = list(queryset[:page_size + 1])
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_cursor = self._encode_cursor([self._get_value(rows[-1], field.lstrip('-'))
+                                                    for field in ordering])
+        return rows
+
+    def get_next_link(self):
+        if self.page is not None:
+            return super().get_next_link()
+        if not self.next_cursor:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_previous_link(self):
+        if self.page is not None:
+            return super().get_previous_link()
+        return None
 
     def get_paginated_response(self, data):
+        if self.page is None:
+            return Response(OrderedDict([
+                ('next', self.get_next_link()),
+                ('previous', None),
+                ('count', self.count),
+                ('limit', self.get_page_size(self.request)),
+                ('results', data)
+            ]))
         return Response(OrderedDict([
             ('next', self.get_next_link()),
             ('previous', self.get_previous_link()),
@@ -19,3 +185,28 @@ class CustomPagePagination(pagination.PageNumberPagination):
             ('num_page', self.page.paginator.num_pages),
             ('results', data)
         ]))
+
+    def get_schema_fields(self, view):
+        fields = super().get_schema_fields(view)
+        assert coreapi is not None, 'coreapi must be installed to use `get_schema_fields()`'
+        assert coreschema is not None, 'coreschema must be installed to use `get_schema_fields()`'
+        return fields + [
+            coreapi.Field(
+                name=self.cursor_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(
+                    title='Cursor',
+                    description='Use cursor pagination, empty for the first page and next link for following pages.'
+                )
+            ),
+            coreapi.Field(
+                name=self.count_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.Boolean(
+                    title='Count',
+                    description='Include result count in cursor pagination.'
+                )
+            ),
+        ]
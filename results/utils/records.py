@@ -1,17 +1,220 @@
+import weakref
+
+from threading import local
+from uuid import uuid4
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import MultipleObjectsReturned
-from django.db.models import Q
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, OuterRef, Q, Subquery, Window
+from django.utils import timezone
 
+from results.models.athletes import Athlete
 from results.models.categories import Category, CategoryForCompetitionType
-from results.models.records import Record, RecordLevel
+from results.models.competitions import CompetitionType
+from results.models.organizations import Organization
+from results.models.records import Record, RecordCheckQueue, RecordLevel
+from results.models.results import Result, ResultPartial
+from results.utils.response_cache import invalidate_response_cache
+
+CATEGORY_CACHE_VERSION_KEY = 'record_categories_version'
+
+_pending = local()
 
 
-def _get_ages(result):
+class RecordIndex:
     """
-    Returns possible age limits for the athlete or the team of athletes.
+    In-memory index of the standing records.
+
+    Loads all current records once and keys them by (level, type, category, partial result type). Record checks with
+    an index answer from memory instead of querying the database for each record level and category. Index is kept
+    up to date when records are created or deleted through the record check functions.
+
+    Lower unapproved records are removed when a new record is created, so each key holds only a few records.
+
+    :param competition_type: load only records for the competition type
+    :type competition_type: competition type object or id
+    """
+    def __init__(self, competition_type=None):
+        self._records = {}
+        self._keys = {}
+        self._owners = {}
+        records = Record.objects.filter(date_end=None, historical=False)
+        if competition_type:
+            records = records.filter(type=competition_type)
+        records = records.values(
+            'id', 'level_id', 'type_id', 'category_id', 'partial_result_id', 'partial_result__type_id',
+            'partial_result__value', 'result_id', 'result__result', 'result__athlete_id', 'result__organization_id',
+            'result__team', 'approved', 'date_start')
+        team_results = set()
+        for record in records:
+            if record['result__team']:
+                team_results.add(record['result_id'])
+            self._add_entry({
+                'id': record['id'],
+                'key': (record['level_id'], record['type_id'], record['category_id'],
+                        record['partial_result__type_id']),
+                'result': record['result_id'],
+                'partial_result': record['partial_result_id'],
+                'value': (record['partial_result__value'] if record['partial_result_id'] else
+                          record['result__result']),
+                'date_start': record['date_start'],
+                'approved': record['approved'],
+                'athlete': record['result__athlete_id'],
+                'organization': record['result__organization_id'],
+                'team_members': set()
+            })
+        team_members = {}
+        for result_id, athlete_id in Result.team_members.through.objects.filter(
+                result_id__in=team_results).values_list('result_id', 'athlete_id'):
+            team_members.setdefault(result_id, set()).add(athlete_id)
+        for entry in self._records.values():
+            entry['team_members'] = team_members.get(entry['result'], set())
+
+    def _add_entry(self, entry):
+        """
+        Adds an entry to the index, replacing the old entry with the same id.
+
+        :param entry: record entry
+        :type entry: dict
+        """
+        self.discard(entry['id'])
+        self._records[entry['id']] = entry
+        self._keys.setdefault(entry['key'], {})[entry['id']] = entry
+        self._owners.setdefault((entry['result'], entry['partial_result']), set()).add(entry['id'])
+
+    def add(self, record):
+        """
+        Adds a standing record to the index.
+
+        :param record:
+        :type record: record object
+        """
+        if record.date_end or record.historical:
+            self.discard(record.pk)
+            return
+        result = record.result
+        partial = record.partial_result
+        self._add_entry({
+            'id': record.pk,
+            'key': (record.level_id, record.type_id, record.category_id, partial.type_id if partial else None),
+            'result': result.pk,
+            'partial_result': partial.pk if partial else None,
+            'value': partial.value if partial else result.result,
+            'date_start': record.date_start,
+            'approved': record.approved,
+            'athlete': result.athlete_id,
+            'organization': result.organization_id,
+            'team_members': set(result.team_members.values_list('id', flat=True)) if result.team else set()
+        })
+
+    def discard(self, record_id):
+        """
+        Removes an ended or deleted record from the index.
+
+        :param record_id: record id
+        :type record_id: int
+        """
+        entry = self._records.pop(record_id, None)
+        if entry:
+            del self._keys[entry['key']][record_id]
+            self._owners[(entry['result'], entry['partial_result'])].discard(record_id)
+
+    def discard_unapproved(self, result_id, partial_result_id=None):
+        """
+        Removes unapproved records for the result or the partial result from the index.
+
+        :param result_id: result id
+        :param partial_result_id: partial result id, None for base results
+        :type result_id: int
+        :type partial_result_id: int
+        """
+        for record_id in list(self._owners.get((result_id, partial_result_id), ())):
+            if not self._records[record_id]['approved']:
+                self.discard(record_id)
+
+    def discard_lower(self, key, value, date):
+        """
+        Removes unapproved records with lower value, starting from the date, from the index.
+
+        :param key: (level id, type id, category id, partial result type id)
+        :param value: result value
+        :param date: start date
+        :type key: tuple
+        :type value: Decimal
+        :type date: date
+        """
+        for entry in list(self._keys.get(key, {}).values()):
+            if (not entry['approved'] and entry['value'] is not None and entry['value'] < value and
+                    entry['date_start'] >= date):
+                self.discard(entry['id'])
+
+    def beats_record(self, key, value, date, athlete_id=None, organization_id=None, team_member_ids=None):
+        """
+        Checks if the value would be a new record.
+
+        :param key: (level id, type id, category id, partial result type id)
+        :param value: result value
+        :param date: competition date
+        :param athlete_id: athlete id, used for the same value check in personal results
+        :param organization_id: organization id, used for the same value check in team results
+        :param team_member_ids: team member ids, used for the same value check in team results
+        :type key: tuple
+        :type value: Decimal
+        :type date: date
+        :type athlete_id: int
+        :type organization_id: int
+        :type team_member_ids: set
+        :return: True if there is no standing record preventing a new record
+        :rtype: bool
+        """
+        partial = key[3] is not None
+        for entry in self._keys.get(key, {}).values():
+            if entry['value'] is None:
+                continue
+            if settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
+                if entry['date_start'] > date:
+                    continue
+                if entry['value'] > value:
+                    return False
+                if entry['value'] == value:
+                    if team_member_ids is not None:
+                        if entry['organization'] == organization_id and entry['team_members'] & team_member_ids:
+                            return False
+                    elif entry['athlete'] == athlete_id:
+                        return False
+            elif entry['date_start'] < date:
+                if entry['value'] >= value:
+                    return False
+            elif entry['date_start'] == date:
+                if (partial and entry['value'] == value) or (not partial and entry['value'] > value):
+                    return False
+        return True
+
+
+def _get_athletes(result):
+    """
+    Returns the athlete or the team members of the result.
 
     :param result:
     :type result: result object
+    :return: athletes
+    :rtype: list
+    """
+    if result.team:
+        return list(result.team_members.all())
+    return [result.athlete]
+
+
+def _get_ages(date, athletes):
+    """
+    Returns possible age limits for the athlete or the team of athletes.
+
+    :param date: competition date
+    :param athletes:
+    :type date: date
+    :type athletes: list
     :return max_age: youngest age in a team at the time of the competition
     :return min_age: oldest age in a team at the time of the competition
     :rtype max_age: int
@@ -19,13 +222,9 @@ def _get_ages(result):
     """
     max_age = None
     min_age = None
-    if result.team:
-        athletes = result.team_members.all()
-    else:
-        athletes = [result.athlete]
     for athlete in athletes:
         if athlete.date_of_birth:
-            age = (result.competition.date_start.year - athlete.date_of_birth.year)
+            age = (date.year - athlete.date_of_birth.year)
             if not max_age or max_age < age:
                 max_age = age
             if not min_age or min_age > age:
@@ -33,23 +232,19 @@ def _get_ages(result):
     return max_age, min_age
 
 
-def _get_gender(result):
+def _get_gender(athletes):
     """
     Returns possible gender limits for the athlete or the team of athletes.
 
-    :param result:
-    :type result: result object
+    :param athletes:
+    :type athletes: list
     :return: gender code or None
     :rtype: str
     """
     gender_list = []
-    if result.team:
-        for athlete in result.team_members.all():
-            if athlete.gender:
-                gender_list.append(athlete.gender)
-    else:
-        if result.athlete.gender:
-            gender_list.append(result.athlete.gender)
+    for athlete in athletes:
+        if athlete.gender:
+            gender_list.append(athlete.gender)
     if 'M' in gender_list and 'W' not in gender_list:
         gender = 'M'
     elif 'M' not in gender_list and 'W' in gender_list:
@@ -59,31 +254,100 @@ def _get_gender(result):
     return gender
 
 
-def get_categories(result, partial=None):
+def _get_category_cache_version():
     """
-    Returns the list of possible record categories for the result.
+    Returns the current version of the cached record categories.
 
-    :param result:
-    :param partial:
-    :type result: result object
-    :type partial: partial result object
+    :return: cache version, None if cache is disabled
+    :rtype: str
+    """
+    if not settings.CATEGORY_CACHE_TIMEOUT:
+        return None
+    version = cache.get(CATEGORY_CACHE_VERSION_KEY)
+    if version is None:
+        cache.add(CATEGORY_CACHE_VERSION_KEY, uuid4().hex, None)
+        version = cache.get(CATEGORY_CACHE_VERSION_KEY)
+    return version
+
+
+def invalidate_category_cache():
+    """
+    Invalidates all cached record categories. Called when categories or category checks are changed.
+    """
+    cache.set(CATEGORY_CACHE_VERSION_KEY, uuid4().hex, None)
+
+
+def _get_cached(version, key, function):
+    """
+    Returns the cached value for the key or calculates and caches it. Value is calculated without cache if
+    CATEGORY_CACHE_TIMEOUT is 0.
+
+    :param version: cache version
+    :param key: cache key values
+    :param function: function returning the value
+    :type version: str
+    :type key: tuple
+    :type function: function
+    :return: cached value
+    """
+    if not settings.CATEGORY_CACHE_TIMEOUT:
+        return function()
+    cache_key = 'record_categories:%s:%s' % (version, ':'.join(str(value) for value in key))
+    value = cache.get(cache_key)
+    if value is None:
+        value = function()
+        cache.set(cache_key, value, settings.CATEGORY_CACHE_TIMEOUT)
+    return value
+
+
+def _get_category_check(competition_type_id, category_id):
+    """
+    Returns the record check information for the category in the competition type.
+
+    :param competition_type_id:
+    :param category_id:
+    :type competition_type_id: int
+    :type category_id: int
+    :return: check information or False if category has no checks
+    :rtype: dict
+    """
+    check = CategoryForCompetitionType.objects.filter(type=competition_type_id, category=category_id).first()
+    if not check:
+        return False
+    return {
+        'check_record': check.check_record,
+        'check_record_partial': check.check_record_partial,
+        'record_group': check.record_group,
+        'limit_partial': set(check.limit_partial.values_list('id', flat=True))
+    }
+
+
+def _get_group_categories(competition_type, record_group, team, gender, max_age, min_age, team_size):
+    """
+    Returns the list of categories in the record group, allowed for the athlete or team properties.
+
+    :param competition_type:
+    :param record_group:
+    :param team: team result
+    :param gender: gender limit for the athlete or team
+    :param max_age: youngest age in a team at the time of the competition
+    :param min_age: oldest age in a team at the time of the competition
+    :param team_size: number of team members
+    :type competition_type: competition type object
+    :type record_group: int
+    :type team: bool
+    :type gender: str
+    :type max_age: int
+    :type min_age: int
+    :type team_size: int
     :return: categories
-    :rtype: QuerySet
+    :rtype: list
     """
-    check = CategoryForCompetitionType.objects.filter(type=result.competition.type, category=result.category).first()
-    if check and ((not partial and not check.check_record) or (partial and not check.check_record_partial)):
-        return Category.objects.none()
-    if check and partial and check.limit_partial.all() and partial.type in check.limit_partial.all():
-        return Category.objects.none()
-    if not check or not check.record_group:
-        return Category.objects.filter(id=result.category.id)
-    max_age, min_age = _get_ages(result)
-    gender = _get_gender(result)
     categories = Category.objects.all()
     categories = categories.filter(
         Q(gender='') | Q(gender=gender),
-        sport=result.competition.type.sport,
-        team=result.team
+        sport=competition_type.sport,
+        team=team
         )
     if max_age is not None:
         categories = categories.filter(
@@ -93,30 +357,93 @@ def get_categories(result, partial=None):
         categories = categories.filter(
             Q(min_age=None) | Q(min_age__lte=min_age)
         )
-    if result.team:
+    if team:
         categories = categories.filter(
-            Q(team_size=None) | Q(team_size=result.team_members.count())
+            Q(team_size=None) | Q(team_size=team_size)
         )
     categories = categories.filter(categoryforcompetitiontype__in=CategoryForCompetitionType.objects.filter(
-        type=result.competition.type, record_group=check.record_group))
-    return categories
+        type=competition_type, record_group=record_group))
+    return list(categories)
 
 
-def _create_record(result, record_level, category):
+def get_categories(result, partial=None):
+    """
+    Returns the list of possible record categories for the result.
+
+    Category checks and record group categories are cached by the competition type, category and athlete or team
+    properties. Cache is invalidated when categories or category checks are changed.
+
+    :param result:
+    :param partial:
+    :type result: result object
+    :type partial: partial result object
+    :return: categories
+    :rtype: list
+    """
+    version = _get_category_cache_version()
+    competition_type = result.competition.type
+    check = _get_cached(version, ('check', competition_type.pk, result.category_id),
+                        lambda: _get_category_check(competition_type.pk, result.category_id))
+    if check and ((not partial and not check['check_record']) or (partial and not check['check_record_partial'])):
+        return []
+    if check and partial and partial.type_id in check['limit_partial']:
+        return []
+    if not check or not check['record_group']:
+        return [result.category]
+    athletes = _get_athletes(result)
+    max_age, min_age = _get_ages(result.competition.date_start, athletes)
+    gender = _get_gender(athletes)
+    team_size = len(athletes) if result.team else None
+    key = (competition_type.pk, check['record_group'], result.team, gender, max_age, min_age, team_size)
+    return _get_cached(version, ('group',) + key,
+                       lambda: _get_group_categories(competition_type, *key[1:]))
+
+
+def _get_record_levels(result, partial=False):
+    """
+    Returns possible record levels for the result or its partial results.
+
+    :param result:
+    :param partial: return record levels for the partial results
+    :type result: result object
+    :type partial: bool
+    :return: record levels
+    :rtype: QuerySet
+    """
+    record_levels = RecordLevel.objects.filter(
+        Q(area=None) | Q(area__in=result.organization.areas.all()),
+        levels=result.competition.level,
+        types=result.competition.type,
+        historical=False)
+    if partial:
+        return record_levels.filter(partial=True)
+    decimals = True if result.decimals else False
+    if result.team:
+        return record_levels.filter(decimals=decimals, base=True, team=True)
+    return record_levels.filter(decimals=decimals, base=True, personal=True)
+
+
+def _create_record(result, record_level, category, index=None):
     """
     Creates a record for the result. Pass it it already exists.
 
     :param result:
     :param record_level:
     :param category:
+    :param index:
     :type result: result object
     :type record_level: record level object
     :type category: category object
+    :type index: RecordIndex object
     """
     try:
-        Record.objects.get_or_create(result=result, level=record_level,
-                                     type=result.competition.type, category=category,
-                                     date_start=result.competition.date_start)
+        record = Record.objects.get_or_create(result=result, level=record_level,
+                                              type=result.competition.type, category=category,
+                                              date_start=result.competition.date_start)[0]
+        if index is not None:
+            index.discard_lower((record_level.pk, result.competition.type_id, category.pk, None), result.result,
+                                result.competition.date_start)
+            index.add(record)
         Record.objects.filter(approved=False,
                               result__result__lt=result.result,
                               partial_result=None,
@@ -129,21 +456,27 @@ def _create_record(result, record_level, category):
         pass
 
 
-def _create_record_partial(partial, record_level, category):
+def _create_record_partial(partial, record_level, category, index=None):
     """
     Creates a record for the partial result. Pass it it already exists.
 
     :param partial:
     :param record_level:
     :param category:
+    :param index:
     :type partial: partial result object
     :type record_level: record level object
     :type category: category object
+    :type index: RecordIndex object
     """
     try:
-        Record.objects.get_or_create(result=partial.result, partial_result=partial, level=record_level,
-                                     type=partial.result.competition.type, category=category,
-                                     date_start=partial.result.competition.date_start)
+        record = Record.objects.get_or_create(result=partial.result, partial_result=partial, level=record_level,
+                                              type=partial.result.competition.type, category=category,
+                                              date_start=partial.result.competition.date_start)[0]
+        if index is not None:
+            index.discard_lower((record_level.pk, partial.result.competition.type_id, category.pk, partial.type_id),
+                                partial.value, partial.result.competition.date_start)
+            index.add(record)
         Record.objects.filter(approved=False,
                               partial_result__value__lt=partial.value,
                               partial_result__type=partial.type,
@@ -156,27 +489,27 @@ def _create_record_partial(partial, record_level, category):
         pass
 
 
-def check_team_records(result, categories):
+def check_team_records(result, categories, index=None):
     """
     Checks possible records for the team results
 
     :param result:
     :param categories:
+    :param index: check against the record index instead of the database
     :type result: result object
     :type categories: list
+    :type index: RecordIndex object
     """
-    decimals = True if result.decimals else False
-    record_levels = RecordLevel.objects.filter(
-        Q(area=None) | Q(area__in=result.organization.areas.all()),
-        levels=result.competition.level,
-        types=result.competition.type,
-        historical=False,
-        decimals=decimals,
-        base=True,
-        team=True)
+    record_levels = _get_record_levels(result)
+    team_member_ids = set(result.team_members.values_list('id', flat=True)) if index is not None else None
     for record_level in record_levels:
         for category in categories:
-            if settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
+            if index is not None:
+                if index.beats_record((record_level.pk, result.competition.type_id, category.pk, None), result.result,
+                                      result.competition.date_start, organization_id=result.organization_id,
+                                      team_member_ids=team_member_ids):
+                    _create_record(result, record_level, category, index=index)
+            elif settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
                 if not Record.objects.filter(Q(result__result__gt=result.result) |
                                              Q(result__result=result.result,
                                                result__team_members__in=result.team_members.all(),
@@ -195,27 +528,25 @@ def check_team_records(result, categories):
                     _create_record(result, record_level, category)
 
 
-def check_personal_records(result, categories):
+def check_personal_records(result, categories, index=None):
     """
     Checks possible records for the personal results
 
     :param result:
     :param categories:
+    :param index: check against the record index instead of the database
     :type result: result object
     :type categories: list
+    :type index: RecordIndex object
     """
-    decimals = True if result.decimals else False
-    record_levels = RecordLevel.objects.filter(
-        Q(area=None) | Q(area__in=result.organization.areas.all()),
-        levels=result.competition.level,
-        types=result.competition.type,
-        historical=False,
-        decimals=decimals,
-        base=True,
-        personal=True)
+    record_levels = _get_record_levels(result)
     for record_level in record_levels:
         for category in categories:
-            if settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
+            if index is not None:
+                if index.beats_record((record_level.pk, result.competition.type_id, category.pk, None), result.result,
+                                      result.competition.date_start, athlete_id=result.athlete_id):
+                    _create_record(result, record_level, category, index=index)
+            elif settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
                 if not Record.objects.filter(Q(result__result__gt=result.result) |
                                              Q(result__result=result.result, result__athlete=result.athlete),
                                              date_start__lte=result.competition.date_start,
@@ -232,42 +563,50 @@ def check_personal_records(result, categories):
                     _create_record(result, record_level, category)
 
 
-def check_records(result):
+def check_records(result, index=None):
     """
     Checks possible records for the result and creates them if found.
 
     :param result:
+    :param index: check against the record index instead of the database
     :type result: result object
+    :type index: RecordIndex object
     """
     Record.objects.filter(result=result, partial_result=None, approved=False).delete()
+    if index is not None:
+        index.discard_unapproved(result.pk)
     if result.result and result.organization and not result.organization.external:
         allowed_categories = get_categories(result)
         if result.team:
-            check_team_records(result, allowed_categories)
+            check_team_records(result, allowed_categories, index=index)
         else:
-            check_personal_records(result, allowed_categories)
+            check_personal_records(result, allowed_categories, index=index)
 
 
-def check_records_partial(partial):
+def check_records_partial(partial, index=None):
     """
     Checks possible records for the partial result and creates them if found.
 
     :param partial:
+    :param index: check against the record index instead of the database
     :type partial: partial result object
+    :type index: RecordIndex object
     """
     Record.objects.filter(partial_result=partial, partial_result__type=partial.type, approved=False).delete()
+    if index is not None:
+        index.discard_unapproved(partial.result_id, partial_result_id=partial.pk)
     if (partial.type.records and partial.value and partial.result.organization and
             not partial.result.organization.external):
         allowed_categories = get_categories(partial.result, partial=partial)
-        record_levels = RecordLevel.objects.filter(
-            Q(area=None) | Q(area__in=partial.result.organization.areas.all()),
-            levels=partial.result.competition.level,
-            types=partial.result.competition.type,
-            historical=False,
-            partial=True)
+        record_levels = _get_record_levels(partial.result, partial=True)
         for record_level in record_levels:
             for category in allowed_categories:
-                if settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
+                if index is not None:
+                    if index.beats_record((record_level.pk, partial.result.competition.type_id, category.pk,
+                                           partial.type_id), partial.value, partial.result.competition.date_start,
+                                          athlete_id=partial.result.athlete_id):
+                        _create_record_partial(partial, record_level, category, index=index)
+                elif settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
                     if not Record.objects.filter(Q(partial_result__value__gt=partial.value) |
                                                  Q(partial_result__value=partial.value,
                                                    result__athlete=partial.result.athlete),
@@ -285,3 +624,444 @@ def check_records_partial(partial):
                                                  date_end=None, partial_result__type=partial.type, historical=False,
                                                  category=category).exclude(partial_result=None):
                         _create_record_partial(partial, record_level, category)
+
+
+def check_records_for_results(result_ids):
+    """
+    Checks possible records for the results and then their partial results, in the same order as checkrecords.
+
+    :param result_ids: result ids
+    :type result_ids: set
+    """
+    results = Result.objects.filter(pk__in=result_ids).select_related(
+        'athlete', 'competition', 'competition__type', 'organization').order_by('competition__date_start', '-result')
+    for result in results:
+        check_records(result)
+    partials = ResultPartial.objects.filter(result__in=result_ids).select_related(
+        'type', 'result', 'result__athlete', 'result__competition', 'result__competition__type',
+        'result__organization').order_by('result__competition__date_start', '-value')
+    for partial in partials:
+        check_records_partial(partial)
+
+
+class _PendingRecordChecks:
+    """
+    Results waiting for the record check when the transaction is committed.
+    """
+    def __init__(self, result_ids):
+        self.result_ids = set(result_ids)
+
+    def run(self):
+        """
+        Checks records for the pending results and clears the scheduled checks from the thread.
+        """
+        if _get_pending_record_checks() is self:
+            _pending.checks = None
+        result_ids = self.result_ids
+        self.result_ids = set()
+        if result_ids:
+            check_records_for_results(result_ids)
+
+
+def _get_pending_record_checks():
+    """
+    Returns the pending record checks scheduled for the current transaction, or None if checks are not scheduled.
+
+    :rtype: _PendingRecordChecks
+    """
+    reference = getattr(_pending, 'checks', None)
+    return reference() if reference else None
+
+
+def _add_pending_results(result_ids):
+    """
+    Adds results to the record checks run when the current transaction is committed.
+
+    Checks are scheduled with on_commit once per transaction. The thread keeps only a weak reference to the
+    scheduled checks, while the on_commit callback holds the checks. When the transaction is committed the callback
+    is run and released, and when it is rolled back the callback is discarded, so results from a rolled back
+    transaction are not checked and the next transaction schedules new checks.
+
+    :param result_ids: result ids
+    :type result_ids: iterable
+    """
+    checks = _get_pending_record_checks()
+    if checks is not None:
+        checks.result_ids.update(result_ids)
+        return
+    checks = _PendingRecordChecks(result_ids)
+    _pending.checks = weakref.ref(checks)
+    transaction.on_commit(checks.run)
+
+
+def run_pending_record_checks():
+    """
+    Checks records for the results deferred until the transaction commit, without waiting for the commit.
+    """
+    checks = _get_pending_record_checks()
+    if checks is not None:
+        checks.run()
+
+
+def defer_record_check(result_id):
+    """
+    Defers the record check for the result and its partial results.
+
+    If RECORD_CHECK_MODE is queue, result is added to the record check queue, which is processed with the
+    checkrecordqueue management command. Otherwise records are checked when the current transaction is committed.
+
+    :param result_id: result id
+    :type result_id: int
+    """
+    if settings.RECORD_CHECK_MODE == 'queue':
+        RecordCheckQueue.objects.update_or_create(result_id=result_id, defaults={'queued_at': timezone.now()})
+    else:
+        _add_pending_results([result_id])
+
+
+def defer_record_checks(result_ids):
+    """
+    Defers the record checks for multiple results, like :func:`defer_record_check`.
+
+    :param result_ids: result ids
+    :type result_ids: set
+    """
+    if settings.RECORD_CHECK_MODE == 'queue':
+        queued_at = timezone.now()
+        queued = set(RecordCheckQueue.objects.filter(result_id__in=result_ids).values_list('result_id', flat=True))
+        if queued:
+            RecordCheckQueue.objects.filter(result_id__in=queued).update(queued_at=queued_at)
+        RecordCheckQueue.objects.bulk_create([RecordCheckQueue(result_id=result_id, queued_at=queued_at)
+                                              for result_id in result_ids if result_id not in queued])
+    else:
+        _add_pending_results(result_ids)
+
+
+def run_record_check_queue(limit=None):
+    """
+    Checks records for the results in the record check queue and removes them from the queue.
+
+    Results queued again during the check are kept in the queue.
+
+    :param limit: maximum number of results to check
+    :type limit: int
+    :return: number of checked results
+    :rtype: int
+    """
+    queue = list(RecordCheckQueue.objects.order_by('queued_at').values_list('result_id', 'queued_at')[:limit])
+    if not queue:
+        return 0
+    result_ids = {result_id for result_id, queued_at in queue}
+    check_records_for_results(result_ids)
+    RecordCheckQueue.objects.filter(result_id__in=result_ids,
+                                    queued_at__lte=max(queued_at for result_id, queued_at in queue)).delete()
+    return len(queue)
+
+
+def _get_cached_record_levels(row, cache, partial=False):
+    """
+    Returns possible record level ids for the result row, using cache for the results with same competition level,
+    type, organization and result format.
+
+    :param row: result row from _get_result_rows
+    :param cache: record level ids by result properties
+    :param partial: return record levels for the partial results
+    :type row: dict
+    :type cache: dict
+    :type partial: bool
+    :return: record level ids
+    :rtype: list
+    """
+    key = (row['competition__level'], row['competition__type'], row['organization'], bool(row['decimals']),
+           row['team'], partial)
+    if key not in cache:
+        record_levels = RecordLevel.objects.filter(
+            Q(area=None) | Q(area__in=Organization.areas.through.objects.filter(
+                organization_id=row['organization']).values('area_id')),
+            levels=row['competition__level'],
+            types=row['competition__type'],
+            historical=False)
+        if partial:
+            record_levels = record_levels.filter(partial=True)
+        elif row['team']:
+            record_levels = record_levels.filter(decimals=bool(row['decimals']), base=True, team=True)
+        else:
+            record_levels = record_levels.filter(decimals=bool(row['decimals']), base=True, personal=True)
+        cache[key] = list(record_levels.values_list('id', flat=True).distinct())
+    return cache[key]
+
+
+def _get_result_rows(results):
+    """
+    Returns result rows with the record check information of the result's category, joined in the query.
+
+    :param results: results
+    :type results: QuerySet
+    :return: result rows by id
+    :rtype: dict
+    """
+    checks = CategoryForCompetitionType.objects.filter(type=OuterRef('competition__type'),
+                                                       category=OuterRef('category')).order_by('pk')
+    rows = results.annotate(
+        has_check=Exists(checks),
+        check_record=Subquery(checks.values('check_record')[:1]),
+        check_record_partial=Subquery(checks.values('check_record_partial')[:1]),
+        record_group=Subquery(checks.values('record_group')[:1])).values(
+        'id', 'result', 'team', 'decimals', 'category', 'organization', 'competition__type', 'competition__level',
+        'competition__date_start', 'athlete__gender', 'athlete__date_of_birth', 'has_check', 'check_record',
+        'check_record_partial', 'record_group')
+    return {row['id']: row for row in rows.iterator()}
+
+
+def _get_row_categories(row, team_members, competition_types, cache):
+    """
+    Returns possible record category ids for the result row, like :func:`get_categories`.
+
+    Record group categories are queried once for each competition type, record group and athlete or team
+    properties.
+
+    :param row: result row from _get_result_rows
+    :param team_members: team member (gender, date of birth) tuples by result id
+    :param competition_types: competition types by id
+    :param cache: record group category ids by key
+    :type row: dict
+    :type team_members: dict
+    :type competition_types: dict
+    :type cache: dict
+    :return: category ids
+    :rtype: list
+    """
+    if not row['has_check'] or not row['record_group']:
+        return [row['category']]
+    if row['team']:
+        athletes = [Athlete(gender=gender, date_of_birth=date_of_birth) for gender, date_of_birth in
+                    team_members.get(row['id'], [])]
+    else:
+        athletes = [Athlete(gender=row['athlete__gender'], date_of_birth=row['athlete__date_of_birth'])]
+    max_age, min_age = _get_ages(row['competition__date_start'], athletes)
+    key = (row['competition__type'], row['record_group'], row['team'], _get_gender(athletes), max_age, min_age,
+           len(athletes) if row['team'] else None)
+    if key not in cache:
+        cache[key] = [category.pk for category in _get_group_categories(competition_types[key[0]], *key[1:])]
+    return cache[key]
+
+
+def get_record_groups(competition_type=None):
+    """
+    Returns record candidates for each record group.
+
+    Group key is (level id, type id, category id, partial result type id), where partial result type id is None for
+    the base results. Groups with unapproved records are included even if they do not have any candidates.
+
+    Record checks of the result categories are joined in the result query, and team members and partial result
+    limits are loaded with a single query each. Record group categories are queried once for each distinct set of
+    athlete or team properties.
+
+    :param competition_type: limit to the competition type
+    :type competition_type: competition type object
+    :return: candidate result or partial result ids by group key
+    :rtype: dict
+    """
+    groups = {}
+    record_levels = {}
+    categories = {}
+    results = Result.objects.filter(organization__external=False)
+    partials = ResultPartial.objects.filter(result__organization__external=False, type__records=True,
+                                            value__isnull=False)
+    records = Record.objects.filter(approved=False, historical=False)
+    limits = CategoryForCompetitionType.limit_partial.through.objects.all()
+    if competition_type:
+        results = results.filter(competition__type=competition_type)
+        partials = partials.filter(result__competition__type=competition_type)
+        records = records.filter(type=competition_type)
+        limits = limits.filter(categoryforcompetitiontype__type=competition_type)
+    rows = _get_result_rows(results)
+    team_members = {}
+    for result_id, gender, date_of_birth in Result.team_members.through.objects.filter(
+            result__in=results.filter(team=True)).values_list('result_id', 'athlete__gender',
+                                                              'athlete__date_of_birth'):
+        team_members.setdefault(result_id, []).append((gender, date_of_birth))
+    competition_types = CompetitionType.objects.select_related('sport').in_bulk(
+        {row['competition__type'] for row in rows.values()})
+    limit_partial = set(limits.values_list('categoryforcompetitiontype__type', 'categoryforcompetitiontype__category',
+                                           'competitionresulttype'))
+    for row in rows.values():
+        if not row['result'] or (row['has_check'] and not row['check_record']):
+            continue
+        level_ids = _get_cached_record_levels(row, record_levels)
+        if level_ids:
+            for category_id in _get_row_categories(row, team_members, competition_types, categories):
+                for level_id in level_ids:
+                    groups.setdefault((level_id, row['competition__type'], category_id, None), set()).add(row['id'])
+    for partial_id, result_id, type_id, value in partials.values_list('id', 'result', 'type', 'value').iterator():
+        row = rows[result_id]
+        if not value or (row['has_check'] and (not row['check_record_partial'] or (
+                row['competition__type'], row['category'], type_id) in limit_partial)):
+            continue
+        level_ids = _get_cached_record_levels(row, record_levels, partial=True)
+        if level_ids:
+            for category_id in _get_row_categories(row, team_members, competition_types, categories):
+                for level_id in level_ids:
+                    groups.setdefault((level_id, row['competition__type'], category_id, type_id), set()).add(
+                        partial_id)
+    for key in records.values_list('level_id', 'type_id', 'category_id', 'partial_result__type_id').distinct():
+        groups.setdefault(key, set())
+    return groups
+
+
+def _get_progression_rows(ids, partial=False):
+    """
+    Returns results ordered by competition date, including running maximum value by the date.
+
+    Running maximum is calculated with a window function if the database supports it.
+
+    :param ids: result or partial result ids
+    :param partial: ids are partial result ids
+    :type ids: set
+    :type partial: bool
+    :return: result rows
+    :rtype: list
+    """
+    if partial:
+        queryset = ResultPartial.objects.filter(pk__in=ids, value__isnull=False)
+        fields = {'id': 'id', 'result': 'result_id', 'value': 'value', 'date': 'result__competition__date_start',
+                  'athlete': 'result__athlete_id', 'organization': 'result__organization_id', 'team': 'result__team'}
+    else:
+        queryset = Result.objects.filter(pk__in=ids, result__isnull=False)
+        fields = {'id': 'id', 'result': 'id', 'value': 'result', 'date': 'competition__date_start',
+                  'athlete': 'athlete_id', 'organization': 'organization_id', 'team': 'team'}
+    queryset = queryset.order_by(fields['date'], '-' + fields['value'])
+    window = connection.features.supports_over_clause
+    if window:
+        queryset = queryset.annotate(running_max=Window(expression=Max(fields['value']),
+                                                        order_by=F(fields['date']).asc()))
+        fields['running_max'] = 'running_max'
+    rows = [{key: row[field] for key, field in fields.items()} for row in queryset.values(*fields.values())]
+    if not window:
+        # Rows are ordered by the value within a date, so the first row of a date includes the best result of the date
+        running_max = None
+        for row in rows:
+            if running_max is None or row['value'] > running_max:
+                running_max = row['value']
+            row['running_max'] = running_max
+    team_members = {}
+    team_results = [row['result'] for row in rows if row['team']]
+    if team_results and settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
+        for result_id, athlete_id in Result.team_members.through.objects.filter(
+                result_id__in=team_results).values_list('result_id', 'athlete_id'):
+            team_members.setdefault(result_id, set()).add(athlete_id)
+    for row in rows:
+        row['team_members'] = team_members.get(row['result'], set())
+    return rows
+
+
+def _same_holder(row, holder):
+    """
+    Checks if the result is by the same athlete or team as the record holder.
+
+    :param row: result row
+    :param holder: record holder row
+    :type row: dict
+    :type holder: dict
+    :rtype: bool
+    """
+    if row['team']:
+        return row['organization'] == holder['organization'] and bool(row['team_members'] & holder['team_members'])
+    return row['athlete'] == holder['athlete']
+
+
+def _record_progression(rows, partial=False):
+    """
+    Yields the rows which were records at the time of the competition.
+
+    Row is a record if it is the best result of the competition date and better than the results before that date.
+    If CREATE_RECORD_FOR_SAME_RESULT_VALUE is set, result equal to the previous record is a new record unless it is by
+    the same athlete or team.
+
+    Partial results follow :func:`check_records_partial`: without CREATE_RECORD_FOR_SAME_RESULT_VALUE, every value
+    better than the results before the date is a record, also if there is a better value on the same date. Only the
+    first of the equal values on the same date is a record.
+
+    :param rows: result rows from _get_progression_rows
+    :param partial: rows are partial results
+    :type rows: list
+    :type partial: bool
+    """
+    prior_max = None
+    running_max = None
+    date = None
+    best = None
+    holders = []
+    date_values = set()
+    for row in rows:
+        if row['date'] != date:
+            prior_max = running_max
+            date = row['date']
+            date_values = set()
+        running_max = row['running_max']
+        if settings.CREATE_RECORD_FOR_SAME_RESULT_VALUE:
+            if row['value'] != running_max:
+                continue
+            if best is not None and row['value'] == best:
+                if any(_same_holder(row, holder) for holder in holders):
+                    continue
+            else:
+                best = row['value']
+                holders = []
+            holders.append(row)
+            yield row
+        elif partial:
+            if (prior_max is None or row['value'] > prior_max) and row['value'] not in date_values:
+                date_values.add(row['value'])
+                yield row
+        elif row['value'] == running_max and (prior_max is None or row['value'] > prior_max):
+            yield row
+
+
+def rebuild_record_group(key, candidates):
+    """
+    Rebuilds unapproved records for the record group from the candidates.
+
+    Unapproved records are removed and the record progression is calculated from the candidates and standing
+    approved records. New records are created with bulk_create in a single transaction, and cached responses for
+    their competitions are invalidated. Approved records are not changed.
+
+    Partial results follow the progression rules of :func:`check_records_partial`. Standing approved records are
+    ordered before the candidates with the same date and value, as they already hold the record.
+
+    :param key: (level id, type id, category id, partial result type id)
+    :param candidates: result ids, or partial result ids for the partial result groups
+    :type key: tuple
+    :type candidates: set
+    :return: number of created and deleted records
+    :rtype: tuple
+    """
+    level_id, type_id, category_id, partial_type_id = key
+    records = Record.objects.filter(level_id=level_id, type_id=type_id, category_id=category_id, historical=False)
+    if partial_type_id:
+        records = records.filter(partial_result__type_id=partial_type_id)
+        field = 'partial_result_id'
+    else:
+        records = records.filter(partial_result=None)
+        field = 'result_id'
+    approved = set(records.filter(approved=True).values_list(field, flat=True))
+    standing = set(records.filter(approved=True, date_end=None).values_list(field, flat=True))
+    rows = sorted(_get_progression_rows(candidates | standing, partial=bool(partial_type_id)),
+                  key=lambda row: (row['date'], -row['value'], row['id'] not in standing))
+    new_records = []
+    for row in _record_progression(rows, partial=bool(partial_type_id)):
+        if row['id'] in candidates and row['id'] not in approved:
+            new_records.append(Record(result_id=row['result'],
+                                      partial_result_id=row['id'] if partial_type_id else None,
+                                      level_id=level_id,
+                                      type_id=type_id,
+                                      category_id=category_id,
+                                      date_start=row['date']))
+    with transaction.atomic():
+        deleted = records.filter(approved=False).delete()[0]
+        Record.objects.bulk_create(new_records)
+        if new_records:
+            invalidate_response_cache(competitions=Result.objects.filter(
+                pk__in={record.result_id for record in new_records}).values_list('competition', flat=True),
+                types=[type_id])
+    return len(new_records), deleted
@@ -0,0 +1,159 @@
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.translation import get_language
+
+from results.models.competitions import Competition, CompetitionType
+from results.models.results import Result
+
+RESPONSE_CACHE_VERSION_KEY = 'response_cache_version'
+
+
+def _get_version_key(scope=None, value=None):
+    """
+    Returns cache key for the response cache version of a scope.
+
+    :param scope: scope name: competition, type or sport, None for all responses
+    :param value: scope object id
+    :type scope: str
+    :type value: int
+    :rtype: str
+    """
+    if scope is None:
+        return RESPONSE_CACHE_VERSION_KEY
+    return '%s:%s:%s' % (RESPONSE_CACHE_VERSION_KEY, scope, value)
+
+
+def _get_versions(version_keys):
+    """
+    Returns response cache versions, creating missing ones.
+
+    :param version_keys: version cache keys
+    :type version_keys: list
+    :return: versions in the same order as keys
+    :rtype: list
+    """
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            cache.add(key, uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in version_keys]
+
+
+def get_request_scopes(request, scope_params):
+    """
+    Returns scopes the response is limited to by the query parameters.
+
+    :param request: request
+    :param scope_params: scope names by query parameter
+    :type request: Request
+    :type scope_params: dict
+    :return: list of (scope, value) tuples
+    :rtype: list
+    :raises ValueError: if a scope value is not an integer
+    """
+    scopes = []
+    for param, scope in scope_params.items():
+        values = request.query_params.get(param, None)
+        if values:
+            scopes += [(scope, int(value)) for value in values.split(',')]
+    return scopes
+
+
+def get_response_versions(scopes):
+    """
+    Returns response cache versions for the scopes.
+
+    :param scopes: list of (scope, value) tuples, empty if response is not limited to any scope
+    :type scopes: list
+    :return: versions
+    :rtype: list
+    """
+    if scopes:
+        version_keys = [_get_version_key(scope, value) for scope, value in sorted(scopes)]
+    else:
+        version_keys = [_get_version_key()]
+    return _get_versions(version_keys)
+
+
+def get_response_cache_key(name, request, scopes):
+    """
+    Returns cache key for the response, based on normalized query parameters and the versions of the scopes
+    the response is limited to.
+
+    :param name: view name
+    :param request: request
+    :param scopes: list of (scope, value) tuples, empty if response is not limited to any scope
+    :type name: str
+    :type request: Request
+    :type scopes: list
+    :rtype: str
+    """
+    params = sorted((key, value) for key in request.query_params for value in request.query_params.getlist(key))
+    key = '%s|%s|%s|%s|%s' % (request.get_host(), get_language(), request.accepted_renderer.format, params,
+                              get_response_versions(scopes))
+    return 'response:%s:%s' % (name, md5(key.encode('utf-8')).hexdigest())
+
+
+def _get_competitions(athletes=(), organizations=()):
+    """
+    Returns competitions with results for the athletes or organizations, or organized by the organizations.
+
+    :param athletes: athlete ids
+    :param organizations: organization ids
+    :type athletes: iterable
+    :type organizations: iterable
+    :return: competition ids
+    :rtype: set
+    """
+    competitions = set()
+    athletes = [athlete for athlete in athletes if athlete]
+    organizations = [organization for organization in organizations if organization]
+    if athletes:
+        competitions.update(Result.objects.filter(athlete__in=athletes).order_by().values_list(
+            'competition', flat=True).distinct())
+        competitions.update(Result.objects.filter(team_members__in=athletes).order_by().values_list(
+            'competition', flat=True).distinct())
+    if organizations:
+        competitions.update(Result.objects.filter(organization__in=organizations).order_by().values_list(
+            'competition', flat=True).distinct())
+        competitions.update(Competition.objects.filter(organization__in=organizations).values_list('pk', flat=True))
+    return competitions
+
+
+def invalidate_response_cache(competitions=(), types=(), athletes=(), organizations=()):
+    """
+    Invalidates cached responses for the competitions and competition types, including their sports. Changes to
+    athletes and organizations invalidate the competitions they have results in or have organized.
+
+    Responses not limited to any scope are always invalidated.
+
+    Versions are renewed after the current transaction is committed, so responses cached by concurrent requests
+    before the commit are not kept.
+
+    :param competitions: competition ids
+    :param types: competition type ids
+    :param athletes: athlete ids
+    :param organizations: organization ids
+    :type competitions: iterable
+    :type types: iterable
+    :type athletes: iterable
+    :type organizations: iterable
+    """
+    if not settings.RESPONSE_CACHE_TIMEOUT:
+        return
+    competitions = {competition for competition in competitions if competition}
+    competitions.update(_get_competitions(athletes=athletes, organizations=organizations))
+    types = {competition_type for competition_type in types if competition_type}
+    if competitions:
+        types.update(Competition.objects.filter(pk__in=competitions).values_list('type', flat=True))
+    sports = set(CompetitionType.objects.filter(pk__in=types).values_list('sport', flat=True)) if types else set()
+    version_keys = [_get_version_key()]
+    version_keys += [_get_version_key('competition', value) for value in competitions]
+    version_keys += [_get_version_key('type', value) for value in types]
+    version_keys += [_get_version_key('sport', value) for value in sports]
+    transaction.on_commit(lambda: cache.set_many({key: uuid4().hex for key in version_keys}, None))
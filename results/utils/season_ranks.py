@@ -0,0 +1,137 @@
+from django.db import transaction
+from django.db.models import Count, IntegerField, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from results.models.results import Result, SeasonResultRank
+
+
+def group_best_results(queryset, count):
+    """
+    Groups results by athlete, summing the best results.
+
+    Athlete's results are ranked with a subquery counting the better results in the same queryset, so all filters
+    apply to the ranking too. Ties are ranked by result id.
+
+    :param queryset: filtered results
+    :param count: number of best results summed
+    :type queryset: QuerySet
+    :type count: int
+    :return: rows with athlete, group_id and group_result, best first
+    :rtype: QuerySet
+    """
+    results = queryset.filter(athlete__isnull=False, result__isnull=False)
+    better = results.filter(athlete=OuterRef('athlete')).filter(
+        Q(result__gt=OuterRef('result')) | Q(result=OuterRef('result'), pk__lt=OuterRef('pk'))).order_by().values(
+        'athlete').annotate(count=Count('pk')).values('count')
+    return results.annotate(rank=Coalesce(Subquery(better, output_field=IntegerField()), 0)).filter(
+        rank__lt=count).order_by().values('athlete').annotate(
+        group_id=Min('pk'), group_result=Sum('result')).order_by('-group_result', 'athlete')
+
+
+def group_season_ranks(season, competition_type, category, count):
+    """
+    Groups results by athlete from the season result ranks, summing the best results.
+
+    Returns same rows as :func:`group_best_results` for the season's results, excluding external organizations.
+
+    :param season: season, year of the competition start
+    :param competition_type: competition type id
+    :param category: category id
+    :param count: number of best results summed
+    :type season: int
+    :type competition_type: int
+    :type category: int
+    :type count: int
+    :return: rows with athlete, group_id and group_result, best first
+    :rtype: QuerySet
+    """
+    return SeasonResultRank.objects.filter(
+        season=season, type=competition_type, category=category, rank__lt=count).order_by().values(
+        'athlete').annotate(group_id=Min('result'), group_result=Sum('value')).order_by('-group_result', 'athlete')
+
+
+def _get_ranked_results():
+    """
+    Returns results included in the season result ranks.
+
+    :rtype: QuerySet
+    """
+    return Result.objects.filter(athlete__isnull=False, result__isnull=False).exclude(organization__external=True)
+
+
+def _create_ranks(key, results):
+    """
+    Creates ranks for the athlete's results in a season, competition type and category.
+
+    :param key: season, competition type id, category id and athlete id
+    :param results: result id and value pairs
+    :type key: tuple
+    :type results: list
+    :return: unsaved season result ranks
+    :rtype: list
+    """
+    season, competition_type, category, athlete = key
+    return [SeasonResultRank(season=season, type_id=competition_type, category_id=category, athlete_id=athlete,
+                             result_id=result_id, value=value, rank=rank)
+            for rank, (result_id, value) in enumerate(sorted(results, key=lambda x: (-x[1], x[0])))]
+
+
+def get_season_rank_keys(result):
+    """
+    Returns season rank keys the result affects, including keys it is currently ranked in.
+
+    :param result: result
+    :type result: Result
+    :return: set of (season, competition type id, category id, athlete id)
+    :rtype: set
+    """
+    keys = set(SeasonResultRank.objects.filter(result=result).values_list('season', 'type', 'category', 'athlete'))
+    if result.athlete_id and result.result is not None and not (result.organization and
+                                                                 result.organization.external):
+        keys.add((result.competition.date_start.year, result.competition.type_id, result.category_id,
+                  result.athlete_id))
+    return keys
+
+
+def update_season_ranks(key):
+    """
+    Updates the athlete's result ranks in a season, competition type and category.
+
+    :param key: season, competition type id, category id and athlete id
+    :type key: tuple
+    """
+    season, competition_type, category, athlete = key
+    results = list(_get_ranked_results().filter(
+        competition__date_start__year=season, competition__type=competition_type, category=category,
+        athlete=athlete).values_list('pk', 'result'))
+    with transaction.atomic():
+        SeasonResultRank.objects.filter(season=season, type=competition_type, category=category,
+                                        athlete=athlete).delete()
+        SeasonResultRank.objects.bulk_create(_create_ranks(key, results))
+
+
+def rebuild_season_ranks(season=None):
+    """
+    Rebuilds season result ranks.
+
+    :param season: limit to season
+    :type season: int
+    :return: number of ranked results
+    :rtype: int
+    """
+    results = _get_ranked_results()
+    ranks = SeasonResultRank.objects.all()
+    if season:
+        results = results.filter(competition__date_start__year=season)
+        ranks = ranks.filter(season=season)
+    groups = {}
+    for pk, athlete, category, competition_type, date_start, value in results.values_list(
+            'pk', 'athlete', 'category', 'competition__type', 'competition__date_start', 'result').iterator():
+        groups.setdefault((date_start.year, competition_type, category, athlete), []).append((pk, value))
+    new_ranks = []
+    for key, values in groups.items():
+        new_ranks += _create_ranks(key, values)
+    with transaction.atomic():
+        ranks.delete()
+        SeasonResultRank.objects.bulk_create(new_ranks, batch_size=1000)
+    return len(new_ranks)
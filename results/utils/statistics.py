@@ -0,0 +1,121 @@
+from datetime import date
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Sum, Value, When
+
+from results.models.competitions import Competition
+from results.models.results import Result
+
+STATISTICS_CACHE_VERSION_KEY = 'statistics_version'
+
+
+def _get_statistics_cache_version():
+    """
+    Returns the current version of the cached statistics.
+
+    :return: cache version
+    :rtype: str
+    """
+    version = cache.get(STATISTICS_CACHE_VERSION_KEY)
+    if version is None:
+        cache.add(STATISTICS_CACHE_VERSION_KEY, uuid4().hex, None)
+        version = cache.get(STATISTICS_CACHE_VERSION_KEY)
+    return version
+
+
+def invalidate_statistics_cache():
+    """
+    Invalidates all cached statistics. Called when results, competitions or organizations are changed.
+    """
+    cache.set(STATISTICS_CACHE_VERSION_KEY, uuid4().hex, None)
+
+
+class PointsTable:
+    """
+    Organization points table calculated from the result positions.
+
+    Points are summed in the database with a single query, grouped by organization. Tables for closed years, i.e.
+    past years without unlocked competitions, are cached for STATISTICS_CACHE_TIMEOUT seconds. Cache is
+    invalidated when results, competitions or organizations are changed.
+
+    :param name: table name, used in the cache key
+    :param points: points by position
+    :param levels: competition level abbreviations, all levels if empty
+    :type name: str
+    :type points: dict
+    :type levels: list
+    """
+    def __init__(self, name, points, levels=()):
+        self.name = name
+        self.points = points
+        self.levels = levels
+
+    def get_queryset(self, year):
+        """
+        :param year: calendar year
+        :type year: int
+        :return: results counted for the year
+        :rtype: QuerySet
+        """
+        results = Result.objects.filter(competition__date_start__year=year, position__in=self.points,
+                                        organization__isnull=False)
+        if self.levels:
+            results = results.filter(competition__level__abbreviation__in=self.levels)
+        return results
+
+    def calculate(self, year):
+        """
+        Calculates points for the year.
+
+        :param year: calendar year
+        :type year: int
+        :return: organizations and points, highest first
+        :rtype: list
+        """
+        points = Sum(Case(*[When(position=position, then=Value(value)) for position, value in self.points.items()],
+                          default=Value(0), output_field=IntegerField()))
+        rows = self.get_queryset(year).order_by().values(
+            'organization', 'organization__name', 'organization__abbreviation').annotate(value=points).order_by(
+            '-value', 'organization__name')
+        return [{
+            'organization': {
+                'id': row['organization'],
+                'name': row['organization__name'],
+                'abbreviation': row['organization__abbreviation']
+            },
+            'value': row['value']
+        } for row in rows]
+
+    def is_closed(self, year):
+        """
+        :param year: calendar year
+        :type year: int
+        :return: True if the year has ended and its competitions are locked
+        :rtype: bool
+        """
+        if year >= date.today().year:
+            return False
+        competitions = Competition.objects.filter(date_start__year=year, locked=False)
+        if self.levels:
+            competitions = competitions.filter(level__abbreviation__in=self.levels)
+        return not competitions.exists()
+
+    def get(self, year):
+        """
+        Returns points for the year, from the cache for closed years.
+
+        :param year: calendar year
+        :type year: int
+        :return: organizations and points, highest first
+        :rtype: list
+        """
+        if not settings.STATISTICS_CACHE_TIMEOUT or not self.is_closed(year):
+            return self.calculate(year)
+        key = 'points_table:%s:%s:%s' % (_get_statistics_cache_version(), self.name, year)
+        data = cache.get(key)
+        if data is None:
+            data = self.calculate(year)
+            cache.set(key, data, settings.STATISTICS_CACHE_TIMEOUT)
+        return data
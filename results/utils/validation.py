@@ -0,0 +1,216 @@
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.serializers import ListSerializer
+
+from results.models.athletes import Athlete, AthleteInformation
+from results.models.categories import CategoryForCompetitionType
+from results.models.competitions import Competition, CompetitionResultType
+from results.models.results import Result
+
+RESULT_VALIDATION_CONTEXT_KEY = 'result_validation'
+
+
+class ResultValidationContext:
+    """
+    Shared lookups for the result validation.
+
+    Stored in the serializer context, so it is shared by all results validated in a request, i.e. results in the
+    bulk create. User's groups, category limits for a competition type, existing entries and athlete information for
+    a competition are each loaded once. Related objects may be preloaded with a single query per field.
+
+    :param user: request user
+    :type user: User
+    """
+    _SELECT_RELATED = {
+        Athlete: ['organization'],
+        Competition: ['level', 'organization', 'type'],
+        CompetitionResultType: ['competition_type'],
+    }
+
+    def __init__(self, user):
+        self.user = user
+        self._group_ids = None
+        self._category_checks = {}
+        self._entries = {}
+        self._information = {}
+        self._objects = {}
+        self._athlete_ids = set()
+
+    @classmethod
+    def get(cls, context):
+        """
+        Returns validation context from the serializer context, creating it if needed.
+
+        :param context: serializer context
+        :type context: dict
+        :rtype: ResultValidationContext
+        """
+        if RESULT_VALIDATION_CONTEXT_KEY not in context:
+            context[RESULT_VALIDATION_CONTEXT_KEY] = cls(context['request'].user)
+        return context[RESULT_VALIDATION_CONTEXT_KEY]
+
+    @staticmethod
+    def _get_pks(values):
+        """
+        Returns integer primary keys from the input values, ignoring invalid values.
+        """
+        pks = set()
+        for value in values:
+            try:
+                pks.add(int(value))
+            except (TypeError, ValueError):
+                pass
+        return pks
+
+    def preload(self, field_name, queryset, values):
+        """
+        Loads related objects for a field with a single query.
+
+        :param field_name: field name, objects are shared only within the field
+        :param queryset: field's queryset
+        :param values: primary key values in the input data
+        :type field_name: str
+        :type queryset: QuerySet
+        :type values: iterable
+        """
+        pks = self._get_pks(values)
+        model = queryset.model
+        if model in self._SELECT_RELATED:
+            queryset = queryset.select_related(*self._SELECT_RELATED[model])
+        self._objects.setdefault((field_name, model), {}).update(queryset.in_bulk(pks))
+        if model == Athlete:
+            self._athlete_ids.update(pks)
+
+    def get_object(self, field_name, model, value):
+        """
+        Returns preloaded object or None if object is not preloaded.
+
+        :param field_name: field name
+        :param model: related model
+        :param value: primary key value in the input data
+        :type field_name: str
+        :type model: Model
+        :type value: int or str
+        """
+        pks = self._get_pks([value])
+        if not pks or (field_name, model) not in self._objects:
+            return None
+        return self._objects[(field_name, model)].get(pks.pop(), None)
+
+    @property
+    def group_ids(self):
+        """
+        :return: ids of the user's groups
+        :rtype: set
+        """
+        if self._group_ids is None:
+            self._group_ids = set(self.user.groups.values_list('pk', flat=True))
+        return self._group_ids
+
+    def get_category_check(self, category, competition_type):
+        """
+        Returns category settings for the competition type or None if not set.
+
+        :param category: category
+        :param competition_type: competition type
+        :type category: Category
+        :type competition_type: CompetitionType
+        :rtype: CategoryForCompetitionType
+        """
+        if competition_type.pk not in self._category_checks:
+            checks = {}
+            for check in CategoryForCompetitionType.objects.filter(type=competition_type):
+                checks.setdefault(check.category_id, check)
+            self._category_checks[competition_type.pk] = checks
+        return self._category_checks[competition_type.pk].get(category.pk, None)
+
+    def entry_exists(self, competition, category, athlete=None, last_name=None):
+        """
+        Returns True if the competition has a result for the athlete, or a team result with the name, in the category.
+
+        :param competition: competition
+        :param category: category
+        :param athlete: athlete, used for individual results
+        :param last_name: team name, used for team results
+        :type competition: Competition
+        :type category: Category
+        :type athlete: Athlete
+        :type last_name: str
+        :rtype: bool
+        """
+        if competition.pk not in self._entries:
+            entries = set()
+            for category_id, athlete_id, name in Result.objects.filter(competition=competition).values_list(
+                    'category', 'athlete', 'last_name'):
+                entries.add((category_id, athlete_id, None))
+                entries.add((category_id, None, name))
+            self._entries[competition.pk] = entries
+        if category.team:
+            return (category.pk, None, last_name) in self._entries[competition.pk]
+        return (category.pk, athlete.pk if athlete else None, None) in self._entries[competition.pk]
+
+    @staticmethod
+    def get_requirements(competition):
+        """
+        Returns competition level and type requirements, i.e. licence.
+
+        :param competition: competition
+        :type competition: Competition
+        :return: requirement information types
+        :rtype: list
+        """
+        requirements = []
+        for requirement in competition.type.requirements.split(',') + competition.level.requirements.split(','):
+            if requirement.strip() and requirement.strip() not in requirements:
+                requirements.append(requirement.strip())
+        return requirements
+
+    def get_athlete_information(self, competition, athletes):
+        """
+        Returns athletes' information types valid at the competition start, limited to the competition's
+        requirements. Information is loaded for all preloaded athletes at once.
+
+        :param competition: competition
+        :param athletes: athletes
+        :type competition: Competition
+        :type athletes: list
+        :return: dict of athlete ids and sets of information types
+        :rtype: dict
+        """
+        information = self._information.setdefault(competition.pk, {})
+        missing = {athlete.pk for athlete in athletes if athlete.pk not in information}
+        if missing:
+            missing.update(self._athlete_ids - set(information))
+            for athlete_id in missing:
+                information[athlete_id] = set()
+            for athlete_id, information_type in AthleteInformation.objects.filter(
+                    athlete__in=missing, type__in=self.get_requirements(competition),
+                    date_start__lte=competition.date_start, date_end__gte=competition.date_start).values_list(
+                    'athlete', 'type'):
+                information[athlete_id].add(information_type)
+        return {athlete.pk: information[athlete.pk] for athlete in athletes}
+
+
+def preload_related_objects(serializer, rows, validation):
+    """
+    Preloads related objects for the serializer's primary key related fields, including nested list serializers.
+
+    :param serializer: serializer
+    :param rows: input data
+    :param validation: validation context
+    :type serializer: Serializer
+    :type rows: list
+    :type validation: ResultValidationContext
+    """
+    rows = [row for row in rows if isinstance(row, dict)]
+    for field_name, field in serializer.fields.items():
+        values = [row[field_name] for row in rows if field_name in row]
+        if field.read_only or not values:
+            continue
+        if isinstance(field, ListSerializer):
+            preload_related_objects(field.child, [item for value in values if isinstance(value, list)
+                                                  for item in value], validation)
+        elif isinstance(field, ManyRelatedField) and isinstance(field.child_relation, PrimaryKeyRelatedField):
+            validation.preload(field_name, field.child_relation.get_queryset(), [
+                item for value in values if isinstance(value, list) for item in value])
+        elif isinstance(field, PrimaryKeyRelatedField):
+            validation.preload(field_name, field.get_queryset(), values)
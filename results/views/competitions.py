@@ -4,15 +4,21 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.vary import vary_on_cookie
 
 from django_filters import rest_framework as filters
+from drf_yasg.utils import swagger_auto_schema
 from dry_rest_permissions.generics import DRYPermissions
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.filters import SearchFilter
+from rest_framework.response import Response
 
+from results.mixins.conditional_get import ConditionalGetMixin
+from results.mixins.response_cache import ResponseCacheMixin
 from results.models.competitions import Competition, CompetitionLevel, CompetitionType, CompetitionResultType
 from results.models.competitions import CompetitionLayout
 from results.serializers.competitions import CompetitionSerializer, CompetitionLevelSerializer
 from results.serializers.competitions import CompetitionTypeSerializer, CompetitionResultTypeSerializer
 from results.serializers.competitions import CompetitionLayoutSerializer
+from results.serializers.results import ResultSerializer
 from results.utils.pagination import CustomPagePagination
 
 
@@ -36,7 +42,7 @@ class CompetitionFilter(filters.FilterSet):
         fields = ['end', 'event', 'level', 'organization', 'public', 'sport', 'start', 'trial', 'type', 'approved']
 
 
-class CompetitionViewSet(viewsets.ModelViewSet):
+class CompetitionViewSet(ResponseCacheMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint for competitions.
 
@@ -57,6 +63,9 @@ class CompetitionViewSet(viewsets.ModelViewSet):
 
     destroy:
     Removes the given competition.
+
+    results_bulk:
+    Creates results for the given competition from a list of results.
     """
     permission_classes = (DRYPermissions,)
     pagination_class = CustomPagePagination
@@ -66,6 +75,7 @@ class CompetitionViewSet(viewsets.ModelViewSet):
                        SearchFilter]
     filterset_class = CompetitionFilter
     search_fields = ('name', 'organization__name', 'organization__abbreviation')
+    _RESPONSE_CACHE_SCOPES = {'type': 'type', 'sport': 'sport'}
 
     def get_queryset(self):
         """
@@ -82,6 +92,24 @@ class CompetitionViewSet(viewsets.ModelViewSet):
         self.queryset = self.get_serializer_class().setup_eager_loading(self.queryset)
         return self.queryset
 
+    @swagger_auto_schema(request_body=ResultSerializer(many=True), responses={201: ResultSerializer(many=True)})
+    @action(detail=True, methods=['post'], url_path='results/bulk')
+    def results_bulk(self, request, pk=None):
+        """
+        Creates results for the competition, i.e. a result sheet from scoring software.
+
+        Competition is set to each result. All results are validated before any are created and created in a single
+        transaction.
+        """
+        competition = self.get_object()
+        data = request.data
+        if isinstance(data, list):
+            data = [dict(item, competition=competition.pk) if isinstance(item, dict) else item for item in data]
+        serializer = ResultSerializer(data=data, many=True, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     @method_decorator(vary_on_cookie)
     def dispatch(self, request, *args, **kwargs):
         return super().dispatch(request, *args, **kwargs)
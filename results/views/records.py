@@ -3,12 +3,14 @@ from django_filters.widgets import BooleanWidget
 from dry_rest_permissions.generics import DRYPermissions
 from rest_framework import mixins, viewsets
 
+from results.mixins.conditional_get import ConditionalGetMixin
+from results.mixins.response_cache import ResponseCacheMixin
 from results.models.records import Record, RecordLevel
 from results.serializers.records import RecordSerializer, RecordLevelSerializer
 from results.serializers.records_list import RecordListSerializer
 
 
-class RecordViewSet(viewsets.ModelViewSet):
+class RecordViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """API endpoint for records.
 
     list:
@@ -94,7 +96,7 @@ class RecordListFilter(filters.FilterSet):
     )
 
 
-class RecordList(mixins.ListModelMixin, viewsets.GenericViewSet):
+class RecordList(ResponseCacheMixin, ConditionalGetMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
     """API endpoint for retrieving record list.
 
     retrieve:
@@ -105,6 +107,7 @@ class RecordList(mixins.ListModelMixin, viewsets.GenericViewSet):
     serializer_class = RecordListSerializer
     filter_backends = [filters.DjangoFilterBackend]
     filterset_class = RecordListFilter
+    _RESPONSE_CACHE_SCOPES = {'type': 'type', 'sport': 'sport'}
 
     def get_queryset(self):
         """
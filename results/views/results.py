@@ -1,22 +1,28 @@
-import re
-
 from datetime import datetime
+from itertools import islice
 
+from django.conf import settings
 from django.utils.decorators import method_decorator
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from dry_rest_permissions.generics import DRYPermissions
 from rest_framework import exceptions, filters, mixins, viewsets
+from rest_framework.settings import api_settings
 
+from results.mixins.conditional_get import ConditionalGetMixin
+from results.mixins.response_cache import ResponseCacheMixin
+from results.models.athletes import Athlete
 from results.models.results import Result, ResultPartial
 from results.serializers.results import ResultSerializer, ResultPartialSerializer, ResultLimitedSerializer
-from results.serializers.results import ResultLimitedAggregateSerializer
+from results.serializers.results import ResultLimitedAggregateSerializer, ResultLimitedFlatSerializer
 from results.serializers.results_detail import ResultDetailSerializer
+from results.utils.export import EXPORT_CHUNK_SIZE, EXPORT_RENDERERS, stream_export
 from results.utils.pagination import CustomPagePagination
+from results.utils.season_ranks import group_best_results, group_season_ranks
 
 
-class ResultViewSet(viewsets.ModelViewSet):
+class ResultViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """API endpoint for results.
 
     list:
@@ -42,6 +48,7 @@ class ResultViewSet(viewsets.ModelViewSet):
     serializer_class = ResultSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['competition']
+    _RESPONSE_CACHE_SCOPES = {'competition': 'competition'}
 
     def get_queryset(self):
         """
@@ -52,7 +59,7 @@ class ResultViewSet(viewsets.ModelViewSet):
         return self.queryset
 
 
-class ResultPartialViewSet(viewsets.ModelViewSet):
+class ResultPartialViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """ API endpoint for partial results.
 
     list:
@@ -116,6 +123,10 @@ class ResultPartialViewSet(viewsets.ModelViewSet):
                           openapi.IN_QUERY,
                           description='Date in %Y-%m-%d (i.e. 2019-01-01) format.',
                           type=openapi.TYPE_STRING),
+        openapi.Parameter('season',
+                          openapi.IN_QUERY,
+                          description='Limit to competitions starting in the year.',
+                          type=openapi.TYPE_INTEGER),
         openapi.Parameter('approved',
                           openapi.IN_QUERY,
                           description='Limit to approved results.',
@@ -136,12 +147,23 @@ class ResultPartialViewSet(viewsets.ModelViewSet):
                           openapi.IN_QUERY,
                           description='Include only fields in results. Use != for excluding fields.',
                           type=openapi.TYPE_STRING),
+        openapi.Parameter('shape',
+                          openapi.IN_QUERY,
+                          description='Use flat to include related objects as ids or abbreviations.',
+                          type=openapi.TYPE_STRING),
+        openapi.Parameter('format',
+                          openapi.IN_QUERY,
+                          description='Export all results in csv or ndjson format.',
+                          type=openapi.TYPE_STRING),
     ]
 ))
-class ResultList(mixins.ListModelMixin, viewsets.GenericViewSet):
+class ResultList(ResponseCacheMixin, ConditionalGetMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
     """API endpoint for retrieving result lists.
 
-    group_results returns limited information, including only athlete and result.
+    Results are streamed without pagination in csv and ndjson formats, selected with format parameter.
+
+    group_results returns limited information, including only athlete and result. Grouped results are read from the
+    season result ranks if enabled and only season, type and category are used for filtering.
 
     retrieve:
     Returns the result list
@@ -153,29 +175,42 @@ class ResultList(mixins.ListModelMixin, viewsets.GenericViewSet):
     ordering_fields = ('competition__start_date', 'category', 'position', 'result')
     ordering = ('-result')
     serializer_class = ResultLimitedSerializer
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + EXPORT_RENDERERS
+    EXPORT_FIELDS = ['id', 'competition', 'competition__name', 'competition__date_start',
+                     'competition__type__abbreviation', 'athlete', 'first_name', 'last_name',
+                     'organization__abbreviation', 'category__abbreviation', 'result', 'result_code', 'decimals',
+                     'position', 'approved', 'team']
+    EXPORT_GROUP_FIELDS = ['athlete', 'first_name', 'last_name', 'result']
 
-    @staticmethod
-    def _build_raw_query(queryset):
+    _RESPONSE_CACHE_SCOPES = {'competition': 'competition', 'type': 'type', 'sport': 'sport'}
+    SEASON_RANK_PARAMS = {'season', 'type', 'category', 'group_results', 'limit', 'page', 'fields', 'format'}
+
+    def _get_group_results(self):
         """
-        Build a raw query for grouping results with inner query.
+        Returns number of best results summed by athlete, or None if results are not grouped.
         """
-        raw_query = str(queryset.query)
-        if 'WHERE' in raw_query:
-            where_query = ' WHERE' + raw_query.split('WHERE')[1].split(' ORDER BY')[0]
-            for match in re.findall(r' \d{4}-\d{2}-\d{2}', raw_query):
-                where_query = where_query.replace(match, ' "' + match.strip() + '"')
-            joins = re.split('FROM .results_result.', raw_query)[1].split('WHERE')[0]
-        else:
-            where_query = ''
-            joins = re.split('FROM .results_result.', raw_query)[1].split('ORDER BY')[0]
-        select_query = raw_query.split('FROM')[0]
-        first_select = re.sub('.results_result...result.,', 'SUM(`results_result`.`result`) `result`,', select_query)
-        second_select = select_query + (', ROW_NUMBER() OVER(PARTITION BY `results_result`.`athlete_id` '
-                                        'ORDER BY `results_result`.`result` DESC) `rn` ')
-        query_end = (') `results_result` WHERE `rn` <= %s GROUP BY `results_result`.`athlete_id` '
-                     'ORDER BY SUM(`result`) DESC')
-        raw_query = first_select + 'FROM (' + second_select + 'FROM `results_result`' + joins + where_query + query_end
-        return raw_query
+        group_results = self.request.query_params.get('group_results', None)
+        if group_results and group_results.isdigit() and int(group_results) > 1:
+            return int(group_results)
+        return None
+
+    def _is_flat(self):
+        """
+        Returns True if results are returned in the flat shape.
+        """
+        return self.request.query_params.get('shape', None) == 'flat'
+
+    def _get_season_rank_key(self):
+        """
+        Returns season, competition type and category if the grouped results can be read from the season result ranks.
+        """
+        if not settings.SEASON_RESULT_RANKS or set(self.request.query_params.keys()) - self.SEASON_RANK_PARAMS:
+            return None
+        try:
+            return (int(self.request.query_params.get('season')), int(self.request.query_params.get('type')),
+                    int(self.request.query_params.get('category')))
+        except (TypeError, ValueError):
+            return None
 
     def get_queryset(self):
         """
@@ -223,6 +258,10 @@ class ResultList(mixins.ListModelMixin, viewsets.GenericViewSet):
                 start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
                 queryset = queryset.filter(competition__date_end__gte=start_date)
 
+            season = self.request.query_params.get('season', None)
+            if season:
+                queryset = queryset.filter(competition__date_start__year=int(season))
+
             end_date = self.request.query_params.get('end', None)
             if end_date:
                 end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
@@ -243,18 +282,74 @@ class ResultList(mixins.ListModelMixin, viewsets.GenericViewSet):
         except ValueError:
             raise exceptions.ParseError()
 
-        group_results = self.request.query_params.get('group_results', None)
-        if group_results and group_results.isdigit() and int(group_results) > 1:
+        group_results = self._get_group_results()
+        if group_results:
             self.serializer_class = ResultLimitedAggregateSerializer
             self.ordering = None
             self.ordering_fields = None
             self.filter_backends = []
-            queryset = Result.objects.raw(self._build_raw_query(queryset), [int(group_results)])
+            season_rank_key = self._get_season_rank_key()
+            if season_rank_key:
+                return group_season_ranks(*season_rank_key, group_results)
+            return group_best_results(queryset, group_results)
+        if self._is_flat():
+            return ResultLimitedFlatSerializer.setup_queryset(queryset)
         queryset = self.get_serializer_class().setup_eager_loading(queryset)
         return queryset
 
+    @staticmethod
+    def _get_group_export_rows(queryset):
+        """
+        Yields grouped result rows with athlete names, loading names for each chunk.
+        """
+        rows = queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        while True:
+            chunk = list(islice(rows, EXPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            athletes = Athlete.objects.in_bulk([row['athlete'] for row in chunk])
+            for row in chunk:
+                athlete = athletes.get(row['athlete'])
+                yield {'athlete': row['athlete'],
+                       'first_name': athlete.first_name if athlete else None,
+                       'last_name': athlete.last_name if athlete else None,
+                       'result': row['group_result']}
+
+    def export(self, request):
+        """
+        Streams all filtered results in the export format, without pagination.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        if queryset.query.group_by is not None:
+            fields = self.EXPORT_GROUP_FIELDS
+            rows = self._get_group_export_rows(queryset)
+        else:
+            fields = self.EXPORT_FIELDS
+            rows = queryset.prefetch_related(None).values(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        return stream_export(request.accepted_renderer.format, fields, rows, 'results')
+
+    def list(self, request, *args, **kwargs):
+        """
+        Streams the export formats, bypassing response cache and pagination.
+        """
+        if request.accepted_renderer.format in [renderer.format for renderer in EXPORT_RENDERERS]:
+            return self.export(request)
+        return super().list(request, *args, **kwargs)
+
+    def get_serializer(self, *args, **kwargs):
+        """
+        Grouped results are serialized from result rows, adding athletes after pagination.
+        Flat results are serialized from result rows, adding partial results and records after pagination.
+        """
+        if self._get_group_results():
+            rows = ResultLimitedAggregateSerializer.setup_athletes(list(args[0]))
+            return super().get_serializer(rows, *args[1:], **kwargs)
+        if self._is_flat():
+            return ResultLimitedFlatSerializer(args[0])
+        return super().get_serializer(*args, **kwargs)
+
 
-class ResultDetailViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+class ResultDetailViewSet(ConditionalGetMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     """API endpoint for retrieving detailed result information.
 
     retrieve:
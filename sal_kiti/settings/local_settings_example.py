@@ -39,6 +39,34 @@ DATABASES = {
 # If true, new record will be created for the same result as the previous record.
 CREATE_RECORD_FOR_SAME_RESULT_VALUE = False
 
+# Cache time in seconds for the record categories, i.e. 60*60. 0 to disable.
+# Requires a cache shared by all processes, as changes to categories invalidate the cache.
+CATEGORY_CACHE_TIMEOUT = 0
+
+# When records are checked after a result is saved, possible values:
+# immediate: check in the save
+# commit: check each changed result once, when the transaction is committed
+# queue: add changed results to a queue, which is processed with the checkrecordqueue management command
+RECORD_CHECK_MODE = 'immediate'
+
+# When change log entries are written, possible values:
+# immediate: write each entry in the save
+# buffered: collect entries during a request or a management command and write them in bulk after the commit
+# thread: as buffered, but write entries in a background thread
+CHANGE_LOG_MODE = 'immediate'
+
+# Keep season result ranks summary table for grouped result lists, rebuild with the rebuildseasonranks command
+SEASON_RESULT_RANKS = False
+
+# Cache result, record and competition lists for anonymous users, in seconds, i.e. 60*5. 0 to disable.
+# Requires a cache shared by all processes, as changes invalidate cached lists.
+# Conditional requests with ETag use the same cache versions and are supported only if the cache is enabled.
+RESPONSE_CACHE_TIMEOUT = 0
+
+# Cache statistics for closed years, i.e. past years without unlocked competitions, in seconds, i.e. 60*60*24.
+# 0 to disable. Requires a cache shared by all processes, as changes invalidate cached statistics.
+STATISTICS_CACHE_TIMEOUT = 0
+
 # Should publishing events and competitions require staff or superuser.
 # If false, organizers may also publish events and competitions.
 COMPETITION_PUBLISH_REQUIRES_STAFF = True
@@ -83,7 +111,12 @@ SUOMISPORT = {
     'ORGANIZATION_ID': '',
     'TOKEN_URL': 'https://www.suomisport.fi/oauth2/token',
     'LICENCE_TYPES': ['Competition'],
-    'FETCH_SIZE': 1000
+    'FETCH_SIZE': 1000,
+    # Pages fetched concurrently ahead of processing
+    'FETCH_WORKERS': 4,
+    # Retries for failed requests, first retry after FETCH_BACKOFF seconds, doubled for each retry
+    'FETCH_RETRIES': 3,
+    'FETCH_BACKOFF': 1
 }
 
 if 'test' in sys.argv:
@@ -39,7 +39,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'results.middleware.current_user.CurrentUserMiddleware'
+    'results.middleware.current_user.CurrentUserMiddleware',
+    'results.middleware.change_log.ChangeLogBufferMiddleware'
 ]
 
 REST_FRAMEWORK = {
@@ -73,6 +74,12 @@ TEMPLATES = [
     },
 ]
 CREATE_RECORD_FOR_SAME_RESULT_VALUE = False
+CATEGORY_CACHE_TIMEOUT = 0
+RECORD_CHECK_MODE = 'immediate'
+CHANGE_LOG_MODE = 'immediate'
+SEASON_RESULT_RANKS = False
+RESPONSE_CACHE_TIMEOUT = 0
+STATISTICS_CACHE_TIMEOUT = 0
 COMPETITION_PUBLISH_REQUIRES_STAFF = True
 EVENT_PUBLISH_REQUIRES_STAFF = True
 